@@ -1 +1,3 @@
 """The age estimation module."""
+
+cosmology_directory = './cosmology_aux_data_170429/cosmology_aux_data_170429'  # The images and CSV files.
@@ -22,6 +22,7 @@ import glob
 from utility import to_normalized_range, download_and_extract_file, unison_shuffled_copies, seed_all
 from skimage import transform,io
 import scipy.misc
+import age as age_package
 
 
 class AgeDataset(Dataset):
@@ -36,7 +37,7 @@ class AgeDataset(Dataset):
         self.IMAGE_SIZE = IMAGE_SIZE
         self.category = category
         #Code for new version for the CIL Project
-        data_path = './cosmology_aux_data_170429/cosmology_aux_data_170429/'
+        data_path = age_package.cosmology_directory + '/'
         self.path_black_image = '/content/drive/My Drive/05_CIL_Project/Black_Image.png'
         self.dataset_path = data_path + category + '/' # Directory of the images
         self.x_images = []
@@ -0,0 +1 @@
+"""Benchmarks of the training code, run on synthetic data."""
@@ -0,0 +1,63 @@
+"""
+Measures drawing the generator input from the offset normal mixture with the scipy `MixtureModel` (followed by the
+copy to the device), against the torch `TorchMixtureModel` sampling directly on the device. Run from the repository
+root with `python -m benchmarks.mixture_sampling`.
+"""
+import time
+
+import torch
+from scipy.stats import norm
+from torch.distributions import Normal
+
+from utility import MixtureModel, TorchMixtureModel, gpu
+
+sample_sizes = [[1000, 10], [16, 100]]  # The shapes drawn (e.g. a batch of generator inputs).
+draw_count = 500  # Timed draws of each shape, after a few untimed warm-up draws.
+mean_offset = 2  # The offset of the normal submodels, as in the settings.
+
+
+def time_draws(draw, size):
+    """
+    Times drawing samples of a size.
+
+    :param draw: The function drawing the samples.
+    :type draw: function
+    :param size: The shape of the samples.
+    :type size: list[int]
+    :return: The average microseconds per draw.
+    :rtype: float
+    """
+    for _ in range(5):
+        draw(size)
+    if gpu.type == 'cuda':
+        torch.cuda.synchronize()
+    start_time = time.perf_counter()
+    for _ in range(draw_count):
+        draw(size)
+    if gpu.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start_time) / draw_count * 1e6
+
+
+def run_benchmark():
+    """
+    Times both mixture models for each sample size, printing the results.
+
+    :return: The microseconds per draw of each model, for each sample size.
+    :rtype: dict[str, dict[str, float]]
+    """
+    scipy_model = MixtureModel([norm(-mean_offset, 1), norm(mean_offset, 1)])
+    torch_model = TorchMixtureModel([Normal(-float(mean_offset), 1.), Normal(float(mean_offset), 1.)])
+
+    def scipy_draw(size):
+        return torch.tensor(scipy_model.rvs(size=size), dtype=torch.float32).to(gpu)
+
+    results = {}
+    for size in sample_sizes:
+        results[str(size)] = {'scipy': time_draws(scipy_draw, size), 'torch': time_draws(torch_model.rvs, size)}
+        print(f'{size}: scipy {results[str(size)]["scipy"]:.0f} us -> torch {results[str(size)]["torch"]:.0f} us')
+    return results
+
+
+if __name__ == '__main__':
+    run_benchmark()
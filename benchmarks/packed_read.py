@@ -0,0 +1,81 @@
+"""
+Measures the read throughput of a crowd database's `.npy` files against its packed shards (see `crowd.packed_data`),
+for both random training patches and full images, checking both storages give the same examples. Run from the
+repository root with `python -m benchmarks.packed_read`, on a preprocessed (or fabricated) database. Reads are
+through the page cache, so the first storage read is at a disadvantage unless the database fits in memory and was
+recently read (or the caches are dropped between runs).
+"""
+import os
+import random
+import time
+
+import numpy as np
+
+from crowd import packed_data
+from crowd.data import CrowdDataset
+from crowd.shanghai_tech_data import ShanghaiTechFullImageDataset, ShanghaiTechTransformedDataset
+from crowd.ucf_cc_50_data import UcfCc50FullImageDataset, UcfCc50TransformedDataset
+from crowd.ucf_qnrf_data import UcfQnrfFullImageDataset, UcfQnrfTransformedDataset
+
+crowd_dataset = CrowdDataset.shanghai_tech  # The database to read.
+patch_count = 2000  # Random patches read from each storage.
+image_patch_size = 224
+map_directory_name = 'i1nn_maps'
+pack_missing = True  # Packs the train dataset directory first, if it has no packed shards.
+
+dataset_classes = {CrowdDataset.shanghai_tech: (ShanghaiTechTransformedDataset, ShanghaiTechFullImageDataset),
+                   CrowdDataset.ucf_qnrf: (UcfQnrfTransformedDataset, UcfQnrfFullImageDataset),
+                   CrowdDataset.ucf_cc_50: (UcfCc50TransformedDataset, UcfCc50FullImageDataset)}
+
+
+def run_benchmark():
+    """
+    Reads the random patches and full images from each storage, printing their throughput.
+
+    :return: The patches per second, full images per second, and megabytes per second of full images, of each storage.
+    :rtype: dict[str, dict[str, float]]
+    """
+    transformed_dataset_class, full_image_dataset_class = dataset_classes[crowd_dataset]
+    dataset_directory = transformed_dataset_class(seed=0, image_patch_size=image_patch_size,
+                                                  label_patch_size=image_patch_size,
+                                                  map_directory_name=map_directory_name).dataset_directory
+    packed_index_path = os.path.join(dataset_directory, packed_data.packed_directory_name,
+                                     packed_data.index_file_name)
+    if pack_missing and not os.path.exists(packed_index_path):
+        packed_data.pack_dataset_directory(dataset_directory, channels=['labels', map_directory_name])
+    results = {}
+    checksums = {}
+    for storage in ['npy', 'packed']:
+        dataset = transformed_dataset_class(seed=0, image_patch_size=image_patch_size,
+                                            label_patch_size=image_patch_size, map_directory_name=map_directory_name,
+                                            storage=storage)
+        random.seed(0)
+        start_time = time.perf_counter()
+        patch_checksum = 0.0
+        for _ in range(patch_count):
+            image, label, map_ = dataset[0]
+            patch_checksum += float(image[0, 0, 0]) + float(label.sum()) + float(map_[0, 0])
+        patch_seconds = time.perf_counter() - start_time
+        full_image_dataset = full_image_dataset_class(seed=0, map_directory_name=map_directory_name, storage=storage)
+        start_time = time.perf_counter()
+        full_image_bytes = 0
+        full_image_checksum = 0.0
+        for index in range(len(full_image_dataset)):
+            image, label, map_ = full_image_dataset[index]
+            full_image_bytes += image.nbytes + label.nbytes + map_.nbytes
+            full_image_checksum += float(np.sum(label, dtype=np.float64))
+        full_image_seconds = time.perf_counter() - start_time
+        checksums[storage] = (patch_checksum, full_image_checksum)
+        results[storage] = {'patches_per_second': patch_count / patch_seconds,
+                            'full_images_per_second': len(full_image_dataset) / full_image_seconds,
+                            'full_image_megabytes_per_second': full_image_bytes / 1e6 / full_image_seconds}
+        print(f'{storage:>6}: {results[storage]["patches_per_second"]:8.1f} patches/s  '
+              f'{results[storage]["full_images_per_second"]:8.1f} full images/s  '
+              f'{results[storage]["full_image_megabytes_per_second"]:8.1f} MB/s')
+    if not np.allclose(checksums['npy'], checksums['packed']):
+        print(f'The storages gave different examples: {checksums}')
+    return results
+
+
+if __name__ == '__main__':
+    run_benchmark()
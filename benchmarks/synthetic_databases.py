@@ -0,0 +1,379 @@
+"""
+Fabricates synthetic versions of the databases, with random images and head positions, in the same on-disk layouts
+as the preprocessed real databases, but under their own root directory (so the real databases are never touched).
+The data pipelines can then be exercised, or load tested beyond the size of the real data, without network access.
+Run from the repository root (where the experiments are run from) with `python -m benchmarks.synthetic_databases`.
+To train on the fabricated databases, call `use_synthetic_databases` at the top of the run script (outside its
+`__main__` guard, so the spawned worker processes use them too).
+"""
+import json
+import os
+import shutil
+
+import imageio
+import numpy as np
+import pandas as pd
+from scipy.ndimage import distance_transform_edt, gaussian_filter
+
+import age
+from crowd import database_preprocessor, world_expo_data
+from crowd.database_preprocessor import (density_kernel_betas, iknn_map_neighbor_counts, iknn_map_epsilon,
+                                         density_directory_name, generate_point_density_map, generate_density_label,
+                                         head_standard_deviation_meters)
+from crowd.shanghai_tech_data import ShanghaiTechPreprocessor
+from crowd.ucf_cc_50_data import UcfCc50Preprocessor
+from crowd.ucf_qnrf_data import UcfQnrfPreprocessor
+from driving import data as driving_data
+
+database_names = None  # Names of the databases to fabricate (see `fabricators`). None fabricates all of them.
+example_scale = 1.0  # Multiplies the real number of examples (e.g. 10 for a load test at 10x the real data).
+image_scale = 1.0  # Multiplies the real image side lengths.
+exact_labels = False  # Generate the labels with the preprocessors' own (slow) code, rather than fast approximations.
+overwrite_existing = False  # Replace existing fabricated databases. Otherwise, existing databases are skipped.
+seed = 0
+output_root = '../Synthetic Databases'  # The directory the databases are fabricated in.
+
+marker_file_name = '.synthetic_database'  # Marks a database directory as fabricated, so it may be replaced.
+
+
+def fabricate_databases():
+    """Fabricates each of the selected databases, under the output root."""
+    use_synthetic_databases()
+    names = database_names if database_names is not None else list(fabricators)
+    for name in names:
+        print(f'Fabricating {name} database...', flush=True)
+        fabricators[name](np.random.RandomState(seed))
+
+
+def fabricate_shanghai_tech(random_state):
+    """
+    Fabricates the ShanghaiTech database, with the splits of each part in their own directories.
+
+    :param random_state: The random state to generate the data with.
+    :type random_state: np.random.RandomState
+    """
+    preprocessor = ShanghaiTechPreprocessor()
+    if not prepare_database_directory(preprocessor.database_directory):
+        return
+    # Part, split, real image count, typical image shape, and mean head count.
+    splits = [('part_A', 'train_data', 300, (589, 868), 501), ('part_A', 'test_data', 182, (589, 868), 501),
+              ('part_B', 'train_data', 400, (768, 1024), 123), ('part_B', 'test_data', 316, (768, 1024), 123)]
+    for part, split, image_count, image_shape, head_count in splits:
+        dataset_directory = os.path.join(preprocessor.database_directory, part, split)
+        # The preprocessor keeps the trailing `.` of the `GT_IMG_1.mat` names.
+        file_names = [f'IMG_{index}.' for index in range(1, scaled_count(image_count) + 1)]
+        fabricate_crowd_examples(preprocessor, dataset_directory, file_names, image_shape, head_count, random_state)
+    preprocessor.write_manifests()
+    preprocessor.print_statistics()
+
+
+def fabricate_ucf_qnrf(random_state):
+    """
+    Fabricates the UCF QNRF database, with its train and test splits.
+
+    :param random_state: The random state to generate the data with.
+    :type random_state: np.random.RandomState
+    """
+    preprocessor = UcfQnrfPreprocessor()
+    if not prepare_database_directory(preprocessor.database_directory):
+        return
+    for split, image_count in [('Train', 1201), ('Test', 334)]:
+        dataset_directory = os.path.join(preprocessor.database_directory, split)
+        file_names = [f'img_{index:04d}' for index in range(1, scaled_count(image_count) + 1)]
+        fabricate_crowd_examples(preprocessor, dataset_directory, file_names, (2013, 2902), 815, random_state)
+    preprocessor.write_manifests()
+    preprocessor.print_statistics()
+
+
+def fabricate_ucf_cc_50(random_state):
+    """
+    Fabricates the UCF CC 50 database, whose splits are chosen when it is loaded.
+
+    :param random_state: The random state to generate the data with.
+    :type random_state: np.random.RandomState
+    """
+    preprocessor = UcfCc50Preprocessor()
+    if not prepare_database_directory(preprocessor.database_directory):
+        return
+    file_names = [str(index) for index in range(1, scaled_count(50) + 1)]
+    fabricate_crowd_examples(preprocessor, preprocessor.database_directory, file_names, (2101, 2888), 1280,
+                             random_state)
+    preprocessor.write_manifests()
+    preprocessor.print_statistics()
+
+
+def fabricate_world_expo(random_state):
+    """
+    Fabricates the World Expo database, with each camera's images, density labels, region of interest, and
+    perspective map in its own directory, and the cameras of each split listed in the JSON file.
+
+    :param random_state: The random state to generate the data with.
+    :type random_state: np.random.RandomState
+    """
+    database_directory = world_expo_data.database_directory
+    if not prepare_database_directory(database_directory):
+        return
+    image_shape = scaled_shape((576, 720))
+    camera_names = [str(100000 + index) for index in range(108)]
+    cameras_dict = {'train': camera_names[:98], 'validation': camera_names[98:103], 'test': camera_names[103:],
+                    'unlabeled': camera_names[:98]}
+    with open(os.path.join(database_directory, 'viable_with_validation_and_random_test.json'), 'w') as json_file:
+        json.dump(cameras_dict, json_file)
+    image_count = scaled_count(35)
+    for camera_name in camera_names:
+        camera_directory = os.path.join(database_directory, camera_name)
+        os.makedirs(camera_directory)
+        roi = np.zeros(image_shape, dtype=np.bool_)
+        horizon = random_state.randint(image_shape[0] // 2)
+        roi[horizon:] = True
+        near_scale, far_scale = random_state.uniform(40, 80), random_state.uniform(5, 20)  # Pixels per meter.
+        perspective = np.repeat(np.linspace(far_scale, near_scale, image_shape[0], dtype=np.float32)[:, None],
+                                image_shape[1], axis=1)
+        np.save(os.path.join(camera_directory, 'roi.npy'), roi)
+        np.save(os.path.join(camera_directory, 'perspective.npy'), perspective)
+        images = np.lib.format.open_memmap(os.path.join(camera_directory, 'images.npy'), mode='w+', dtype=np.uint8,
+                                           shape=(image_count, *image_shape, 3))
+        labels = np.lib.format.open_memmap(os.path.join(camera_directory, 'labels.npy'), mode='w+',
+                                           dtype=np.float32, shape=(image_count, *image_shape))
+        for index in range(image_count):
+            images[index] = random_image(image_shape, random_state)
+            head_positions = random_head_positions((image_shape[0] - horizon, image_shape[1]), 50, random_state)
+            head_positions[:, 0] += horizon
+            if exact_labels:
+                labels[index] = generate_density_label(head_positions, image_shape, perspective=perspective,
+                                                       yx_order=True)
+            else:
+                labels[index] = fast_density_label(head_positions, image_shape,
+                                                   head_standard_deviation_meters * perspective.mean())
+        images.flush()
+        labels.flush()
+        del images, labels
+        if camera_name in cameras_dict['unlabeled']:
+            unlabeled_images = np.lib.format.open_memmap(os.path.join(camera_directory, 'unlabeled_images.npy'),
+                                                         mode='w+', dtype=np.uint8,
+                                                         shape=(image_count, *image_shape, 3))
+            for index in range(image_count):
+                unlabeled_images[index] = random_image(image_shape, random_state)
+            unlabeled_images.flush()
+            del unlabeled_images
+    print(f'{len(camera_names)} cameras of {image_count} images fabricated.')
+
+
+def fabricate_steering_angle(random_state):
+    """
+    Fabricates the steering angle database, with the preprocessed images and the `meta.pkl` of their angles.
+
+    :param random_state: The random state to generate the data with.
+    :type random_state: np.random.RandomState
+    """
+    database_directory = driving_data.database_directory
+    if not prepare_database_directory(database_directory):
+        return
+    image_count = scaled_count(45567)
+    image_names = [f'{index}.jpg' for index in range(image_count)]
+    angles = np.clip(random_state.normal(0, 30, size=image_count), -180, 180).round(2)
+    pd.DataFrame({0: image_names, 1: angles}).to_pickle(os.path.join(database_directory, 'meta.pkl'))
+    image_size = scaled_shape((128, 128))
+    for image_name in image_names:
+        image = random_image(image_size, random_state).transpose((2, 0, 1)).astype(np.float64)
+        np.save(os.path.join(database_directory, image_name.replace('.jpg', '.npy')), image)
+    print(f'{image_count} images fabricated.')
+
+
+def fabricate_cosmology(random_state):
+    """
+    Fabricates the cosmology database, with the labeled, scored, and query PNG images and the CSV files of the labels
+    and scores.
+
+    :param random_state: The random state to generate the data with.
+    :type random_state: np.random.RandomState
+    """
+    cosmology_directory = age.cosmology_directory
+    if not prepare_database_directory(cosmology_directory):
+        return
+    image_shape = scaled_shape((1000, 1000))
+    category_counts = {'labeled': scaled_count(1200), 'scored': scaled_count(9600), 'query': scaled_count(1200)}
+    ids = random_state.choice(9000000, size=sum(category_counts.values()), replace=False) + 1000000
+    start = 0
+    for category, count in category_counts.items():
+        category_ids = ids[start:start + count]
+        start += count
+        category_directory = os.path.join(cosmology_directory, category)
+        os.makedirs(category_directory)
+        for id_ in category_ids:
+            image = (random_state.exponential(8, size=image_shape)).clip(0, 255).astype(np.uint8)  # Mostly dark.
+            imageio.imwrite(os.path.join(category_directory, f'{id_}.png'), image)
+        if category == 'labeled':
+            actual = random_state.randint(2, size=count).astype(np.float64)
+        elif category == 'scored':
+            actual = random_state.uniform(0, 8, size=count)
+        else:
+            continue
+        pd.DataFrame({'Id': category_ids, 'Actual': actual}).to_csv(
+            os.path.join(cosmology_directory, f'{category}.csv'), index=False)
+    print(f'{sum(category_counts.values())} images fabricated.')
+
+
+def fabricate_crowd_examples(preprocessor, dataset_directory, file_names, typical_image_shape, mean_head_count,
+                             random_state):
+    """
+    Fabricates the images, point labels, density labels, and inverse kNN maps of crowd examples, in the layout of
+    `DatabasePreprocessor.generate_labels_for_example`, adding them to the preprocessor's manifests.
+
+    :param preprocessor: The preprocessor of the database.
+    :type preprocessor: crowd.database_preprocessor.DatabasePreprocessor
+    :param dataset_directory: The directory of the dataset split.
+    :type dataset_directory: str
+    :param file_names: The file names of the examples (without extension).
+    :type file_names: list[str]
+    :param typical_image_shape: The typical (unscaled) shape of the images, around which each image's shape varies.
+    :type typical_image_shape: (int, int)
+    :param mean_head_count: The mean head count of an (unscaled) image.
+    :type mean_head_count: int
+    :param random_state: The random state to generate the data with.
+    :type random_state: np.random.RandomState
+    """
+    os.makedirs(dataset_directory, exist_ok=True)
+    for file_name in file_names:
+        image_shape = scaled_shape(np.array(typical_image_shape) * random_state.uniform(0.75, 1.25))
+        image = random_image(image_shape, random_state)
+        head_positions = random_head_positions(image_shape, mean_head_count, random_state)
+        if exact_labels:
+            preprocessor.generate_labels_for_example(dataset_directory, file_name, image, head_positions)
+        else:
+            save_fast_crowd_labels(dataset_directory, file_name, image, head_positions)
+            preprocessor.total_head_count += len(head_positions)
+            preprocessor.total_images += 1
+            preprocessor.add_manifest_entry(dataset_directory, file_name, len(head_positions))
+
+
+def save_fast_crowd_labels(dataset_directory, file_name, image, head_positions):
+    """
+    Saves an example with the labels of `DatabasePreprocessor.generate_labels_for_example`, approximated with image
+    filters. The density spreads use the mean spacing of the heads in place of each head's neighbor distances, and
+    every kNN map uses the distance to the nearest head.
+    """
+    label_size = image.shape[:2]
+    point_map, _ = generate_point_density_map(head_positions, label_size)
+    arrays = {'images': image, 'labels': point_map.astype(np.float16)}
+    head_spacing = np.sqrt(label_size[0] * label_size[1] / len(head_positions))
+    for beta in density_kernel_betas:
+        density_label = fast_density_label(head_positions, label_size, beta * head_spacing, point_map=point_map)
+        arrays[density_directory_name(beta)] = density_label.astype(np.float16)
+    iknn_map = 1 / (distance_transform_edt(point_map == 0) + iknn_map_epsilon)
+    for k in iknn_map_neighbor_counts:
+        arrays[f'i{k}nn_maps'] = iknn_map.astype(np.float16)
+    for directory_name, array in arrays.items():
+        directory = os.path.join(dataset_directory, directory_name)
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, f'{file_name}.npy'), array)
+
+
+def fast_density_label(head_positions, label_size, standard_deviation, point_map=None):
+    """
+    A density label of gaussians with a single standard deviation, normalized to the head count.
+
+    :param head_positions: The y, x head positions.
+    :type head_positions: np.ndarray
+    :param label_size: The shape of the label.
+    :type label_size: (int, int)
+    :param standard_deviation: The standard deviation of the head gaussians.
+    :type standard_deviation: float
+    :param point_map: The point label of the heads, if already generated.
+    :type point_map: np.ndarray
+    :return: The density label.
+    :rtype: np.ndarray
+    """
+    if point_map is None:
+        point_map, _ = generate_point_density_map(head_positions, label_size)
+    density_label = gaussian_filter(point_map.astype(np.float32), standard_deviation, mode='constant')
+    return density_label * (point_map.sum() / max(density_label.sum(), 1e-12))
+
+
+def random_image(image_shape, random_state):
+    """A random RGB uint8 image."""
+    return random_state.randint(256, size=(*image_shape, 3), dtype=np.uint8)
+
+
+def random_head_positions(image_shape, mean_head_count, random_state):
+    """
+    Random y, x head positions within an image, with a head count around the mean (scaled to the image area), half of
+    them gathered in clusters as in real crowds.
+
+    :param image_shape: The shape of the image.
+    :type image_shape: (int, int)
+    :param mean_head_count: The mean head count of an (unscaled) image.
+    :type mean_head_count: int
+    :param random_state: The random state to generate the data with.
+    :type random_state: np.random.RandomState
+    :return: The head positions.
+    :rtype: np.ndarray
+    """
+    head_count = max(1, random_state.poisson(mean_head_count * image_scale ** 2))
+    image_shape = np.array(image_shape)
+    scattered_positions = random_state.uniform(0, image_shape, size=(head_count - head_count // 2, 2))
+    cluster_centers = random_state.uniform(0, image_shape, size=(random_state.randint(1, 6), 2))
+    clustered_positions = (cluster_centers[random_state.randint(len(cluster_centers), size=head_count // 2)] +
+                           random_state.normal(0, image_shape.min() / 10, size=(head_count // 2, 2)))
+    head_positions = np.concatenate([scattered_positions, clustered_positions])
+    return np.clip(head_positions, 0, image_shape - 1)
+
+
+def scaled_count(count):
+    """The number of examples for a real number of examples, scaled by `example_scale`."""
+    return max(1, int(round(count * example_scale)))
+
+
+def scaled_shape(shape):
+    """The image shape for a real image shape, scaled by `image_scale`."""
+    return tuple(max(1, int(round(side * image_scale))) for side in shape)
+
+
+def use_synthetic_databases(root=None):
+    """
+    Points the database loaders of this process at the fabricated databases.
+
+    :param root: The directory of the fabricated databases. None for the output root.
+    :type root: str
+    """
+    root = root if root is not None else output_root
+    database_preprocessor.database_root = root
+    world_expo_data.database_directory = os.path.join(root, 'World Expo')
+    driving_data.database_directory = os.path.join(root, 'Steering Angle Database')
+    age.cosmology_directory = os.path.join(root, 'cosmology_aux_data_170429', 'cosmology_aux_data_170429')
+
+
+def prepare_database_directory(database_directory):
+    """
+    Creates an empty directory for a database, marked as fabricated. An existing directory is replaced only if
+    `overwrite_existing` is set, and only if it was fabricated.
+
+    :param database_directory: The directory of the database.
+    :type database_directory: str
+    :return: Whether the database should be fabricated.
+    :rtype: bool
+    """
+    if os.path.exists(database_directory):
+        if not overwrite_existing:
+            print(f'{database_directory} already exists. Skipping.')
+            return False
+        if not os.path.exists(os.path.join(database_directory, marker_file_name)):
+            raise ValueError(f'{database_directory} was not fabricated, so it will not be replaced.')
+        shutil.rmtree(database_directory)
+    os.makedirs(database_directory)
+    open(os.path.join(database_directory, marker_file_name), 'w').close()
+    return True
+
+
+fabricators = {
+    'ShanghaiTech': fabricate_shanghai_tech,
+    'UCF QNRF': fabricate_ucf_qnrf,
+    'UCF CC 50': fabricate_ucf_cc_50,
+    'World Expo': fabricate_world_expo,
+    'Steering Angle': fabricate_steering_angle,
+    'Cosmology': fabricate_cosmology,
+}
+
+
+if __name__ == '__main__':
+    fabricate_databases()
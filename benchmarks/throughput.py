@@ -0,0 +1,292 @@
+"""
+Measures the training throughput of each application's experiments on synthetic in-memory data, writing the results
+with the machine's metadata as JSON (so runs can be compared across commits). Each experiment is also run with its
+networks compiled, whose startup cost shows in the setup and warm-up time, and whose steady-state speedup in the steps
+per second. Run from the repository root with `python -m benchmarks.throughput`. Needs no datasets, downloads, or GPU.
+"""
+import datetime
+import importlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import torch
+import torch.multiprocessing as multiprocessing
+from torch.utils.data import DataLoader, TensorDataset
+
+from settings import Settings
+
+benchmark_names = None  # Names of the benchmarks to run (see `benchmarks`). None runs all of them.
+benchmark_steps = 20  # Timed training steps of each benchmark, after one untimed warm-up step.
+benchmark_batch_size = None  # Overrides the batch size of every benchmark (e.g. for a quick check).
+output_path = 'benchmark_results.json'  # The file the results are written to. None only prints them.
+
+
+class Benchmark:
+    """
+    An experiment to benchmark, with the shapes of its synthetic data. Without an example shape, the experiment's own
+    datasets are used (for applications whose data is already generated in memory). The timed steps can be reduced
+    below `benchmark_steps` for slow benchmarks.
+    """
+    def __init__(self, module_name, class_name, batch_size, example_shape=None, label_shapes=(), settings=None,
+                 steps=None):
+        self.module_name = module_name
+        self.class_name = class_name
+        self.batch_size = batch_size
+        self.example_shape = example_shape
+        self.label_shapes = label_shapes
+        self.settings = settings or {}
+        self.steps = steps
+
+
+crowd_shapes = dict(example_shape=(3, 224, 224), label_shapes=[(224, 224), (224, 224)])  # Image, density, and map.
+driving_shapes = dict(example_shape=(3, 128, 128), label_shapes=[()])
+compiled = {'compile_mode': 'default'}
+compiled_crowd_steps = 5  # The DenseNet compiles slowly, so its compiled benchmarks time fewer steps.
+benchmarks = {
+    'coefficient srgan': Benchmark('coefficient.srgan', 'CoefficientExperiment', 5000),
+    'coefficient srgan compiled': Benchmark('coefficient.srgan', 'CoefficientExperiment', 5000, settings=compiled),
+    'coefficient sgan': Benchmark('coefficient.sgan', 'CoefficientSganExperiment', 5000),
+    'coefficient sgan compiled': Benchmark('coefficient.sgan', 'CoefficientSganExperiment', 5000, settings=compiled),
+    'coefficient dggan': Benchmark('coefficient.dggan', 'CoefficientDgganExperiment', 5000),
+    'coefficient dggan compiled': Benchmark('coefficient.dggan', 'CoefficientDgganExperiment', 5000,
+                                            settings=compiled),
+    'driving srgan': Benchmark('driving.srgan', 'DrivingExperiment', 600, **driving_shapes),
+    'driving srgan compiled': Benchmark('driving.srgan', 'DrivingExperiment', 600, **driving_shapes,
+                                        settings=compiled),
+    'crowd srgan': Benchmark('crowd.srgan', 'CrowdExperiment', 15, **crowd_shapes),
+    'crowd srgan compiled': Benchmark('crowd.srgan', 'CrowdExperiment', 15, **crowd_shapes, settings=compiled,
+                                      steps=compiled_crowd_steps),
+    'crowd dnn': Benchmark('crowd.dnn', 'CrowdDnnExperiment', 15, **crowd_shapes),
+    'crowd dnn compiled': Benchmark('crowd.dnn', 'CrowdDnnExperiment', 15, **crowd_shapes, settings=compiled,
+                                    steps=compiled_crowd_steps),
+    'crowd sgan': Benchmark('crowd.sgan', 'CrowdSganExperiment', 15, **crowd_shapes),
+    'crowd sgan compiled': Benchmark('crowd.sgan', 'CrowdSganExperiment', 15, **crowd_shapes, settings=compiled,
+                                     steps=compiled_crowd_steps),
+    'crowd dggan': Benchmark('crowd.dggan', 'CrowdDgganExperiment', 15, **crowd_shapes),
+    'crowd dggan compiled': Benchmark('crowd.dggan', 'CrowdDgganExperiment', 15, **crowd_shapes, settings=compiled,
+                                      steps=compiled_crowd_steps),
+}
+
+
+def run_benchmarks():
+    """
+    Runs the benchmarks, each in its own process (so its peak memory is its own), then writes the results.
+
+    :return: The machine metadata and the result of each benchmark.
+    :rtype: dict
+    """
+    names = benchmark_names if benchmark_names is not None else list(benchmarks)
+    results = {}
+    for name in names:
+        print(f'Benchmarking {name}...', flush=True)
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            try:
+                results[name] = executor.submit(benchmark_worker, name, benchmark_steps,
+                                                benchmark_batch_size).result()
+            except BrokenProcessPool:
+                results[name] = {'status': 'Crashed'}
+        print(summary_line(name, results[name]), flush=True)
+    report = {'machine': machine_metadata(), 'steps': benchmark_steps, 'benchmarks': results}
+    if output_path is not None:
+        with open(output_path, 'w') as output_file:
+            json.dump(report, output_file, indent=1)
+        print(f'Results written to {output_path}.')
+    return report
+
+
+def benchmark_worker(name, steps, batch_size=None):
+    """
+    Runs a single benchmark, reporting any error as its result.
+
+    :param name: The name of the benchmark.
+    :type name: str
+    :param steps: The number of timed training steps.
+    :type steps: int
+    :param batch_size: The batch size, or None for the benchmark's own.
+    :type batch_size: int
+    :return: The result of the benchmark.
+    :rtype: dict
+    """
+    try:
+        return run_benchmark(benchmarks[name], steps, batch_size)
+    except Exception:
+        return {'status': 'Failed', 'error': traceback.format_exc()}
+
+
+def run_benchmark(benchmark, steps, batch_size=None):
+    """
+    Trains the benchmark's experiment for one warm-up step and the timed steps, without validation summaries.
+
+    :param benchmark: The benchmark to run.
+    :type benchmark: Benchmark
+    :param steps: The number of timed training steps (reduced to the benchmark's own, if it has fewer).
+    :type steps: int
+    :param batch_size: The batch size, or None for the benchmark's own.
+    :type batch_size: int
+    :return: The result of the benchmark.
+    :rtype: dict
+    """
+    if benchmark.steps is not None:
+        steps = min(steps, benchmark.steps)
+    experiment_class = getattr(importlib.import_module(benchmark.module_name), benchmark.class_name)
+    settings = Settings()
+    settings.trial_name = benchmark.class_name
+    settings.batch_size = batch_size or benchmark.batch_size
+    settings.steps_to_run = steps + 1
+    settings.summary_step_period = steps + 1  # Summaries (and phase timings) only at the first and last steps.
+    settings.should_save_models = False
+    settings.skip_completed_experiment = False
+    settings.number_of_data_workers = 0
+    settings.pin_memory = torch.cuda.is_available()
+    settings.pretrained_weights = False
+    for name, value in benchmark.settings.items():
+        setattr(settings, name, value)
+    with tempfile.TemporaryDirectory() as logs_directory:
+        settings.logs_directory = logs_directory
+        experiment = synthetic_data_experiment_class(experiment_class, benchmark)(settings)
+        start_time = time.perf_counter()
+        experiment.train()
+        total_time = time.perf_counter() - start_time
+        summary_writers = [summary_writer for summary_writer in [experiment.dnn_summary_writer,
+                                                                 experiment.gan_summary_writer]
+                           if summary_writer is not None]
+        for summary_writer in summary_writers:
+            summary_writer.close()
+    step_end_times = experiment.step_end_times
+    timed_seconds = step_end_times[-1] - step_end_times[0]
+    phase_seconds_per_step = {}
+    for summary_writer in summary_writers:
+        for name, value in summary_writer.latest_scalars.items():
+            if name.startswith('Time/'):
+                phase_seconds_per_step[name[len('Time/'):]] = float(value)
+    return {'status': 'Completed',
+            'experiment': benchmark.class_name,
+            'batch_size': settings.batch_size,
+            'steps': steps,
+            'steps_per_second': steps / timed_seconds,
+            'examples_per_second': steps * settings.batch_size / timed_seconds,
+            'setup_and_warm_up_seconds': total_time - timed_seconds,
+            'phase_seconds_per_step': phase_seconds_per_step,
+            'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+
+def synthetic_data_experiment_class(experiment_class, benchmark):
+    """
+    Creates a subclass of the experiment which trains on random tensors of the benchmark's shapes, skips the
+    validation summaries, and records the end time of each step.
+
+    :param experiment_class: The experiment class to benchmark.
+    :type experiment_class: type
+    :param benchmark: The benchmark, with the shapes of the data.
+    :type benchmark: Benchmark
+    :return: The benchmark experiment class.
+    :rtype: type
+    """
+    class SyntheticDataExperiment(experiment_class):
+        """The experiment, trained on synthetic data."""
+        def __init__(self, settings):
+            super().__init__(settings)
+            self.step_end_times = []
+
+        def dataset_setup(self):
+            """Sets up random datasets of two batches each, or the experiment's own datasets."""
+            if benchmark.example_shape is None:
+                super().dataset_setup()
+                return
+            settings = self.settings
+            self.train_dataset = synthetic_dataset(2 * settings.batch_size, benchmark.example_shape,
+                                                   benchmark.label_shapes, seed=0)
+            self.unlabeled_dataset = synthetic_dataset(2 * settings.batch_size, benchmark.example_shape,
+                                                       benchmark.label_shapes, seed=1)
+            self.validation_dataset = self.train_dataset
+            self.train_dataset_loader = DataLoader(self.train_dataset, batch_size=settings.batch_size, shuffle=True,
+                                                   pin_memory=settings.pin_memory, drop_last=True)
+            self.unlabeled_dataset_loader = DataLoader(self.unlabeled_dataset, batch_size=settings.batch_size,
+                                                       shuffle=True, pin_memory=settings.pin_memory, drop_last=True)
+
+        def validation_summaries(self, step):
+            """Skipped, as only training is benchmarked."""
+            pass
+
+        def handle_user_input(self, step):
+            """Handles the user input, then records the end of the step."""
+            super().handle_user_input(step)
+            self.step_end_times.append(time.perf_counter())
+
+    return SyntheticDataExperiment
+
+
+def synthetic_dataset(size, example_shape, label_shapes, seed):
+    """
+    Creates a dataset of uniformly random examples (in -1 to 1, as the normalized images) and labels (in 0 to 1).
+
+    :param size: The number of examples.
+    :type size: int
+    :param example_shape: The shape of each example.
+    :type example_shape: tuple[int]
+    :param label_shapes: The shape of each label of an example.
+    :type label_shapes: list[tuple[int]]
+    :param seed: The seed of the random values.
+    :type seed: int
+    :return: The dataset.
+    :rtype: TensorDataset
+    """
+    generator = torch.Generator().manual_seed(seed)
+    examples = torch.rand((size, *example_shape), generator=generator) * 2 - 1
+    labels = [torch.rand((size, *label_shape), generator=generator) for label_shape in label_shapes]
+    return TensorDataset(examples, *labels)
+
+
+def machine_metadata():
+    """
+    Describes the machine and code the benchmarks ran on.
+
+    :return: The metadata.
+    :rtype: dict
+    """
+    processor = platform.processor()
+    if os.path.exists('/proc/cpuinfo'):
+        with open('/proc/cpuinfo') as cpu_info_file:
+            for line in cpu_info_file:
+                if line.startswith('model name'):
+                    processor = line.split(':', 1)[1].strip()
+                    break
+    try:
+        git_commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                    check=True).stdout.strip()
+        git_dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                        capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        git_commit, git_dirty = None, None
+    return {'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'host': platform.node(),
+            'platform': platform.platform(),
+            'processor': processor,
+            'cpu_count': os.cpu_count(),
+            'available_cpu_count': len(os.sched_getaffinity(0)),
+            'torch_threads': torch.get_num_threads(),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'cuda': torch.version.cuda if torch.cuda.is_available() else None,
+            'git_commit': git_commit,
+            'git_dirty': git_dirty}
+
+
+def summary_line(name, result):
+    """Creates a line of text summarizing a benchmark's result."""
+    if result['status'] != 'Completed':
+        return f'{name}: {result["status"]}\n{result.get("error", "")}'
+    return (f'{name}: {result["steps_per_second"]:.3g} steps/s, {result["examples_per_second"]:.4g} examples/s, '
+            f'peak RSS {result["peak_rss_bytes"] / 2 ** 20:.0f} MB')
+
+
+if __name__ == '__main__':
+    run_benchmarks()
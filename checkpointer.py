@@ -0,0 +1,245 @@
+"""
+Code to write model checkpoints in the background.
+"""
+import json
+import os
+import re
+import threading
+import zipfile
+
+import torch
+
+manifest_file_name = 'checkpoints.json'
+
+
+class CheckpointWriter:
+    """
+    Writes model checkpoints on a background thread. Each checkpoint is first written to the temporary directory and
+    then atomically renamed to `model_{step}.pth` in the trial directory, so an interrupted save never leaves a
+    partial checkpoint to be loaded. At most one save is outstanding; a new save waits for the previous one to finish.
+    If `checkpoints_to_keep` is set, only that many of the latest checkpoints are kept, plus the checkpoint with the
+    lowest score, plus the checkpoints whose scores are still pending (e.g. from a background evaluation). After each
+    save, a manifest of the checkpoints in the trial directory (their steps, scores, the steps the scores were written
+    at, and entry sizes) is written alongside them.
+    """
+    def __init__(self, trial_directory, temporary_directory, checkpoints_to_keep=None):
+        self.trial_directory = trial_directory
+        self.temporary_directory = temporary_directory
+        self.checkpoints_to_keep = checkpoints_to_keep
+        self.thread: threading.Thread = None
+        self.error: BaseException = None
+        self.best_step = None
+        self.best_score = None
+        self.pending_score_steps = {}  # The step each unscored checkpoint awaits the score of, by checkpoint step.
+        for record in read_manifest(trial_directory):
+            if record['score'] is not None and (self.best_score is None or record['score'] < self.best_score):
+                self.best_step = record['step']
+                self.best_score = record['score']
+
+    def save(self, model, step, score=None, score_step=None, score_pending=False):
+        """
+        Snapshots the model to the CPU and starts writing it in the background.
+
+        :param model: The dictionary of state dicts (and other values) to save.
+        :type model: dict
+        :param step: The step of the checkpoint.
+        :type step: int
+        :param score: The score of the checkpoint, lower being better. None if unscored.
+        :type score: float
+        :param score_step: The step the score was written at, or is pending for.
+        :type score_step: int
+        :param score_pending: Whether the score will be given later, by `add_score` for the score step.
+        :type score_pending: bool
+        """
+        self.wait()
+        if score_pending:
+            self.pending_score_steps[step] = score_step
+        snapshot = cpu_copy(model)
+        self.thread = threading.Thread(target=self.write, args=(snapshot, step, score, score_step), daemon=True)
+        self.thread.start()
+
+    def add_score(self, pending_score_step, score, score_step):
+        """
+        Scores the checkpoints which were pending the score of a step, then removes the checkpoints no longer kept.
+
+        :param pending_score_step: The step the checkpoints were pending the score of.
+        :type pending_score_step: int
+        :param score: The score of the checkpoints, lower being better. None if unscored.
+        :type score: float
+        :param score_step: The step the score was written at.
+        :type score_step: int
+        """
+        self.wait()
+        steps = [step for step, pending_step in self.pending_score_steps.items() if pending_step == pending_score_step]
+        if not steps:
+            return
+        for step in steps:
+            del self.pending_score_steps[step]
+            if score is not None and (self.best_score is None or score < self.best_score):
+                self.best_step = step
+                self.best_score = score
+        self.remove_old_checkpoints()
+        records = read_manifest(self.trial_directory)
+        for record in records:
+            if record['step'] in steps:
+                record['score'] = None if score is None else float(score)
+                record['score_step'] = score_step
+        self.write_manifest_records(records)
+
+    def wait(self):
+        """Waits for the outstanding save (if any) to finish, raising any error from it."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    def close(self):
+        """Waits for the outstanding save to finish."""
+        self.wait()
+
+    def write(self, snapshot, step, score, score_step):
+        """Writes a checkpoint and removes the checkpoints which are no longer kept."""
+        try:
+            file_name = f'model_{step}.pth'
+            temporary_path = os.path.join(self.temporary_directory, file_name)
+            with open(temporary_path, 'wb') as temporary_file:
+                torch.save(snapshot, temporary_file)
+                temporary_file.flush()
+                os.fsync(temporary_file.fileno())
+            os.replace(temporary_path, os.path.join(self.trial_directory, file_name))
+            if score is not None and (self.best_score is None or score < self.best_score):
+                self.best_step = step
+                self.best_score = score
+            self.remove_old_checkpoints()
+            self.write_manifest(snapshot, step, score, score_step)
+        except BaseException as error:
+            self.error = error
+
+    def remove_old_checkpoints(self):
+        """Removes all but the latest `checkpoints_to_keep` checkpoints, the best, and those with pending scores."""
+        if self.checkpoints_to_keep is None:
+            return
+        steps = []
+        for file_name in os.listdir(self.trial_directory):
+            match = re.fullmatch(r'model_(\d+)\.pth', file_name)
+            if match:
+                steps.append(int(match.group(1)))
+        steps.sort()
+        kept_steps = set(steps[-self.checkpoints_to_keep:]) if self.checkpoints_to_keep > 0 else set()
+        for step in steps:
+            if step not in kept_steps and step != self.best_step and step not in self.pending_score_steps:
+                os.remove(os.path.join(self.trial_directory, f'model_{step}.pth'))
+
+    def write_manifest(self, snapshot, step, score, score_step):
+        """Adds a checkpoint to the manifest."""
+        records = [record for record in read_manifest(self.trial_directory) if record['step'] != step]
+        entries = {}
+        for name, value in snapshot.items():
+            tensors = list(nested_tensors(value))
+            entries[name] = {'tensors': len(tensors),
+                             'bytes': sum(tensor.numel() * tensor.element_size() for tensor in tensors)}
+        records.append({'file_name': f'model_{step}.pth', 'step': step,
+                        'score': None if score is None else float(score), 'score_step': score_step,
+                        'entries': entries})
+        self.write_manifest_records(records)
+
+    def write_manifest_records(self, records):
+        """Writes the manifest of the checkpoint records, dropping the checkpoints which have been removed."""
+        records = [record for record in records if os.path.exists(os.path.join(self.trial_directory,
+                                                                               record['file_name']))]
+        records.sort(key=lambda record: record['step'])
+        temporary_path = os.path.join(self.temporary_directory, manifest_file_name)
+        with open(temporary_path, 'w') as temporary_file:
+            json.dump({'checkpoints': records, 'best_step': self.best_step}, temporary_file, indent=1)
+        os.replace(temporary_path, os.path.join(self.trial_directory, manifest_file_name))
+
+
+def read_manifest(directory):
+    """
+    Reads the checkpoint records of a directory's manifest.
+
+    :param directory: The directory of the checkpoints.
+    :type directory: str
+    :return: The checkpoint records ordered by step, or an empty list if there is no manifest.
+    :rtype: list[dict]
+    """
+    manifest_path = os.path.join(directory, manifest_file_name)
+    if not os.path.exists(manifest_path):
+        return []
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)['checkpoints']
+
+
+def latest_checkpoint_file_name(directory):
+    """
+    Finds the latest checkpoint in the manifest of a directory whose file still exists.
+
+    :param directory: The directory of the checkpoints.
+    :type directory: str
+    :return: The file name of the checkpoint, or None if the manifest has none.
+    :rtype: str
+    """
+    for record in reversed(read_manifest(directory)):
+        if os.path.exists(os.path.join(directory, record['file_name'])):
+            return record['file_name']
+    return None
+
+
+def load_checkpoint_entries(path, entry_names):
+    """
+    Loads only the given entries of a checkpoint. The checkpoint file is memory-mapped, so the tensors of the other
+    entries are never read, and the loaded tensors are only read when copied (e.g. by `load_state_dict` into a network
+    already on its device).
+
+    :param path: The path of the checkpoint.
+    :type path: str
+    :param entry_names: The names of the entries to load (e.g. `['D', 'd_optimizer']`).
+    :type entry_names: list[str]
+    :return: The loaded entries which exist in the checkpoint.
+    :rtype: dict
+    """
+    if zipfile.is_zipfile(path):
+        checkpoint = torch.load(path, map_location='cpu', mmap=True)
+    else:  # Checkpoints in the legacy serialization format cannot be memory-mapped.
+        checkpoint = torch.load(path, map_location='cpu')
+    return {name: checkpoint[name] for name in entry_names if name in checkpoint}
+
+
+def nested_tensors(value):
+    """
+    Finds the tensors of a nested structure of dicts, lists, and tuples.
+
+    :param value: The structure to search.
+    :type value: object
+    :return: The tensors of the structure.
+    :rtype: collections.abc.Iterator[torch.Tensor]
+    """
+    if isinstance(value, torch.Tensor):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from nested_tensors(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from nested_tensors(item)
+
+
+def cpu_copy(value):
+    """
+    Copies the tensors of a nested structure of dicts, lists, and tuples to the CPU.
+
+    :param value: The structure to copy.
+    :type value: object
+    :return: The structure with CPU copies of the tensors.
+    :rtype: object
+    """
+    if isinstance(value, torch.Tensor):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        return {key: cpu_copy(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(cpu_copy(item) for item in value)
+    return value
@@ -3,9 +3,9 @@ Code for the polynomial coefficient data generating models.
 """
 
 import numpy as np
-from scipy.stats import uniform
+from torch.distributions import Uniform
 from torch.utils.data import Dataset
-from utility import MixtureModel, seed_all
+from utility import TorchMixtureModel, seed_all
 
 irrelevant_data_multiplier = 5
 
@@ -39,23 +39,23 @@ def generate_polynomial_examples(number_of_examples, number_of_observations):
 
 def generate_single_a3_double_a2_a4_coefficients(number_of_examples):
     """Generates coefficients with a single uniform distribution for a3 and double for a2 and a4."""
-    a2_distribution = MixtureModel([uniform(-2, 1), uniform(1, 1)])
-    a2 = a2_distribution.rvs(size=[number_of_examples, irrelevant_data_multiplier, 1]).astype(dtype=np.float32)
-    a3_distribution = MixtureModel([uniform(loc=-1, scale=2)])
-    a3 = a3_distribution.rvs(size=[number_of_examples, irrelevant_data_multiplier, 1]).astype(dtype=np.float32)
-    a4_distribution = MixtureModel([uniform(-2, 1), uniform(1, 1)])
-    a4 = a4_distribution.rvs(size=[number_of_examples, irrelevant_data_multiplier, 1]).astype(dtype=np.float32)
+    a2_distribution = TorchMixtureModel([Uniform(-2., -1.), Uniform(1., 2.)], device='cpu')
+    a2 = a2_distribution.rvs([number_of_examples, irrelevant_data_multiplier, 1]).numpy()
+    a3_distribution = TorchMixtureModel([Uniform(-1., 1.)], device='cpu')
+    a3 = a3_distribution.rvs([number_of_examples, irrelevant_data_multiplier, 1]).numpy()
+    a4_distribution = TorchMixtureModel([Uniform(-2., -1.), Uniform(1., 2.)], device='cpu')
+    a4 = a4_distribution.rvs([number_of_examples, irrelevant_data_multiplier, 1]).numpy()
     return a2, a3, a4
 
 
 def generate_double_a2_a3_a4_coefficients(number_of_examples):
     """Generates coefficients with a double uniform distribution for a2, a3, and a4."""
-    a2_distribution = MixtureModel([uniform(-2, 1), uniform(1, 1)])
-    a2 = a2_distribution.rvs(size=[number_of_examples, irrelevant_data_multiplier, 1]).astype(dtype=np.float32)
-    a3_distribution = MixtureModel([uniform(-2, 1), uniform(1, 1)])
-    a3 = a3_distribution.rvs(size=[number_of_examples, irrelevant_data_multiplier, 1]).astype(dtype=np.float32)
-    a4_distribution = MixtureModel([uniform(-2, 1), uniform(1, 1)])
-    a4 = a4_distribution.rvs(size=[number_of_examples, irrelevant_data_multiplier, 1]).astype(dtype=np.float32)
+    a2_distribution = TorchMixtureModel([Uniform(-2., -1.), Uniform(1., 2.)], device='cpu')
+    a2 = a2_distribution.rvs([number_of_examples, irrelevant_data_multiplier, 1]).numpy()
+    a3_distribution = TorchMixtureModel([Uniform(-2., -1.), Uniform(1., 2.)], device='cpu')
+    a3 = a3_distribution.rvs([number_of_examples, irrelevant_data_multiplier, 1]).numpy()
+    a4_distribution = TorchMixtureModel([Uniform(-2., -1.), Uniform(1., 2.)], device='cpu')
+    a4 = a4_distribution.rvs([number_of_examples, irrelevant_data_multiplier, 1]).numpy()
     return a2, a3, a4
 
 
@@ -3,7 +3,7 @@ Code for the coefficient application.
 """
 import numpy as np
 import torch
-from scipy.stats import norm, wasserstein_distance
+from scipy.stats import wasserstein_distance
 from torch.utils.data import DataLoader
 from recordclass import RecordClass
 
@@ -11,7 +11,7 @@ from srgan import Experiment
 from coefficient.data import ToyDataset
 from coefficient.models import Generator, MLP, observation_count
 from coefficient.presentation import generate_display_frame
-from utility import gpu, MixtureModel, standard_image_format_to_tensorboard_image_format
+from utility import gpu, standard_image_format_to_tensorboard_image_format
 
 
 class CoefficientExperiment(Experiment):
@@ -37,6 +37,19 @@ class CoefficientExperiment(Experiment):
         self.D = MLP(self.settings.hidden_size)
         self.G = Generator(self.settings.hidden_size)
 
+    def compile_networks(self):
+        """
+        Compiles the networks and, as Python overhead dominates the small MLPs, the training loss calculations too.
+        """
+        super().compile_networks()
+        loss_calculation_networks = {'dnn_loss_calculation': 'DNN', 'labeled_loss_calculation': 'D',
+                                     'unlabeled_loss_calculation': 'D', 'fake_loss_calculation': 'D',
+                                     'generator_loss_calculation': 'D'}
+        for loss_calculation_name, network_name in loss_calculation_networks.items():
+            mode = self.compile_mode_for(network_name)
+            if mode is not None:
+                setattr(self, loss_calculation_name, torch.compile(getattr(self, loss_calculation_name), mode=mode))
+
     def validation_summaries(self, step):
         """Prepares the summaries that should be run for the given application."""
         settings = self.settings
@@ -53,8 +66,7 @@ class CoefficientExperiment(Experiment):
         gan_train_values = self.evaluation_epoch(D, train_dataset, gan_summary_writer, '2 Train Error')
         gan_validation_values = self.evaluation_epoch(D, validation_dataset, gan_summary_writer, '1 Validation Error',
                               comparison_values=dnn_validation_values)
-        z = torch.tensor(MixtureModel([norm(-settings.mean_offset, 1), norm(settings.mean_offset, 1)]).rvs(
-            size=[settings.batch_size, G.input_size]).astype(np.float32)).to(gpu)
+        z = self.generator_input_distribution.rvs([settings.batch_size, G.input_size])
         fake_examples = G(z, add_noise=False)
         fake_examples_array = fake_examples.to('cpu').detach().numpy()
         fake_predicted_labels = D(fake_examples)
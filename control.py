@@ -0,0 +1,182 @@
+"""
+Code to control a running experiment and read its live metrics from outside the training loop.
+"""
+import collections
+import os
+import queue
+import resource
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+command_names = ['save', 'quit', 'pause', 'resume', 'summary']
+stdin_command_queue = queue.SimpleQueue()
+stdin_thread: threading.Thread = None
+
+
+class TrainingController:
+    """
+    Queues commands for a running experiment, which the training loop applies between steps. Commands come from a
+    localhost HTTP endpoint on `settings.control_port` (e.g. `curl -X POST localhost:8000/save`), and from lines
+    typed on an interactive stdin, each read on a background thread so the training loop never polls for them. The
+    endpoint also serves live metrics in the Prometheus text format at `/metrics`.
+    """
+    def __init__(self, experiment, data_generators=()):
+        self.experiment = experiment
+        self.data_generators = list(data_generators)
+        self.commands = queue.SimpleQueue()
+        self.paused = False
+        self.step = None
+        self.step_times = collections.deque(maxlen=100)
+        self.start_time = time.perf_counter()
+        self.previous_scrape = None
+        self.server = None
+        if experiment.settings.control_port is not None:
+            self.server = ThreadingHTTPServer(('127.0.0.1', experiment.settings.control_port), ControlRequestHandler)
+            self.server.daemon_threads = True
+            self.server.controller = self
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            print(f'\rControl endpoint at http://127.0.0.1:{self.server.server_port}/')
+        start_stdin_thread()
+
+    def step_completed(self, step):
+        """
+        Records a completed training step for the metrics.
+
+        :param step: The step which was completed.
+        :type step: int
+        """
+        self.step = step
+        self.step_times.append(time.perf_counter())
+
+    def next_command(self):
+        """
+        Takes the next queued command. While paused, waits for one.
+
+        :return: The command name, or None if none is queued (and not paused).
+        :rtype: str
+        """
+        while True:
+            for command_queue in [self.commands, stdin_command_queue]:
+                try:
+                    return command_queue.get_nowait()
+                except queue.Empty:
+                    pass
+            if not self.paused:
+                return None
+            time.sleep(0.1)
+
+    def metrics(self):
+        """
+        Creates the text of the live metrics.
+
+        :return: The metrics in the Prometheus text format.
+        :rtype: str
+        """
+        now = time.perf_counter()
+        step_times = list(self.step_times)
+        steps_per_second = 0.0
+        if len(step_times) > 1 and step_times[-1] > step_times[0]:
+            steps_per_second = (len(step_times) - 1) / (step_times[-1] - step_times[0])
+        data_wait_time = sum(generator.total_wait_time for generator in self.data_generators)
+        previous_time, previous_data_wait_time = self.previous_scrape or (self.start_time, 0.0)
+        self.previous_scrape = (now, data_wait_time)
+        data_wait_fraction = (data_wait_time - previous_data_wait_time) / max(now - previous_time, 1e-9)
+        lines = []
+        add_metric(lines, 'srgan_step', 'gauge', 'The latest completed training step.',
+                   -1 if self.step is None else self.step)
+        add_metric(lines, 'srgan_steps_per_second', 'gauge', 'Training steps per second, over the last 100 steps.',
+                   steps_per_second)
+        add_metric(lines, 'srgan_paused', 'gauge', 'Whether training is paused.', int(self.paused))
+        add_metric(lines, 'srgan_data_wait_seconds_total', 'counter', 'Seconds the training loop waited for data.',
+                   data_wait_time)
+        add_metric(lines, 'srgan_data_wait_fraction', 'gauge',
+                   'Fraction of the time since the previous scrape spent waiting for data.', data_wait_fraction)
+        add_metric(lines, 'srgan_resident_memory_bytes', 'gauge', 'Resident memory of the training process.',
+                   resident_memory_bytes())
+        lines.append('# HELP srgan_summary The latest value of each summary scalar (e.g. the losses).')
+        lines.append('# TYPE srgan_summary gauge')
+        for writer_name in ['dnn_summary_writer', 'gan_summary_writer']:
+            summary_writer = getattr(self.experiment, writer_name)
+            if summary_writer is None:
+                continue
+            network = 'DNN' if writer_name == 'dnn_summary_writer' else 'GAN'
+            for name, value in summary_writer.latest_scalars.copy().items():
+                name = name.replace('\\', '\\\\').replace('"', '\\"')
+                lines.append(f'srgan_summary{{writer="{network}",name="{name}"}} {float(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        """Stops the HTTP endpoint."""
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class ControlRequestHandler(BaseHTTPRequestHandler):
+    """Handles the requests of the control endpoint."""
+    def do_GET(self):
+        """Serves the metrics, or queues a command."""
+        path = self.path.strip('/')
+        if path == 'metrics':
+            self.respond(200, self.server.controller.metrics())
+        else:
+            self.do_POST()
+
+    def do_POST(self):
+        """Queues a command."""
+        command = self.path.strip('/')
+        if command not in command_names:
+            self.respond(404, f'Unknown command `{command}`. Use one of {command_names} or `metrics`.\n')
+            return
+        self.server.controller.commands.put(command)
+        self.respond(200, f'Queued {command}.\n')
+
+    def respond(self, status, text):
+        """Sends a text response."""
+        body = text.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format_, *args):
+        """Keeps requests out of the training output."""
+        pass
+
+
+def start_stdin_thread():
+    """Starts the thread reading commands from stdin, once per process, if stdin is an interactive terminal."""
+    global stdin_thread
+    if stdin_thread is not None or sys.stdin is None or not sys.stdin.isatty():
+        return
+    stdin_thread = threading.Thread(target=read_stdin_commands, daemon=True)
+    stdin_thread.start()
+
+
+def read_stdin_commands():
+    """Queues the commands named in each line of stdin, until stdin is closed."""
+    for line in sys.stdin:
+        for command in command_names:
+            if command in line:
+                stdin_command_queue.put(command)
+
+
+def add_metric(lines, name, type_, help_text, value):
+    """Adds a metric in the Prometheus text format to the lines."""
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} {type_}')
+    lines.append(f'{name} {float(value)}')
+
+
+def resident_memory_bytes():
+    """The resident memory of the process, or its peak if the current value is unavailable."""
+    try:
+        with open('/proc/self/statm') as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
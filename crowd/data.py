@@ -1,13 +1,19 @@
 """
 Code for the crowd data dataset.
 """
+import copy
+import os
 import random
+from collections import OrderedDict
 from enum import Enum
 import scipy.misc
 import torch
 import numpy as np
 import torchvision
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler, get_worker_info
+from torch.utils.data.dataloader import default_collate
+
+from crowd.database_preprocessor import load_image_shapes
 
 
 class CrowdDataset(Enum):
@@ -101,7 +107,7 @@ class RandomHorizontalFlip:
         :return: The possibly flipped crowd example in Numpy.
         :rtype: CrowdExample
         """
-        if random.choice([True, False]):
+        if self.should_flip():
             example.image = np.flip(example.image, axis=1).copy()
             example.label = np.flip(example.label, axis=1).copy()
             example.map = np.flip(example.map, axis=1).copy()
@@ -111,6 +117,11 @@ class RandomHorizontalFlip:
                 example.perspective = np.flip(example.perspective, axis=1).copy()
         return example
 
+    @staticmethod
+    def should_flip():
+        """Randomly decides whether to flip an example."""
+        return random.choice([True, False])
+
 
 class NegativeOneToOneNormalizeImage:
     """
@@ -369,10 +380,11 @@ class ExtractPatchForPositionNoPerspectiveRescale(PatchAndRescale):
 
 class ExtractPatch:
     """A transform to extract a patch from an example."""
-    def __init__(self, image_patch_size=128, label_patch_size=32, allow_padded=False):
+    def __init__(self, image_patch_size=128, label_patch_size=32, allow_padded=False, map_divisor=None):
         self.allow_padded = allow_padded
         self.image_patch_size = image_patch_size
         self.label_patch_size = label_patch_size
+        self.map_divisor = map_divisor  # Divides the map patches (rather than the full, memory mapped, maps).
 
     def get_patch_for_position(self, example, y, x):
         """
@@ -413,6 +425,8 @@ class ExtractPatch:
         if example.map is not None:
             map_patch = example.map[y - half_patch_size:y + half_patch_size,
                                     x - half_patch_size:x + half_patch_size]
+            if self.map_divisor is not None:
+                map_patch = map_patch / self.map_divisor
         else:
             map_patch = None
         if example.perspective is not None:
@@ -558,3 +572,369 @@ class ImageSlidingWindowDataset(Dataset):
 
     def __len__(self):
         return self.length
+
+
+class MemoryMapCache:
+    """
+    A least recently used cache of read-only memory maps of NumPy files, so a file sampled repeatedly is opened (and
+    its header parsed) only once. Each process keeps its own maps and counters (e.g. one cache per data loader
+    worker), as a copy of the cache in another process starts empty.
+    """
+    def __init__(self, size=48):
+        self.size = size
+        self.memory_maps = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.process_id = os.getpid()
+
+    def load(self, path):
+        """
+        Gives the memory map of a file, opening it if it is not cached.
+
+        :param path: The path of the `.npy` file.
+        :type path: str
+        :return: The read-only memory map of the array.
+        :rtype: np.memmap
+        """
+        if self.process_id != os.getpid():
+            self.clear()
+        memory_map = self.memory_maps.get(path)
+        if memory_map is not None:
+            self.memory_maps.move_to_end(path)
+            self.hits += 1
+            return memory_map
+        self.misses += 1
+        memory_map = np.load(path, mmap_mode='r')
+        if self.size > 0:
+            self.memory_maps[path] = memory_map
+            if len(self.memory_maps) > self.size:
+                self.memory_maps.popitem(last=False)
+        return memory_map
+
+    def clear(self):
+        """Drops the cached memory maps (which close once no patch references them) and resets the counters."""
+        self.__init__(self.size)
+
+    def __getstate__(self):
+        return {'size': self.size}
+
+    def __setstate__(self, state):
+        self.__init__(state['size'])
+
+
+class PatchBatch(list):
+    """
+    A batch of patch examples, each a tuple of views of the batch's image, label, and map tensors, which are kept so
+    the batch can be collated without copying.
+    """
+    def __init__(self, images, labels, maps):
+        super().__init__(zip(images, labels, maps))
+        self.tensors = (images, labels, maps)
+
+
+def collate_patch_batch(batch):
+    """
+    Collates a batch of examples, passing the tensors of a `PatchBatch` through as they are.
+
+    :param batch: The examples.
+    :type batch: list | PatchBatch
+    :return: The batch tensors.
+    :rtype: (torch.Tensor, torch.Tensor, torch.Tensor)
+    """
+    if isinstance(batch, PatchBatch):
+        return batch.tensors
+    return default_collate(batch)
+
+
+def batched_extraction_supported(middle_transform, image_patch_size, label_patch_size):
+    """Whether `extract_patch_batch` gives the same patches as the example transforms would."""
+    return ((middle_transform is None or isinstance(middle_transform, RandomHorizontalFlip)) and
+            image_patch_size == label_patch_size)
+
+
+def extract_patch_batch(patches, patch_size, pin_memory=False, map_divisor=None):
+    """
+    Extracts a batch of patches straight into the batch tensors, giving the same values as extracting each with
+    `ExtractPatchForPosition` (with padding allowed), flipping with `RandomHorizontalFlip`, and preprocessing with
+    `NegativeOneToOneNormalizeImage` and `NumpyArraysToTorchTensors`. Only the part of a patch outside its image is
+    padded, rather than the whole image.
+
+    :param patches: The HWC image, label, map, patch center y and x, and whether to flip, of each patch.
+    :type patches: list[(np.ndarray, np.ndarray, np.ndarray, int, int, bool)]
+    :param patch_size: The size of the image and label patches.
+    :type patch_size: int
+    :param pin_memory: Whether to allocate the batch in pinned memory (when loading in the main process with CUDA).
+    :type pin_memory: bool
+    :param map_divisor: Divides each map patch (in its own data type, as `ExtractPatch` does). None leaves them.
+    :type map_divisor: float
+    :return: The batch.
+    :rtype: PatchBatch
+    """
+    half_patch_size = int(patch_size // 2)
+    size = 2 * half_patch_size
+    pin_memory = pin_memory and torch.cuda.is_available() and get_worker_info() is None
+    images = torch.empty((len(patches), 3, size, size), dtype=torch.float32, pin_memory=pin_memory)
+    labels = torch.empty((len(patches), size, size), dtype=torch.float32, pin_memory=pin_memory)
+    maps = torch.empty((len(patches), size, size), dtype=torch.float32, pin_memory=pin_memory)
+    images_array, labels_array, maps_array = images.numpy(), labels.numpy(), maps.numpy()
+    for index, (image, label, map_, y, x, flip) in enumerate(patches):
+        source_y_start, source_y_end = max(0, y - half_patch_size), min(image.shape[0], y + half_patch_size)
+        source_x_start, source_x_end = max(0, x - half_patch_size), min(image.shape[1], x + half_patch_size)
+        y_start = source_y_start - (y - half_patch_size)
+        y_end = y_start + source_y_end - source_y_start
+        x_start = source_x_start - (x - half_patch_size)
+        x_end = x_start + source_x_end - source_x_start
+        if (y_start, y_end, x_start, x_end) != (0, size, 0, size):
+            images_array[index] = 0
+            labels_array[index] = 0
+            maps_array[index] = 0
+        source_x_slice = slice(source_x_start, source_x_end)
+        if flip:
+            x_start, x_end = size - x_end, size - x_start
+            source_x_slice = slice(source_x_end - 1, source_x_start - 1 if source_x_start > 0 else None, -1)
+        images_array[index, :, y_start:y_end, x_start:x_end] = image[source_y_start:source_y_end,
+                                                                     source_x_slice].transpose((2, 0, 1))
+        labels_array[index, y_start:y_end, x_start:x_end] = label[source_y_start:source_y_end, source_x_slice]
+        map_patch = map_[source_y_start:source_y_end, source_x_slice]
+        if map_divisor is not None:
+            map_patch = map_patch / map_divisor
+        maps_array[index, y_start:y_end, x_start:x_end] = map_patch
+    np.divide(images_array, 255 / 2, out=images_array)  # As in `NegativeOneToOneNormalizeImage`.
+    np.subtract(images_array, 1, out=images_array)
+    return PatchBatch(images, labels, maps)
+
+
+class CrowdPatchDataset(Dataset):
+    """
+    The base of the transformed crowd datasets, whose examples are patches of the full images (with their labels and
+    maps) of a dataset directory, in `.npy` files or packed shards. A patch is indexed either by an int, which is
+    ignored as a random patch of the whole dataset is chosen, or by an (image_id, y, x) tuple (e.g. from an
+    `ImageGroupedPatchSampler`), giving the patch centered at y and x of the image of the `image_id`th file name.
+    Subclasses choose the file names, then call `index_patch_positions`.
+    """
+    def __init__(self, dataset_directory, image_patch_size, label_patch_size, middle_transform, map_directory_name,
+                 memory_map_cache_size, storage, pin_memory, map_divisor=None):
+        # The packed storage module imports this one, so it is imported only here.
+        from crowd.packed_data import PackedShards
+        self.dataset_directory = dataset_directory
+        self.packed_shards = (PackedShards(self.dataset_directory, ['labels', map_directory_name])
+                              if storage == 'packed' else None)
+        self.file_names = []
+        self.image_patch_size = image_patch_size
+        self.label_patch_size = label_patch_size
+        self.middle_transform = middle_transform
+        self.map_divisor = map_divisor
+        self.extract_patch_transform = ExtractPatchForPosition(self.image_patch_size, self.label_patch_size,
+                                                               allow_padded=True,  # In case image is smaller.
+                                                               map_divisor=map_divisor)
+        self.preprocess_transform = torchvision.transforms.Compose([NegativeOneToOneNormalizeImage(),
+                                                                    NumpyArraysToTorchTensors()])
+        self.memory_map_cache = MemoryMapCache(memory_map_cache_size)
+        self.pin_memory = pin_memory
+        self.map_directory_name = map_directory_name
+        self.position_counts = None
+        self.start_indexes = None
+        self.length = 0
+
+    def index_patch_positions(self):
+        """Indexes the patch positions of the images of the chosen file names."""
+        if self.packed_shards is not None:
+            image_shapes = self.packed_shards.image_shapes
+        else:
+            image_shapes = load_image_shapes(self.dataset_directory, self.file_names)
+        self.position_counts = patch_position_counts([image_shapes[file_name] for file_name in self.file_names],
+                                                     self.image_patch_size)
+        self.start_indexes, self.length = patch_start_indexes(self.position_counts)
+
+    def __getitem__(self, index):
+        """
+        :param index: The index within the entire dataset (ignored, as a random patch is chosen), or the image id and
+            patch center y and x of the patch (e.g. from an `ImageGroupedPatchSampler`).
+        :type index: int | (int, int, int)
+        :return: An example and label from the crowd dataset.
+        :rtype: torch.Tensor, torch.Tensor
+        """
+        image_id, y, x = index if isinstance(index, tuple) else self.random_patch_position()
+        image, label, map_ = self.load_example(image_id)
+        example = CrowdExample(image=image, label=label, map_=map_)
+        example = self.extract_patch_transform(example, y, x)
+        if self.middle_transform:
+            example = self.middle_transform(example)
+        example = self.preprocess_transform(example)
+        self.postprocess_maps(example.map)
+        return example.image, example.label, example.map
+
+    def __getitems__(self, indexes):
+        """
+        Extracts a batch of patches at once. The patches are the same as those of `__getitem__` for each index in turn.
+
+        :param indexes: The indexes within the entire dataset, or patch image ids and centers (see `__getitem__`).
+        :type indexes: list[int] | list[(int, int, int)]
+        :return: The examples of the batch.
+        :rtype: PatchBatch | list[(torch.Tensor, torch.Tensor, torch.Tensor)]
+        """
+        if not batched_extraction_supported(self.middle_transform, self.image_patch_size, self.label_patch_size):
+            return [self[index] for index in indexes]
+        patches = []
+        for index in indexes:
+            image_id, y, x = index if isinstance(index, tuple) else self.random_patch_position()
+            image, label, map_ = self.load_example(image_id)
+            flip = self.middle_transform is not None and self.middle_transform.should_flip()
+            patches.append((image, label, map_, y, x, flip))
+        batch = extract_patch_batch(patches, self.image_patch_size, pin_memory=self.pin_memory,
+                                    map_divisor=self.map_divisor)
+        self.postprocess_maps(batch.tensors[2])
+        return batch
+
+    def random_patch_position(self):
+        """
+        Randomly chooses a patch from the entire dataset.
+
+        :return: The image id and patch center y and x.
+        :rtype: (int, int, int)
+        """
+        index_ = random.randrange(self.length)
+        image_id = int(np.searchsorted(self.start_indexes, index_, side='right') - 1)
+        y_index, x_index = np.unravel_index(index_ - self.start_indexes[image_id], self.position_counts[image_id])
+        half_patch_size = int(self.image_patch_size // 2)
+        return image_id, half_patch_size + int(y_index), half_patch_size + int(x_index)
+
+    def load_example(self, image_id):
+        """
+        Gives the (memory mapped) arrays of an example.
+
+        :param image_id: The index of the example's file name.
+        :type image_id: int
+        :return: The image, label, and map.
+        :rtype: (np.ndarray, np.ndarray, np.ndarray)
+        """
+        file_name = self.file_names[image_id]
+        if self.packed_shards is not None:
+            image, (label, map_) = self.packed_shards.load(file_name)
+        else:
+            image = self.memory_map_cache.load(os.path.join(self.dataset_directory, 'images', file_name))
+            label = self.memory_map_cache.load(os.path.join(self.dataset_directory, 'labels', file_name))
+            map_ = self.memory_map_cache.load(os.path.join(self.dataset_directory, self.map_directory_name,
+                                                          file_name))
+        return image, label, map_
+
+    def postprocess_maps(self, maps):
+        """
+        Adjusts the map tensor of a patch, or of a batch of patches, in place after preprocessing.
+
+        :param maps: The map tensor.
+        :type maps: torch.Tensor
+        """
+        pass
+
+    def __len__(self):
+        return self.length
+
+
+def patch_position_counts(image_shapes, image_patch_size):
+    """
+    The number of patch centers (for patches entirely within the image) along y and x of each image. The centers
+    along an axis start at half the patch size.
+
+    :param image_shapes: The shape of each image.
+    :type image_shapes: list[(int, int, int)]
+    :param image_patch_size: The size of the image patches.
+    :type image_patch_size: int
+    :return: The int32 table of y and x center counts, one row per image.
+    :rtype: np.ndarray
+    """
+    half_patch_size = int(image_patch_size // 2)
+    position_counts = np.zeros((len(image_shapes), 2), dtype=np.int32)
+    for image_id, image_shape in enumerate(image_shapes):
+        position_counts[image_id, 0] = len(range(half_patch_size, image_shape[0] - half_patch_size + 1))
+        position_counts[image_id, 1] = len(range(half_patch_size, image_shape[1] - half_patch_size + 1))
+    return position_counts
+
+
+def patch_start_indexes(position_counts):
+    """
+    The index within an entire patch dataset of each image's first patch, and the number of patches in the dataset.
+
+    :param position_counts: The int32 table of y and x center counts of each image.
+    :type position_counts: np.ndarray
+    :return: The start indexes, and the dataset length.
+    :rtype: (np.ndarray, int)
+    """
+    image_lengths = position_counts.astype(np.int64).prod(axis=1)
+    start_indexes = np.concatenate([[0], np.cumsum(image_lengths)[:-1]]).astype(np.int64)
+    return start_indexes, int(image_lengths.sum())
+
+
+class ImageGroupedPatchSampler(Sampler):
+    """
+    Samples the patches of a crowd transformed dataset grouped by image, drawing several patches from each image
+    visited, so consecutive patches share an image (and its label and map) in the page cache. Images are visited in
+    proportion to their number of patch positions, so each position is as likely as with the dataset's own random
+    sampling. Gives (image_id, y, x) indexes, which the datasets extract the patch for. The schedule is drawn in the
+    main process, so it does not depend on the data loader workers (whose flips are seeded per worker as usual).
+    """
+    def __init__(self, dataset, patches_per_image=16, patches_per_epoch=None, seed=None, visits_per_chunk=4096,
+                 generator=None):
+        self.position_counts = dataset.position_counts
+        self.half_patch_size = int(dataset.image_patch_size // 2)
+        self.patches_per_image = patches_per_image
+        self.patches_per_epoch = patches_per_epoch if patches_per_epoch is not None else len(dataset)
+        self.seed = seed
+        self.generator = generator  # Draws the seed of each epoch without a seed given (as `RandomSampler` does).
+        self.visits_per_chunk = visits_per_chunk  # Image visits drawn at a time, to bound the schedule's memory.
+        self.epoch = 0
+        self.rank = 0
+        image_lengths = self.position_counts.astype(np.float64).prod(axis=1)
+        self.image_probabilities = image_lengths / image_lengths.sum()
+
+    def __iter__(self):
+        if self.seed is None:
+            seed = [int(torch.empty((), dtype=torch.int64).random_(generator=self.generator).item())]
+        else:
+            seed = [self.seed, self.rank, self.epoch]
+        self.epoch += 1
+        random_generator = np.random.default_rng(seed)
+        patches_remaining = self.patches_per_epoch
+        while patches_remaining > 0:
+            visit_count = min(self.visits_per_chunk, -(-patches_remaining // self.patches_per_image))
+            schedule = self.schedule_chunk(random_generator, visit_count)[:patches_remaining]
+            patches_remaining -= len(schedule)
+            yield from map(tuple, schedule.tolist())
+
+    def schedule_chunk(self, random_generator, visit_count):
+        """
+        Draws the patches of a number of image visits.
+
+        :param random_generator: The generator to draw with.
+        :type random_generator: np.random.Generator
+        :param visit_count: The number of image visits.
+        :type visit_count: int
+        :return: The int32 table of image ids and patch center y and x, one row per patch, grouped by visit.
+        :rtype: np.ndarray
+        """
+        image_ids = random_generator.choice(len(self.position_counts), size=visit_count, p=self.image_probabilities)
+        image_ids = np.repeat(image_ids, self.patches_per_image)
+        schedule = np.empty((len(image_ids), 3), dtype=np.int32)
+        schedule[:, 0] = image_ids
+        schedule[:, 1:] = random_generator.integers(self.position_counts[image_ids], dtype=np.int32)
+        schedule[:, 1:] += self.half_patch_size
+        return schedule
+
+    def shard(self, rank, world_size):
+        """
+        Gives a sampler for a data-parallel rank's share of the epoch. The ranks draw distinct schedules.
+
+        :param rank: The rank of the process.
+        :type rank: int
+        :param world_size: The number of processes.
+        :type world_size: int
+        :return: The rank's sampler.
+        :rtype: ImageGroupedPatchSampler
+        """
+        sampler = copy.copy(self)
+        sampler.patches_per_epoch = -(-self.patches_per_epoch // world_size)
+        sampler.rank = rank
+        return sampler
+
+    def __len__(self):
+        return self.patches_per_epoch
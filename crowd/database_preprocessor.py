@@ -1,4 +1,5 @@
 """Code for downloading and preprocessing the datasets."""
+import json
 import os
 import shutil
 import zipfile
@@ -10,6 +11,13 @@ from sklearn.neighbors import NearestNeighbors
 from utility import clean_scientific_notation
 
 
+density_kernel_betas = [0.05, 0.1, 0.3, 0.5]  # The spreads of the density labels, relative to the neighbor distances.
+iknn_map_neighbor_counts = [1, 2, 3, 4, 5]  # The k of each inverse kNN map.
+iknn_map_epsilon = 1
+manifest_file_name = 'manifest.json'  # Lists the examples of a dataset directory, with their image shapes.
+database_root = None  # The directory of the databases (e.g. fabricated ones). None for the default location.
+
+
 class DatabasePreprocessor(ABC):
     """A class for downloading and preprocessing the datasets"""
     def __init__(self):
@@ -18,10 +26,13 @@ class DatabasePreprocessor(ABC):
         self.database_archived_directory_name: str = None
         self.total_head_count = 0
         self.total_images = 0
+        self.manifests = {}  # Dataset directory to the manifest of its examples.
 
     @property
     def database_directory(self):
         """The location of the database directory."""
+        if database_root is not None:
+            return os.path.join(database_root, self.database_name)
         if os.path.basename(os.path.normpath(os.path.abspath('..'))) == 'srgan':
             return '../../{}'.format(self.database_name)
         else:
@@ -32,6 +43,7 @@ class DatabasePreprocessor(ABC):
         print(f'Preparing {self.database_name} database.')
         self.download()
         self.preprocess()
+        self.write_manifests()
         self.print_statistics()
 
     def download(self):
@@ -70,40 +82,110 @@ class DatabasePreprocessor(ABC):
         self.total_head_count += np.sum(density_map)
         self.total_images += 1
         # Images as numpy.
-        images_directory = os.path.join(dataset_directory, 'images', f'{file_name}.npy')
+        images_directory = os.path.join(dataset_directory, 'images')
         os.makedirs(images_directory, exist_ok=True)
         np.save(os.path.join(images_directory, f'{file_name}.npy'), image)
+        self.add_manifest_entry(dataset_directory, file_name, int(np.sum(density_map)))
         # Point labels.
-        labels_directory = os.path.join(dataset_directory, 'labels', f'{file_name}.npy')
+        labels_directory = os.path.join(dataset_directory, 'labels')
         os.makedirs(labels_directory, exist_ok=True)
         np.save(os.path.join(labels_directory, f'{file_name}.npy'), density_map.astype(np.float16))
         # Density labels.
-        density_kernel_betas = [0.05, 0.1, 0.3, 0.5]
         for beta in density_kernel_betas:
-            density_directory_name = clean_scientific_notation('density{:e}'.format(beta))
-            density_directory = os.path.join(dataset_directory, density_directory_name)
+            density_directory = os.path.join(dataset_directory, density_directory_name(beta))
             os.makedirs(density_directory, exist_ok=True)
             density_path = os.path.join(density_directory, f'{file_name}.npy')
             density_map = generate_density_label(head_positions, label_size, perspective_resizing=True,
                                                  yx_order=True, neighbor_deviation_beta=beta)
             np.save(density_path, density_map.astype(np.float16))
         # ikNN labels.
-        k_list = [1, 2, 3, 4, 5]
-        epsilon = 1
-        for k in k_list:
+        for k in iknn_map_neighbor_counts:
             iknn_maps_directory = os.path.join(dataset_directory, f'i{k}nn_maps')
             os.makedirs(iknn_maps_directory, exist_ok=True)
             iknn_map_path = os.path.join(iknn_maps_directory, f'{file_name}.npy')
             knn_map = generate_knn_map(head_positions, label_size, number_of_neighbors=k)
-            iknn_map = 1 / (knn_map + epsilon)
+            iknn_map = 1 / (knn_map + iknn_map_epsilon)
             np.save(iknn_map_path, iknn_map.astype(np.float16))
 
+    def add_manifest_entry(self, dataset_directory, file_name, head_count):
+        """
+        Adds a saved example to the manifest of its dataset directory.
+
+        :param dataset_directory: The dataset directory the example was saved in.
+        :type dataset_directory: str
+        :param file_name: The file name of the example (without extension).
+        :type file_name: str
+        :param head_count: The head count of the example.
+        :type head_count: int
+        """
+        shape, _, data_offset = read_npy_header(os.path.join(dataset_directory, 'images', f'{file_name}.npy'))
+        manifest = self.manifests.setdefault(dataset_directory, {'file_names': [], 'image_shapes': [],
+                                                                 'head_counts': [], 'image_data_offsets': []})
+        manifest['file_names'].append(f'{file_name}.npy')
+        manifest['image_shapes'].append(list(shape))
+        manifest['head_counts'].append(head_count)
+        manifest['image_data_offsets'].append(data_offset)
+
+    def write_manifests(self):
+        """Writes the manifest of each dataset directory, so the datasets can be indexed without opening the images."""
+        for dataset_directory, manifest in self.manifests.items():
+            with open(os.path.join(dataset_directory, manifest_file_name), 'w') as manifest_file:
+                json.dump(manifest, manifest_file, separators=(',', ':'))
+
     def print_statistics(self):
         """Prints basic statistics for the processed database."""
         print(f'{self.total_images} images processed.')
         print(f'{self.total_head_count} head counts processed.')
 
 
+def density_directory_name(beta):
+    """The name of the directory of the density labels with a given neighbor deviation beta."""
+    return clean_scientific_notation('density{:e}'.format(beta))
+
+
+def read_npy_header(path):
+    """
+    Reads the array information from the header of a `.npy` file, without reading the array.
+
+    :param path: The path of the file.
+    :type path: str
+    :return: The shape and dtype of the array, and the byte offset of its data in the file.
+    :rtype: (tuple[int], np.dtype, int)
+    """
+    with open(path, 'rb') as npy_file:
+        version = np.lib.format.read_magic(npy_file)
+        if version == (1, 0):
+            shape, _, dtype = np.lib.format.read_array_header_1_0(npy_file)
+        else:
+            shape, _, dtype = np.lib.format.read_array_header_2_0(npy_file)
+        return shape, dtype, npy_file.tell()
+
+
+def load_image_shapes(dataset_directory, file_names):
+    """
+    Gives the image shapes of the examples of a dataset directory, from its manifest when the preprocessor wrote one,
+    otherwise from the headers of the image files.
+
+    :param dataset_directory: The dataset directory.
+    :type dataset_directory: str
+    :param file_names: The file names of the examples.
+    :type file_names: list[str]
+    :return: The image shape of each file name.
+    :rtype: dict[str, tuple[int]]
+    """
+    image_shapes = {}
+    manifest_path = os.path.join(dataset_directory, manifest_file_name)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        image_shapes = {file_name: tuple(shape)
+                        for file_name, shape in zip(manifest['file_names'], manifest['image_shapes'])}
+    for file_name in file_names:
+        if file_name not in image_shapes:
+            image_shapes[file_name], _, _ = read_npy_header(os.path.join(dataset_directory, 'images', file_name))
+    return image_shapes
+
+
 head_standard_deviation_meters = 0.2
 body_width_standard_deviation_meters = 0.2
 body_height_standard_deviation_meters = 0.5
@@ -146,9 +228,9 @@ def generate_density_label(head_positions, label_size, perspective=None, include
     label = np.zeros(shape=label_size, dtype=np.float32)
     for head_index, head_position in enumerate(head_positions):
         if yx_order:
-            y, x = np.rint(head_position).astype(np.uint32)
+            y, x = np.rint(head_position).astype(np.int64)
         else:
-            x, y = np.rint(head_position).astype(np.uint32)
+            x, y = np.rint(head_position).astype(np.int64)
         if perspective_resizing:
             if perspective is not None:
                 if 0 <= x < perspective.shape[1]:
@@ -7,7 +7,7 @@ import numpy as np
 from torch.utils.data import DataLoader
 
 from crowd import data
-from crowd.data import CrowdExample, CrowdDataset
+from crowd.data import CrowdExample, CrowdDataset, collate_patch_batch
 from crowd.models import KnnDenseNetCat
 from crowd.shanghai_tech_data import ShanghaiTechFullImageDataset, ShanghaiTechTransformedDataset
 from crowd.srgan import CrowdExperiment
@@ -22,15 +22,23 @@ class CrowdDnnExperiment(DnnExperiment, CrowdExperiment):
     def dataset_setup(self):
         """Sets up the datasets for the application."""
         settings = self.settings
+        memory_map_cache_size = settings.memory_map_cache_size
+        storage = settings.crowd_data_storage
         if settings.crowd_dataset == CrowdDataset.ucf_qnrf:
             self.dataset_class = UcfQnrfFullImageDataset
             self.train_dataset = UcfQnrfTransformedDataset(middle_transform=data.RandomHorizontalFlip(),
                                                            seed=settings.labeled_dataset_seed,
-                                                           number_of_examples=settings.labeled_dataset_size)
+                                                           number_of_examples=settings.labeled_dataset_size,
+                                                           memory_map_cache_size=memory_map_cache_size,
+                                                           storage=storage, pin_memory=settings.pin_memory)
             self.train_dataset_loader = DataLoader(self.train_dataset, batch_size=settings.batch_size,
+                                                   sampler=self.patch_sampler(self.train_dataset),
                                                    pin_memory=self.settings.pin_memory,
-                                                   num_workers=settings.number_of_data_workers)
-            self.validation_dataset = UcfQnrfTransformedDataset(dataset='test', seed=101)
+                                                   num_workers=settings.number_of_data_workers,
+                                                   collate_fn=collate_patch_batch)
+            self.validation_dataset = UcfQnrfTransformedDataset(dataset='test', seed=101,
+                                                                memory_map_cache_size=memory_map_cache_size,
+                                                                storage=storage)
         elif settings.crowd_dataset == CrowdDataset.shanghai_tech:
             self.dataset_class = ShanghaiTechFullImageDataset
             self.train_dataset = ShanghaiTechTransformedDataset(middle_transform=data.RandomHorizontalFlip(),
@@ -38,14 +46,20 @@ class CrowdDnnExperiment(DnnExperiment, CrowdExperiment):
                                                                 number_of_examples=settings.labeled_dataset_size,
                                                                 map_directory_name=settings.map_directory_name,
                                                                 image_patch_size=self.settings.image_patch_size,
-                                                                label_patch_size=self.settings.label_patch_size)
+                                                                label_patch_size=self.settings.label_patch_size,
+                                                                memory_map_cache_size=memory_map_cache_size,
+                                                                storage=storage, pin_memory=settings.pin_memory)
             self.train_dataset_loader = DataLoader(self.train_dataset, batch_size=settings.batch_size,
+                                                   sampler=self.patch_sampler(self.train_dataset),
                                                    pin_memory=self.settings.pin_memory,
-                                                   num_workers=settings.number_of_data_workers)
+                                                   num_workers=settings.number_of_data_workers,
+                                                   collate_fn=collate_patch_batch)
             self.validation_dataset = ShanghaiTechTransformedDataset(dataset='test', seed=101,
                                                                      map_directory_name=settings.map_directory_name,
                                                                      image_patch_size=self.settings.image_patch_size,
-                                                                     label_patch_size=self.settings.label_patch_size)
+                                                                     label_patch_size=self.settings.label_patch_size,
+                                                                     memory_map_cache_size=memory_map_cache_size,
+                                                                     storage=storage)
         elif settings.crowd_dataset == CrowdDataset.ucf_cc_50:
             seed = 0
             self.dataset_class = UcfCc50FullImageDataset
@@ -53,20 +67,27 @@ class CrowdDnnExperiment(DnnExperiment, CrowdExperiment):
                                                            seed=seed,
                                                            test_start=settings.labeled_dataset_seed * 10,
                                                            inverse_map=settings.inverse_map,
-                                                           map_directory_name=settings.map_directory_name)
+                                                           map_directory_name=settings.map_directory_name,
+                                                           memory_map_cache_size=memory_map_cache_size,
+                                                           storage=storage, pin_memory=settings.pin_memory)
             self.train_dataset_loader = DataLoader(self.train_dataset, batch_size=settings.batch_size,
+                                                   sampler=self.patch_sampler(self.train_dataset),
                                                    pin_memory=self.settings.pin_memory,
-                                                   num_workers=settings.number_of_data_workers)
+                                                   num_workers=settings.number_of_data_workers,
+                                                   collate_fn=collate_patch_batch)
             self.validation_dataset = UcfCc50TransformedDataset(dataset='test', seed=seed,
                                                                 test_start=settings.labeled_dataset_seed * 10,
                                                                 inverse_map=settings.inverse_map,
-                                                                map_directory_name=settings.map_directory_name)
+                                                                map_directory_name=settings.map_directory_name,
+                                                                memory_map_cache_size=memory_map_cache_size,
+                                                                storage=storage)
         else:
             raise ValueError('{} is not an understood crowd dataset.'.format(settings.crowd_dataset))
 
     def model_setup(self):
         """Prepares all the model architectures required for the application."""
-        self.DNN = KnnDenseNetCat(label_patch_size=self.settings.label_patch_size)
+        self.DNN = KnnDenseNetCat(label_patch_size=self.settings.label_patch_size,
+                                  pretrained=self.settings.pretrained_weights)
 
     def validation_summaries(self, step):
         """Prepares the summaries that should be run for the given application."""
@@ -94,7 +115,8 @@ class CrowdDnnExperiment(DnnExperiment, CrowdExperiment):
 
     def test_summaries(self):
         """Evaluates the model on test data during training."""
-        test_dataset = self.dataset_class(dataset='test', map_directory_name=self.settings.map_directory_name)
+        test_dataset = self.dataset_class(dataset='test', map_directory_name=self.settings.map_directory_name,
+                                          storage=self.settings.crowd_data_storage)
         if self.settings.test_summary_size is not None:
             indexes = random.sample(range(test_dataset.length), self.settings.test_summary_size)
         else:
@@ -125,8 +147,8 @@ class CrowdDnnExperiment(DnnExperiment, CrowdExperiment):
     def evaluate(self, during_training=False, step=None, number_of_examples=None):
         """Evaluates the model on test data."""
         self.model_setup()
-        self.load_models()
         self.gpu_mode()
+        self.load_models(with_optimizers=False)
         self.eval_mode()
         self.settings.dataset_class = UcfQnrfFullImageDataset
         test_dataset = self.settings.dataset_class(dataset='test')
@@ -0,0 +1,179 @@
+"""
+Code for the packed storage of the crowd datasets. A packed dataset directory holds a few large shard files, rather
+than a `.npy` file per image, label, and map. Each example is its uint8 CHW image followed by its float16 label and
+map channels, at the offsets given by the index, so the examples are read zero-copy from memory maps of the shards.
+Convert the `.npy` files of a database with `python -m crowd.packed_data`.
+"""
+import json
+import os
+
+import numpy as np
+
+from crowd.data import CrowdDataset
+
+packed_directory_name = 'packed'
+index_file_name = 'index.json'
+alignment = 64  # Bytes each array starts on a multiple of.
+
+packed_crowd_dataset = CrowdDataset.shanghai_tech  # The database to pack.
+packed_channels = ['labels', 'i1nn_maps']  # The label and map directories to pack alongside the images.
+packed_shard_size = 2 ** 30  # The size in bytes after which a new shard is started.
+
+
+class PackedShards:
+    """
+    Reads the examples of a packed dataset directory. Each process memory maps the shards itself (e.g. each data
+    loader worker), as a copy of the reader in another process starts without the maps.
+    """
+    def __init__(self, dataset_directory, channel_names):
+        self.dataset_directory = dataset_directory
+        self.packed_directory = os.path.join(dataset_directory, packed_directory_name)
+        with open(os.path.join(self.packed_directory, index_file_name)) as index_file:
+            self.index = json.load(index_file)
+        self.channels = self.index['channels']
+        for channel_name in channel_names:
+            if channel_name not in self.channels:
+                raise ValueError(f'{channel_name} was not packed in {self.packed_directory} (only {self.channels}).')
+        self.channel_indexes = [self.channels.index(channel_name) for channel_name in channel_names]
+        self.file_names = self.index['file_names']
+        self.image_shapes = {file_name: (*shape, 3) for file_name, shape in zip(self.file_names,
+                                                                                self.index['image_shapes'])}
+        self.positions = {file_name: position for position, file_name in enumerate(self.file_names)}
+        self.shard_maps = None
+        self.process_id = None
+
+    def load(self, file_name):
+        """
+        Gives views of an example's arrays in the shard memory maps.
+
+        :param file_name: The file name of the example (as in the `.npy` layout).
+        :type file_name: str
+        :return: The HWC image (a view of the CHW image), and the channels the reader was created for.
+        :rtype: (np.ndarray, list[np.ndarray])
+        """
+        if self.process_id != os.getpid():
+            self.shard_maps = [np.memmap(os.path.join(self.packed_directory, shard_name), dtype=np.uint8, mode='r')
+                               for shard_name in self.index['shard_names']]
+            self.process_id = os.getpid()
+        position = self.positions[file_name]
+        height, width = self.index['image_shapes'][position]
+        shard_map = self.shard_maps[self.index['shards'][position]]
+        image_offset = self.index['image_offsets'][position]
+        image = shard_map[image_offset:image_offset + 3 * height * width].reshape(3, height, width)
+        channels_offset = self.index['channel_offsets'][position]
+        channels_size = len(self.channels) * height * width * 2
+        channel_arrays = shard_map[channels_offset:channels_offset + channels_size].view(np.float16).reshape(
+            len(self.channels), height, width)
+        return image.transpose((1, 2, 0)), [channel_arrays[channel_index] for channel_index in self.channel_indexes]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shard_maps'] = None
+        state['process_id'] = None
+        return state
+
+
+def example_file_names(dataset_directory, packed_shards=None):
+    """
+    The file names of the examples of a dataset directory.
+
+    :param dataset_directory: The dataset directory.
+    :type dataset_directory: str
+    :param packed_shards: The reader of the directory's packed shards, or None to list the `.npy` labels.
+    :type packed_shards: PackedShards
+    :return: The file names.
+    :rtype: list[str]
+    """
+    if packed_shards is not None:
+        return list(packed_shards.file_names)
+    return [name for name in os.listdir(os.path.join(dataset_directory, 'labels')) if name.endswith('.npy')]
+
+
+def pack_dataset_directory(dataset_directory, channels=None, shard_size=None):
+    """
+    Packs the `.npy` images, labels, and maps of a dataset directory into shards. The `.npy` files are kept.
+
+    :param dataset_directory: The dataset directory.
+    :type dataset_directory: str
+    :param channels: The label and map directories to pack. Defaults to `packed_channels`.
+    :type channels: list[str]
+    :param shard_size: The size in bytes after which a new shard is started. Defaults to `packed_shard_size`.
+    :type shard_size: int
+    """
+    channels = channels if channels is not None else packed_channels
+    shard_size = shard_size if shard_size is not None else packed_shard_size
+    packed_directory = os.path.join(dataset_directory, packed_directory_name)
+    os.makedirs(packed_directory, exist_ok=True)
+    file_names = example_file_names(dataset_directory)
+    index = {'channels': channels, 'shard_names': [], 'file_names': file_names, 'image_shapes': [],
+             'shards': [], 'image_offsets': [], 'channel_offsets': []}
+    shard_file = None
+    try:
+        for file_name in file_names:
+            if shard_file is None or shard_file.tell() >= shard_size:
+                if shard_file is not None:
+                    shard_file.close()
+                index['shard_names'].append(f'shard_{len(index["shard_names"])}.bin')
+                shard_file = open(os.path.join(packed_directory, index['shard_names'][-1]), 'wb')
+            image = np.load(os.path.join(dataset_directory, 'images', file_name), mmap_mode='r')
+            channel_arrays = [np.load(os.path.join(dataset_directory, name, file_name), mmap_mode='r')
+                              for name in channels]
+            index['image_shapes'].append(list(image.shape[:2]))
+            index['shards'].append(len(index['shard_names']) - 1)
+            index['image_offsets'].append(write_aligned(shard_file, image.astype(np.uint8).transpose((2, 0, 1))))
+            index['channel_offsets'].append(write_aligned(shard_file, np.stack(channel_arrays).astype(np.float16)))
+    finally:
+        if shard_file is not None:
+            shard_file.close()
+    with open(os.path.join(packed_directory, index_file_name), 'w') as index_file:
+        json.dump(index, index_file, separators=(',', ':'))
+    print(f'Packed {len(file_names)} examples of {dataset_directory} into {len(index["shard_names"])} shards.')
+
+
+def write_aligned(file, array):
+    """
+    Writes an array's C ordered bytes to a file, starting at the next multiple of the alignment.
+
+    :param file: The file to write to.
+    :type file: io.BufferedWriter
+    :param array: The array to write.
+    :type array: np.ndarray
+    :return: The offset the array was written at.
+    :rtype: int
+    """
+    padding = -file.tell() % alignment
+    file.write(b'\0' * padding)
+    offset = file.tell()
+    file.write(np.ascontiguousarray(array).tobytes())
+    return offset
+
+
+def dataset_directories(crowd_dataset):
+    """
+    The dataset directories (each of which is packed on its own) of a crowd database.
+
+    :param crowd_dataset: The crowd database.
+    :type crowd_dataset: CrowdDataset
+    :return: The dataset directories.
+    :rtype: list[str]
+    """
+    # The dataset modules import this one, so their preprocessors are imported only here.
+    if crowd_dataset == CrowdDataset.shanghai_tech:
+        from crowd.shanghai_tech_data import ShanghaiTechPreprocessor
+        database_directory = ShanghaiTechPreprocessor().database_directory
+        return [os.path.join(database_directory, part, split) for part in ['part_A', 'part_B']
+                for split in ['train_data', 'test_data']]
+    elif crowd_dataset == CrowdDataset.ucf_qnrf:
+        from crowd.ucf_qnrf_data import UcfQnrfPreprocessor
+        database_directory = UcfQnrfPreprocessor().database_directory
+        return [os.path.join(database_directory, split) for split in ['Train', 'Test']]
+    elif crowd_dataset == CrowdDataset.ucf_cc_50:
+        from crowd.ucf_cc_50_data import UcfCc50Preprocessor
+        return [UcfCc50Preprocessor().database_directory]
+    else:
+        raise ValueError('{} has no packed storage.'.format(crowd_dataset))
+
+
+if __name__ == '__main__':
+    for dataset_directory in dataset_directories(packed_crowd_dataset):
+        pack_dataset_directory(dataset_directory)
@@ -11,18 +11,18 @@ import scipy.misc
 import matplotlib
 import numpy as np
 import torch
-from scipy.stats import norm
 import torchvision
 from torch.utils.data import DataLoader
 
 from crowd import data
-from crowd.data import ExtractPatchForPosition, CrowdExample, ImageSlidingWindowDataset, CrowdDataset
+from crowd.data import (ExtractPatchForPosition, CrowdExample, ImageSlidingWindowDataset, CrowdDataset,
+                        ImageGroupedPatchSampler, collate_patch_batch)
 from crowd.models import DCGenerator, KnnDenseNetCat
 from crowd.shanghai_tech_data import ShanghaiTechFullImageDataset, ShanghaiTechTransformedDataset
 from crowd.ucf_qnrf_data import UcfQnrfFullImageDataset, UcfQnrfTransformedDataset
 from crowd.world_expo_data import WorldExpoFullImageDataset, WorldExpoTransformedDataset
 from srgan import Experiment
-from utility import MixtureModel, gpu
+from utility import gpu
 
 
 class CrowdExperiment(Experiment):
@@ -31,43 +31,65 @@ class CrowdExperiment(Experiment):
     def dataset_setup(self):
         """Sets up the datasets for the application."""
         settings = self.settings
+        memory_map_cache_size = settings.memory_map_cache_size
+        storage = settings.crowd_data_storage
         if settings.crowd_dataset == CrowdDataset.ucf_qnrf:
             self.dataset_class = UcfQnrfFullImageDataset
             self.train_dataset = UcfQnrfTransformedDataset(middle_transform=data.RandomHorizontalFlip(),
                                                            seed=settings.labeled_dataset_seed,
                                                            number_of_examples=settings.labeled_dataset_size,
-                                                           map_directory_name=settings.map_directory_name)
+                                                           map_directory_name=settings.map_directory_name,
+                                                           memory_map_cache_size=memory_map_cache_size,
+                                                           storage=storage, pin_memory=settings.pin_memory)
             self.train_dataset_loader = DataLoader(self.train_dataset, batch_size=settings.batch_size,
+                                                   sampler=self.patch_sampler(self.train_dataset),
                                                    pin_memory=self.settings.pin_memory,
-                                                   num_workers=settings.number_of_data_workers)
+                                                   num_workers=settings.number_of_data_workers,
+                                                   collate_fn=collate_patch_batch)
             self.unlabeled_dataset = UcfQnrfTransformedDataset(middle_transform=data.RandomHorizontalFlip(),
                                                                seed=settings.labeled_dataset_seed,
                                                                number_of_examples=settings.unlabeled_dataset_size,
                                                                map_directory_name=settings.map_directory_name,
-                                                               examples_start=settings.labeled_dataset_size)
+                                                               examples_start=settings.labeled_dataset_size,
+                                                               memory_map_cache_size=memory_map_cache_size,
+                                                               storage=storage, pin_memory=settings.pin_memory)
             self.unlabeled_dataset_loader = DataLoader(self.unlabeled_dataset, batch_size=settings.batch_size,
+                                                       sampler=self.patch_sampler(self.unlabeled_dataset),
                                                        pin_memory=self.settings.pin_memory,
-                                                       num_workers=settings.number_of_data_workers)
+                                                       num_workers=settings.number_of_data_workers,
+                                                       collate_fn=collate_patch_batch)
             self.validation_dataset = UcfQnrfTransformedDataset(dataset='test', seed=101,
-                                                                map_directory_name=settings.map_directory_name)
+                                                                map_directory_name=settings.map_directory_name,
+                                                                memory_map_cache_size=memory_map_cache_size,
+                                                                storage=storage)
         elif settings.crowd_dataset == CrowdDataset.shanghai_tech:
             self.dataset_class = ShanghaiTechFullImageDataset
             self.train_dataset = ShanghaiTechTransformedDataset(middle_transform=data.RandomHorizontalFlip(),
                                                                 seed=settings.labeled_dataset_seed,
                                                                 number_of_examples=settings.labeled_dataset_size,
-                                                                map_directory_name=settings.map_directory_name)
+                                                                map_directory_name=settings.map_directory_name,
+                                                                memory_map_cache_size=memory_map_cache_size,
+                                                                storage=storage, pin_memory=settings.pin_memory)
             self.train_dataset_loader = DataLoader(self.train_dataset, batch_size=settings.batch_size,
+                                                   sampler=self.patch_sampler(self.train_dataset),
                                                    pin_memory=self.settings.pin_memory,
-                                                   num_workers=settings.number_of_data_workers)
+                                                   num_workers=settings.number_of_data_workers,
+                                                   collate_fn=collate_patch_batch)
             self.unlabeled_dataset = ShanghaiTechTransformedDataset(middle_transform=data.RandomHorizontalFlip(),
                                                                     seed=100,
                                                                     number_of_examples=settings.unlabeled_dataset_size,
-                                                                    map_directory_name=settings.map_directory_name)
+                                                                    map_directory_name=settings.map_directory_name,
+                                                                    memory_map_cache_size=memory_map_cache_size,
+                                                                    storage=storage, pin_memory=settings.pin_memory)
             self.unlabeled_dataset_loader = DataLoader(self.train_dataset, batch_size=settings.batch_size,
+                                                       sampler=self.patch_sampler(self.train_dataset),
                                                        pin_memory=self.settings.pin_memory,
-                                                       num_workers=settings.number_of_data_workers)
+                                                       num_workers=settings.number_of_data_workers,
+                                                       collate_fn=collate_patch_batch)
             self.validation_dataset = ShanghaiTechTransformedDataset(dataset='test', seed=101,
-                                                                     map_directory_name=settings.map_directory_name)
+                                                                     map_directory_name=settings.map_directory_name,
+                                                                     memory_map_cache_size=memory_map_cache_size,
+                                                                     storage=storage)
 
         elif settings.crowd_dataset == CrowdDataset.world_expo:
             self.dataset_class = WorldExpoFullImageDataset
@@ -77,23 +99,39 @@ class CrowdExperiment(Experiment):
                                                              number_of_images_per_camera=settings.number_of_images_per_camera)
             self.train_dataset_loader = DataLoader(self.train_dataset, batch_size=settings.batch_size,
                                                    pin_memory=self.settings.pin_memory,
-                                                   num_workers=settings.number_of_data_workers)
+                                                   num_workers=settings.number_of_data_workers,
+                                                   collate_fn=collate_patch_batch)
             self.unlabeled_dataset = WorldExpoTransformedDataset(middle_transform=data.RandomHorizontalFlip(),
                                                                  seed=settings.labeled_dataset_seed,
                                                                  number_of_cameras=settings.number_of_cameras,
                                                                  number_of_images_per_camera=settings.number_of_images_per_camera)
             self.unlabeled_dataset_loader = DataLoader(self.unlabeled_dataset, batch_size=settings.batch_size,
                                                        pin_memory=self.settings.pin_memory,
-                                                       num_workers=settings.number_of_data_workers)
+                                                       num_workers=settings.number_of_data_workers,
+                                                       collate_fn=collate_patch_batch)
             self.validation_dataset = WorldExpoTransformedDataset(dataset='validation', seed=101)
             if self.settings.batch_size > self.train_dataset.length:
                 self.settings.batch_size = self.train_dataset.length
 
+    def patch_sampler(self, dataset):
+        """
+        The sampler of a crowd training dataset, which draws several patches from each image visited if the settings
+        ask for it.
+
+        :param dataset: The transformed crowd dataset.
+        :type dataset: Dataset
+        :return: The sampler, or None to sample each patch from any image.
+        :rtype: ImageGroupedPatchSampler | None
+        """
+        if self.settings.patches_per_image_visit is None:
+            return None
+        return ImageGroupedPatchSampler(dataset, patches_per_image=self.settings.patches_per_image_visit)
+
     def model_setup(self):
         """Prepares all the model architectures required for the application."""
         self.G = DCGenerator()
-        self.D = KnnDenseNetCat()
-        self.DNN = KnnDenseNetCat()
+        self.D = KnnDenseNetCat(pretrained=self.settings.pretrained_weights)
+        self.DNN = KnnDenseNetCat(pretrained=self.settings.pretrained_weights)
 
     def validation_summaries(self, step):
         """Prepares the summaries that should be run for the given application."""
@@ -138,9 +176,8 @@ class CrowdExperiment(Experiment):
         fake_examples = G(z.to(gpu)).to('cpu')
         fake_images_image = torchvision.utils.make_grid(fake_examples.data[:9], normalize=True, range=(-1, 1), nrow=3)
         gan_summary_writer.add_image('Fake/Standard', fake_images_image.numpy())
-        z = torch.as_tensor(MixtureModel([norm(-settings.mean_offset, 1), norm(settings.mean_offset, 1)]
-                                         ).rvs(size=[settings.batch_size, G.input_size]).astype(np.float32))
-        fake_examples = G(z.to(gpu)).to('cpu')
+        z = self.generator_input_distribution.rvs([settings.batch_size, G.input_size])
+        fake_examples = G(z).to('cpu')
         fake_images_image = torchvision.utils.make_grid(fake_examples.data[:9], normalize=True, range=(-1, 1), nrow=3)
         gan_summary_writer.add_image('Fake/Offset', fake_images_image.numpy())
 
@@ -260,7 +297,8 @@ class CrowdExperiment(Experiment):
 
     def test_summaries(self):
         """Evaluates the model on test data during training."""
-        test_dataset = self.dataset_class(dataset='test', map_directory_name=self.settings.map_directory_name)
+        test_dataset = self.dataset_class(dataset='test', map_directory_name=self.settings.map_directory_name,
+                                          storage=self.settings.crowd_data_storage)
         if self.settings.test_summary_size is not None:
             indexes = random.sample(range(test_dataset.length), self.settings.test_summary_size)
         else:
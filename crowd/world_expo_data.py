@@ -32,7 +32,9 @@ class WorldExpoFullImageDataset(Dataset):
     A class for the World Expo full image crowd dataset.
     """
     def __init__(self, dataset='train', seed=None, number_of_cameras=None, number_of_images_per_camera=None,
-                 map_directory_name=None):
+                 map_directory_name=None, storage='npy'):
+        if storage != 'npy':
+            raise ValueError('The World Expo data is only stored as the arrays of each camera.')
         seed_all(seed)
         self.dataset_directory = database_directory
         with open(os.path.join(self.dataset_directory, 'viable_with_validation_and_random_test.json')) as json_file:
@@ -0,0 +1,147 @@
+"""
+Code to train an experiment with data-parallel processes over the gloo backend.
+"""
+import os
+
+import torch
+import torch.distributed as distributed
+import torch.multiprocessing as multiprocessing
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+from torch.utils.data import DataLoader, RandomSampler, Subset
+
+
+def launch_distributed_training(experiment_class, settings):
+    """
+    Trains an experiment with `settings.distributed_processes` data-parallel processes on this host. Each host of a
+    multi-host run launches its own processes with the same settings (other than `distributed_host_index`), and
+    the processes of all the hosts join a single gloo process group at `settings.distributed_address`.
+
+    :param experiment_class: The class of the experiment to train.
+    :type experiment_class: type
+    :param settings: The settings of the experiment.
+    :type settings: settings.Settings
+    :return: The trial directory written by rank 0, or None if rank 0 is on another host (or skipped the trial).
+    :rtype: str
+    """
+    context = multiprocessing.get_context('spawn')
+    result_queue = context.SimpleQueue()
+    multiprocessing.start_processes(distributed_worker, args=(experiment_class, settings, result_queue),
+                                    nprocs=settings.distributed_processes, start_method='spawn')
+    if result_queue.empty():
+        return None
+    return result_queue.get()
+
+
+def distributed_worker(local_rank, experiment_class, settings, result_queue):
+    """
+    Joins the process group and trains the experiment as one of its ranks.
+
+    :param local_rank: The index of the process on this host.
+    :type local_rank: int
+    :param experiment_class: The class of the experiment to train.
+    :type experiment_class: type
+    :param settings: The settings of the experiment.
+    :type settings: settings.Settings
+    :param result_queue: The queue rank 0 sends the trial directory through.
+    :type result_queue: multiprocessing.SimpleQueue
+    """
+    processes = settings.distributed_processes
+    rank = settings.distributed_host_index * processes + local_rank
+    world_size = settings.distributed_hosts * processes
+    torch.set_num_threads(max(1, len(os.sched_getaffinity(0)) // processes))
+    distributed.init_process_group('gloo', init_method=f'tcp://{settings.distributed_address}', rank=rank,
+                                   world_size=world_size)
+    try:
+        experiment = experiment_class(settings)
+        experiment.train()
+        for summary_writer in [experiment.dnn_summary_writer, experiment.gan_summary_writer]:
+            if summary_writer is not None:
+                summary_writer.close()
+        if rank == 0:
+            result_queue.put(experiment.trial_directory)
+    finally:
+        distributed.destroy_process_group()
+
+
+def shard_data_loader(data_loader, rank, world_size):
+    """
+    Creates a copy of a data loader over only a rank's shard of its dataset (every `world_size`th example, starting
+    at the rank's index), so the ranks train on distinct examples. A sampler which can shard itself (one with a
+    `shard` method) gives the rank's examples instead.
+
+    :param data_loader: The data loader over the whole dataset.
+    :type data_loader: DataLoader
+    :param rank: The rank of the process.
+    :type rank: int
+    :param world_size: The number of processes.
+    :type world_size: int
+    :return: The data loader over the rank's shard.
+    :rtype: DataLoader
+    """
+    dataset = data_loader.dataset
+    if hasattr(data_loader.sampler, 'shard'):  # A sampler giving its own indexes (e.g. grouped crowd patches).
+        return DataLoader(dataset, batch_size=data_loader.batch_size,
+                          sampler=data_loader.sampler.shard(rank, world_size),
+                          num_workers=data_loader.num_workers, collate_fn=data_loader.collate_fn,
+                          pin_memory=data_loader.pin_memory, drop_last=data_loader.drop_last,
+                          worker_init_fn=data_loader.worker_init_fn)
+    shard = Subset(dataset, range(rank, len(dataset), world_size))
+    return DataLoader(shard, batch_size=data_loader.batch_size, shuffle=isinstance(data_loader.sampler, RandomSampler),
+                      num_workers=data_loader.num_workers, collate_fn=data_loader.collate_fn,
+                      pin_memory=data_loader.pin_memory, drop_last=data_loader.drop_last,
+                      worker_init_fn=data_loader.worker_init_fn)
+
+
+def broadcast_module_state(module, source_rank=0):
+    """
+    Copies the parameters and buffers of a module from the source rank to all the other ranks.
+
+    :param module: The module to synchronize.
+    :type module: torch.nn.Module
+    :param source_rank: The rank whose values are copied.
+    :type source_rank: int
+    """
+    with torch.no_grad():
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            distributed.broadcast(tensor, source_rank)
+
+
+def all_reduce_gradients(module, group=None):
+    """
+    Averages the gradients of a module's parameters over the ranks, in a single flattened all-reduce.
+
+    :param module: The module whose gradients are averaged.
+    :type module: torch.nn.Module
+    :param group: The process group to average over. None for the default group.
+    :type group: torch.distributed.ProcessGroup
+    """
+    gradients = [parameter.grad for parameter in module.parameters() if parameter.grad is not None]
+    if not gradients:
+        return
+    flat_gradients = _flatten_dense_tensors(gradients)
+    distributed.all_reduce(flat_gradients, group=group)
+    flat_gradients /= distributed.get_world_size(group)
+    for gradient, reduced_gradient in zip(gradients, _unflatten_dense_tensors(flat_gradients, gradients)):
+        gradient.copy_(reduced_gradient)
+
+
+def global_batch_mean(tensor):
+    """
+    The mean over the first dimension of a tensor across the batches of all the ranks, from an all-gather of each
+    rank's sum and example count. Only the rank's own examples are differentiated, with their gradients scaled by the
+    world size, so averaging the parameter gradients over the ranks gives the gradient of the global batch's loss.
+
+    :param tensor: The rank's batch of values (e.g. features).
+    :type tensor: torch.Tensor
+    :return: The global mean.
+    :rtype: torch.Tensor
+    """
+    world_size = distributed.get_world_size()
+    local_sum = tensor.sum(0, dtype=torch.float32)
+    local_sum_and_count = torch.cat([local_sum.detach().flatten(), local_sum.new_tensor([tensor.size(0)])])
+    gathered = [torch.empty_like(local_sum_and_count) for _ in range(world_size)]
+    distributed.all_gather(gathered, local_sum_and_count)
+    global_sum_and_count = torch.stack(gathered).sum(0)
+    global_sum = global_sum_and_count[:-1].view_as(local_sum)
+    differentiable_sum = global_sum + (local_sum - local_sum.detach()) * world_size
+    return (differentiable_sum / global_sum_and_count[-1]).to(tensor.dtype)
@@ -3,20 +3,23 @@ Code to run only the DNN model.
 """
 import datetime
 import os
-import re
 from abc import ABC
 import torch
 from torch.optim import Adam
 
+from control import TrainingController
+from evaluator import AsynchronousEvaluator
+from profiler import TrainingProfiler
 from srgan import Experiment
-from utility import SummaryWriter, gpu
+from utility import SummaryWriter, gpu, BatchPrefetcher
 
 
 class DnnExperiment(Experiment, ABC):
     """A class to manage an experimental trial with only a DNN."""
-    def prepare_summary_writers(self):
-        """Prepares the summary writers for TensorBoard."""
-        self.dnn_summary_writer = SummaryWriter(os.path.join(self.trial_directory, 'DNN'))
+    def prepare_summary_writers(self, filename_suffix=''):
+        """Prepares the summary writers for TensorBoard. Only rank 0 writes summaries when training data-parallel."""
+        self.dnn_summary_writer = SummaryWriter(os.path.join(self.trial_directory, 'DNN'),
+                                                filename_suffix=filename_suffix, write_to_disk=self.rank == 0)
         self.dnn_summary_writer.summary_period = self.settings.summary_step_period
 
     def gpu_mode(self):
@@ -48,53 +51,52 @@ class DnnExperiment(Experiment, ABC):
         model = {'DNN': self.DNN.state_dict(),
                  'dnn_optimizer': self.dnn_optimizer.state_dict(),
                  'step': step}
-        torch.save(model, os.path.join(self.trial_directory, f'model_{step}.pth'))
-
-    def load_models(self, with_optimizers=True):
-        """Loads existing models if they exist at `self.settings.load_model_path`."""
-        if self.settings.load_model_path:
-            latest_model = None
-            model_path_file_names = os.listdir(self.settings.load_model_path)
-            for file_name in model_path_file_names:
-                match = re.search(r'model_?(\d+)?\.pth', file_name)
-                if match:
-                    latest_model = self.compare_model_path_for_latest(latest_model, match)
-            latest_model = None if latest_model is None else latest_model.group(0)
-            if not torch.cuda.is_available():
-                map_location = 'cpu'
-            else:
-                map_location = None
-            if latest_model:
-                model_path = os.path.join(self.settings.load_model_path, latest_model)
-                loaded_model = torch.load(model_path, map_location)
-                self.DNN.load_state_dict(loaded_model['DNN'])
-                if with_optimizers:
-                    self.dnn_optimizer.load_state_dict(loaded_model['dnn_optimizer'])
-                    self.optimizer_to_gpu(self.dnn_optimizer)
-                print('Model loaded from `{}`.'.format(model_path))
-                if self.settings.continue_existing_experiments:
-                    self.starting_step = loaded_model['step'] + 1
-                    print(f'Continuing from step {self.starting_step}')
+        self.write_checkpoint(model, step)
 
     def training_loop(self):
         """Runs the main training loop."""
-        train_dataset_generator = self.infinite_iter(self.train_dataset_loader)
+        train_dataset_generator = BatchPrefetcher(self.train_dataset_loader, depth=self.settings.prefetch_batches)
+        if self.settings.asynchronous_evaluation and self.rank == 0:
+            self.evaluator = AsynchronousEvaluator(self)
+        profiler = TrainingProfiler(self) if self.settings.profile_steps is not None and self.rank == 0 else None
+        if self.rank == 0:
+            self.controller = TrainingController(self, [train_dataset_generator])
         step_time_start = datetime.datetime.now()
         for step in range(self.starting_step, self.settings.steps_to_run):
+            if profiler is not None:
+                profiler.step_started(step)
             self.adjust_learning_rate(step)
             samples = next(train_dataset_generator)
             if len(samples) == 2:
                 labeled_examples, labels = samples
-                labeled_examples, labels = labeled_examples.to(gpu), labels.to(gpu)
             else:
                 labeled_examples, primary_labels, secondary_labels = samples
-                labeled_examples, labels = labeled_examples.to(gpu), (primary_labels.to(gpu), secondary_labels.to(gpu))
+                labels = (primary_labels, secondary_labels)
             self.dnn_training_step(labeled_examples, labels, step)
-            if self.dnn_summary_writer.is_summary_step() or step == self.settings.steps_to_run - 1:
+            self.timer.step_completed()
+            summary_step = self.dnn_summary_writer.is_summary_step() or step == self.settings.steps_to_run - 1
+            if self.rank == 0 and (summary_step or self.summary_requested):
+                self.summary_requested = False
                 print('\rStep {}, {}...'.format(step, datetime.datetime.now() - step_time_start), end='')
+                self.timer.add('Data Wait/Labeled', train_dataset_generator.pop_wait_time())
+                self.timer.add('Host To Device Copy', train_dataset_generator.pop_copy_time())
+                self.timer.write_summaries(self.dnn_summary_writer)
                 step_time_start = datetime.datetime.now()
-                self.eval_mode()
-                with torch.no_grad():
-                    self.validation_summaries(step)
-                self.train_mode()
+                with self.timer.phase('Summaries'):
+                    if self.evaluator is not None:
+                        self.evaluator.submit(self, step, block=step == self.settings.steps_to_run - 1)
+                    else:
+                        self.eval_mode()
+                        with torch.no_grad():
+                            self.validation_summaries(step)
+                        self.train_mode()
             self.handle_user_input(step)
+            if profiler is not None:
+                profiler.step_completed(step)
+        if profiler is not None:
+            profiler.close()
+        if self.controller is not None:
+            self.controller.close()
+        train_dataset_generator.close()
+        if self.evaluator is not None:
+            self.evaluator.close(self)
@@ -2,13 +2,12 @@
 import numpy as np
 import torch
 import torchvision as torchvision
-from scipy.stats import norm
 from torch.utils.data import DataLoader
 
 from driving.models import Generator, Discriminator
 from driving.data import SteeringAngleDataset
 from srgan import Experiment
-from utility import seed_all, gpu, MixtureModel, to_image_range
+from utility import seed_all, gpu, to_image_range
 
 
 class DrivingExperiment(Experiment):
@@ -77,8 +76,7 @@ class DrivingExperiment(Experiment):
         fake_images_image = torchvision.utils.make_grid(to_image_range(fake_examples.data[:9]), normalize=True,
                                                         range=(0, 255), nrow=3)
         gan_summary_writer.add_image('Fake/Standard', fake_images_image.numpy())
-        z = torch.as_tensor(MixtureModel([norm(-settings.mean_offset, 1), norm(settings.mean_offset, 1)]
-                                         ).rvs(size=[settings.batch_size, G.input_size]).astype(np.float32)).to(gpu)
+        z = self.generator_input_distribution.rvs([settings.batch_size, G.input_size])
         fake_examples = G(z).to('cpu')
         fake_images_image = torchvision.utils.make_grid(to_image_range(fake_examples.data[:9]), normalize=True,
                                                         range=(0, 255), nrow=3)
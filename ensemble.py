@@ -0,0 +1,368 @@
+"""
+Code to train several trials of an experiment together as one vectorized ensemble.
+"""
+import datetime
+from contextlib import contextmanager
+from copy import copy
+
+import torch
+from torch.func import functional_call, grad, stack_module_state, vmap
+from torch.optim import Adam
+
+from utility import gpu, BatchPrefetcher
+
+# Settings which may differ between the trials of an ensemble. Each only scales a loss, or selects the labeled data.
+ensemble_setting_names = {'labeled_loss_multiplier', 'matching_loss_multiplier', 'contrasting_loss_multiplier',
+                          'srgan_loss_multiplier', 'dggan_loss_multiplier', 'gradient_penalty_multiplier',
+                          'labeled_dataset_seed'}
+# Settings which differ between the trials without affecting training.
+trial_setting_names = {'trial_name'}
+unsupported_setting_values = {'fused_discriminator_forward': False, 'reuse_generator_forward': False,
+                              'reuse_discriminator_fake_features': False, 'precision': 'fp32',
+                              'micro_batch_size': None, 'compile_mode': None, 'distributed_processes': None,
+                              'gradient_penalty_period': 1, 'gradient_penalty_fraction': 1.0}
+
+
+class ExperimentEnsemble:
+    """
+    Trains several trials of an experiment at once. The trials must share their architectures and differ only in the
+    settings of `ensemble_setting_names`. The parameters of each network are stacked over the trials, and each
+    training step runs the experiment's own loss calculations once, vectorized over the trials with `torch.func.vmap`.
+    As each trial's losses only depend on its own slice of the parameters (and Adam updates are elementwise), each
+    trial trains as it would alone. Summaries, validation summaries, and checkpoints are written by each trial's own
+    experiment, into its own trial directory. This suits small networks (e.g. the coefficient application), where
+    each trial alone would be dominated by Python and kernel launch overhead. The networks must not use batch norm.
+    """
+    def __init__(self, experiment_class, settings_list):
+        check_ensemble_settings(settings_list, experiment_class)
+        self.experiments = [experiment_class(settings) for settings in settings_list]
+        self.settings = settings_list[0]
+        self.template = None
+        self.stacked = {}
+        self.dnn_optimizer: Adam = None
+        self.d_optimizer: Adam = None
+        self.g_optimizer: Adam = None
+        self.trial_settings = {}
+        self.labeled_dimension = None
+
+    def train(self):
+        """Runs the training of all the trials."""
+        self.experiments = [experiment for experiment in self.experiments if experiment.training_setup()]
+        if not self.experiments:
+            return
+        self.template = self.experiments[0]
+        self.trial_settings = {name: torch.tensor([float(getattr(experiment.settings, name))
+                                                   for experiment in self.experiments], device=gpu)
+                               for name in sorted(ensemble_setting_names)
+                               if isinstance(getattr(self.settings, name), (int, float))}
+        for network_name in ['DNN', 'D', 'G']:
+            parameters, buffers = stack_module_state([getattr(experiment, network_name)
+                                                      for experiment in self.experiments])
+            self.stacked[network_name] = {**parameters, **buffers}
+        weight_decay = self.settings.weight_decay
+        self.dnn_optimizer = Adam(self.stacked['DNN'].values(), lr=self.settings.learning_rate,
+                                  weight_decay=weight_decay)
+        self.d_optimizer = Adam(self.stacked['D'].values(), lr=self.settings.learning_rate,
+                                weight_decay=weight_decay)
+        self.g_optimizer = Adam(self.stacked['G'].values(), lr=self.settings.learning_rate)
+        self.stack_optimizer_states()
+        self.training_loop()
+        self.unstack()
+        for experiment in self.experiments:
+            print('Completed {}'.format(experiment.trial_directory))
+            if experiment.settings.should_save_models:
+                experiment.save_models(step=experiment.settings.steps_to_run)
+            if experiment.checkpoint_writer is not None:
+                experiment.checkpoint_writer.close()
+
+    def training_loop(self):
+        """Runs the main training loop for all the trials."""
+        # A single labeled dataset is shared by all the trials, unless they select different labeled data.
+        if len({experiment.settings.labeled_dataset_seed for experiment in self.experiments}) == 1:
+            labeled_experiments = [self.template]
+            self.labeled_dimension = None
+        else:
+            labeled_experiments = self.experiments
+            self.labeled_dimension = 0
+        train_dataset_generators = [BatchPrefetcher(experiment.train_dataset_loader,
+                                                    depth=self.settings.prefetch_batches)
+                                    for experiment in labeled_experiments]
+        unlabeled_dataset_generator = BatchPrefetcher(self.template.unlabeled_dataset_loader,
+                                                      depth=self.settings.prefetch_batches)
+        step_time_start = datetime.datetime.now()
+        for step in range(self.template.starting_step, self.settings.steps_to_run):
+            self.adjust_learning_rate(step)
+            labeled_batches = [next(train_dataset_generator) for train_dataset_generator in train_dataset_generators]
+            if self.labeled_dimension is None:
+                labeled_examples, labels = labeled_batches[0]
+            else:
+                labeled_examples, labels = (torch.stack(tensors) for tensors in zip(*labeled_batches))
+            unlabeled_examples = next(unlabeled_dataset_generator)[0]
+            self.dnn_training_step(labeled_examples, labels, step)
+            self.gan_training_step(labeled_examples, labels, unlabeled_examples, step)
+            if self.template.gan_summary_writer.is_summary_step() or step == self.settings.steps_to_run - 1:
+                print('\rStep {}, {}...'.format(step, datetime.datetime.now() - step_time_start), end='')
+                step_time_start = datetime.datetime.now()
+                self.unstack()
+                for experiment in self.experiments:
+                    experiment.eval_mode()
+                    with torch.no_grad():
+                        experiment.validation_summaries(step)
+                    experiment.train_mode()
+            if self.settings.save_step_period and step % self.settings.save_step_period == 0 and step != 0:
+                self.unstack()
+                for experiment in self.experiments:
+                    experiment.save_models(step=step)
+        for train_dataset_generator in train_dataset_generators:
+            train_dataset_generator.close()
+        unlabeled_dataset_generator.close()
+
+    def adjust_learning_rate(self, step):
+        """Decays the DNN learning rate of all the trials, as `Experiment.adjust_learning_rate` does for one."""
+        lr = self.settings.learning_rate * (0.1 ** (step // 100000))
+        for param_group in self.dnn_optimizer.param_groups:
+            param_group['lr'] = lr
+
+    def dnn_training_step(self, labeled_examples, labels, step):
+        """Runs an individual round of DNN training for all the trials."""
+        for experiment in self.experiments:
+            experiment.dnn_summary_writer.step = step
+        with torch.no_grad():  # The gradients are taken by `grad`, so no graph is needed outside of it.
+            gradients, summaries = vmap(grad(self.dnn_loss, has_aux=True),
+                                        in_dims=(0, 0, self.labeled_dimension, self.labeled_dimension),
+                                        randomness='different')(self.stacked['DNN'], self.trial_settings,
+                                                                labeled_examples, labels)
+        apply_gradients(self.dnn_optimizer, self.stacked['DNN'], gradients)
+        self.write_summaries('dnn_summary_writer', summaries)
+
+    def dnn_loss(self, parameters, trial_settings, labeled_examples, labels):
+        """Calculates a trial's DNN loss, with the summary values as the auxiliary output."""
+        template = self.template
+        with self.trial(trial_settings, DNN=parameters):
+            dnn_loss = template.dnn_loss_calculation(labeled_examples, labels)
+            summaries = {'Discriminator/Labeled Loss': dnn_loss}
+            if getattr(template.DNN, 'features', None) is not None:
+                summaries['Feature Norm/Labeled'] = template.DNN.features.norm(dim=1).mean()
+        return dnn_loss, summaries
+
+    def gan_training_step(self, labeled_examples, labels, unlabeled_examples, step):
+        """Runs an individual round of GAN training for all the trials."""
+        for experiment in self.experiments:
+            experiment.gan_summary_writer.step = step
+        trial_count = len(self.experiments)
+        input_size = self.template.G.input_size
+        with torch.no_grad():  # The gradients are taken by `grad`, so no graph is needed outside of it.
+            z = self.template.generator_input_distribution.rvs([trial_count, unlabeled_examples.size(0), input_size])
+            fake_examples = vmap(self.generator_forward)(self.stacked['G'], z)
+            gradients, summaries = vmap(grad(self.discriminator_loss, has_aux=True),
+                                        in_dims=(0, 0, self.labeled_dimension, self.labeled_dimension, None, 0),
+                                        randomness='different')(self.stacked['D'], self.trial_settings,
+                                                                labeled_examples, labels, unlabeled_examples,
+                                                                fake_examples)
+        apply_gradients(self.d_optimizer, self.stacked['D'], gradients)
+        if step % self.settings.generator_training_step_period == 0:
+            with torch.no_grad():
+                z = torch.randn(trial_count, unlabeled_examples.size(0), input_size, device=gpu)
+                gradients, generator_summaries = vmap(grad(self.generator_loss, has_aux=True),
+                                                      in_dims=(0, 0, 0, 0, None),
+                                                      randomness='different')(self.stacked['G'], self.stacked['D'],
+                                                                              self.trial_settings, z,
+                                                                              unlabeled_examples)
+            apply_gradients(self.g_optimizer, self.stacked['G'], gradients)
+            summaries.update(generator_summaries)
+        self.write_summaries('gan_summary_writer', summaries)
+
+    def generator_forward(self, parameters, z):
+        """Runs a trial's generator."""
+        return functional_call(self.template.G, parameters, (z,))
+
+    def discriminator_loss(self, parameters, trial_settings, labeled_examples, labels, unlabeled_examples,
+                           fake_examples):
+        """Calculates a trial's discriminator loss, with the summary values as the auxiliary output."""
+        template = self.template
+        with self.trial(trial_settings, D=parameters, interpolate_gradients=self.interpolate_gradients):
+            labeled_loss = template.labeled_loss_calculation(labeled_examples, labels)
+            unlabeled_loss = template.unlabeled_loss_calculation(labeled_examples, unlabeled_examples)
+            fake_loss = template.fake_loss_calculation(unlabeled_examples, fake_examples)
+            summaries = {'Discriminator/Labeled Loss': labeled_loss,
+                         'Discriminator/Unlabeled Loss': unlabeled_loss,
+                         'Discriminator/Fake Loss': fake_loss}
+            if template.labeled_features is not None and template.unlabeled_features is not None:
+                summaries['Feature Norm/Labeled'] = template.labeled_features.mean(0).norm()
+                summaries['Feature Norm/Unlabeled'] = template.unlabeled_features.mean(0).norm()
+            gradient_penalty = template.gradient_penalty_calculation(fake_examples, unlabeled_examples)
+            summaries['Discriminator/Gradient Penalty'] = gradient_penalty
+            summaries['Discriminator/Gradient Norm'] = template.gradient_norm.mean()
+            loss = labeled_loss + unlabeled_loss + fake_loss + gradient_penalty
+        return loss, summaries
+
+    def interpolate_gradients(self, interpolates):
+        """Calculates the gradients of a trial's interpolate loss with respect to the interpolates."""
+        return grad(lambda interpolates_: self.template.interpolate_loss_calculation(interpolates_).sum())(
+            interpolates)
+
+    def generator_loss(self, parameters, discriminator_parameters, trial_settings, z, unlabeled_examples):
+        """Calculates a trial's generator loss, with the summary values as the auxiliary output."""
+        template = self.template
+        with self.trial(trial_settings, G=parameters, D=discriminator_parameters):
+            fake_examples = template.G(z)
+            generator_loss = template.generator_loss_calculation(fake_examples, unlabeled_examples)
+        return generator_loss, {'Generator/Loss': generator_loss}
+
+    @contextmanager
+    def trial(self, trial_settings, interpolate_gradients=None, **network_parameters):
+        """
+        Sets up the template experiment to calculate a single trial's losses, within the vectorized function. For the
+        duration of the context, the given networks are replaced with functional calls on the trial's parameters, and
+        the settings which vary between the trials are replaced with the trial's values.
+
+        :param trial_settings: The trial's values of the settings which vary between the trials.
+        :type trial_settings: dict[str, torch.Tensor]
+        :param interpolate_gradients: A replacement for the gradient penalty's gradient calculation.
+        :type interpolate_gradients: callable
+        :param network_parameters: The trial's parameters of each network, by network name.
+        :type network_parameters: dict[str, torch.Tensor]
+        """
+        template = self.template
+        settings = copy(template.settings)
+        for name, value in trial_settings.items():
+            setattr(settings, name, value)
+        replacements = {'settings': settings}
+        for network_name, parameters in network_parameters.items():
+            replacements[network_name] = FunctionalModuleForward(getattr(template, network_name), parameters)
+        if interpolate_gradients is not None:
+            replacements['interpolate_gradients'] = interpolate_gradients
+        originals = {name: template.__dict__[name] for name in replacements if name in template.__dict__}
+        template.__dict__.update(replacements)
+        try:
+            yield
+        finally:
+            for name in replacements:
+                del template.__dict__[name]
+            template.__dict__.update(originals)
+            # Clear the per-trial tensors the loss calculations stored, which only exist within the vectorization.
+            for module in [template.DNN, template.D, template.G]:
+                if getattr(module, 'features', None) is not None:
+                    module.features = None
+            template.labeled_features = None
+            template.unlabeled_features = None
+            template.fake_features = None
+            template.interpolates_features = None
+            template.gradient_norm = None
+
+    def write_summaries(self, summary_writer_name, summaries):
+        """Writes each trial's slice of the summary values to that trial's summary writer."""
+        for index, experiment in enumerate(self.experiments):
+            summary_writer = getattr(experiment, summary_writer_name)
+            if summary_writer.is_summary_step():
+                for name, values in summaries.items():
+                    summary_writer.add_scalar(name, values[index].item())
+
+    def unstack(self):
+        """Copies each trial's slice of the stacked parameters and optimizer states into the trial's experiment."""
+        with torch.no_grad():
+            for network_name in ['DNN', 'D', 'G']:
+                for index, experiment in enumerate(self.experiments):
+                    network = getattr(experiment, network_name)
+                    for name, tensor in list(network.named_parameters()) + list(network.named_buffers()):
+                        tensor.copy_(self.stacked[network_name][name][index])
+            for optimizer_name, network_name in [('dnn_optimizer', 'DNN'), ('d_optimizer', 'D'),
+                                                 ('g_optimizer', 'G')]:
+                stacked_optimizer = getattr(self, optimizer_name)
+                stacked_parameters = list(self.stacked[network_name].values())
+                for index, experiment in enumerate(self.experiments):
+                    optimizer = getattr(experiment, optimizer_name)
+                    for stacked_parameter, (name, parameter) in zip(stacked_parameters,
+                                                                    getattr(experiment, network_name).named_parameters()):
+                        stacked_state = stacked_optimizer.state.get(stacked_parameter)
+                        if stacked_state:
+                            optimizer.state[parameter] = {key: (value[index].clone() if value.dim() > 0
+                                                                else value.clone())
+                                                          for key, value in stacked_state.items()}
+                    for param_group, stacked_param_group in zip(optimizer.param_groups,
+                                                                stacked_optimizer.param_groups):
+                        param_group['lr'] = stacked_param_group['lr']
+
+    def stack_optimizer_states(self):
+        """Stacks the trials' optimizer states (e.g. when continuing from checkpoints) into the stacked optimizers."""
+        for optimizer_name, network_name in [('dnn_optimizer', 'DNN'), ('d_optimizer', 'D'), ('g_optimizer', 'G')]:
+            stacked_optimizer = getattr(self, optimizer_name)
+            trial_parameters = [list(getattr(experiment, network_name).parameters())
+                                for experiment in self.experiments]
+            for parameter_index, stacked_parameter in enumerate(self.stacked[network_name].values()):
+                states = [getattr(experiment, optimizer_name).state.get(parameters[parameter_index])
+                          for experiment, parameters in zip(self.experiments, trial_parameters)]
+                if all(states):
+                    stacked_optimizer.state[stacked_parameter] = {
+                        key: (torch.stack([state[key] for state in states]) if states[0][key].dim() > 0
+                              else states[0][key].clone())
+                        for key in states[0]}
+
+
+class FunctionalModuleForward:
+    """
+    Calls a module with the given parameters (and buffers) in place of its own. Any other attribute access is passed
+    through to the module.
+    """
+    def __init__(self, module, parameters):
+        self.module = module
+        self.parameters = parameters
+
+    def __call__(self, *args, **kwargs):
+        return functional_call(self.module, self.parameters, args, kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+
+def check_ensemble_settings(settings_list, experiment_class):
+    """
+    Checks that the trials of the settings can be trained together as an ensemble.
+
+    :param settings_list: The settings of each trial.
+    :type settings_list: list[settings.Settings]
+    :param experiment_class: The class of the experiment of the trials.
+    :type experiment_class: type
+    """
+    # Only the coefficient experiments have the small, batch norm free networks and (example, label) batches needed.
+    from coefficient.srgan import CoefficientExperiment
+    if not issubclass(experiment_class, CoefficientExperiment):
+        raise ValueError(f'Ensembles can only be trained for the coefficient experiments, not {experiment_class}.')
+    for name, value in unsupported_setting_values.items():
+        if any(getattr(settings, name) != value for settings in settings_list):
+            raise ValueError(f'Ensembles cannot be trained with `{name}` set.')
+    differing_names = {name for settings in settings_list[1:] for name, value in vars(settings).items()
+                       if value != getattr(settings_list[0], name)}
+    differing_names -= ensemble_setting_names | trial_setting_names
+    if differing_names:
+        raise ValueError(f'Ensemble trials can only differ in {sorted(ensemble_setting_names)}, '
+                         f'but also differ in {sorted(differing_names)}.')
+
+
+def group_ensemble_settings(settings_list):
+    """
+    Groups the settings into lists of trials which can be trained together as an ensemble.
+
+    :param settings_list: The settings of each trial.
+    :type settings_list: list[settings.Settings]
+    :return: The groups of settings.
+    :rtype: list[list[settings.Settings]]
+    """
+    groups = []
+    for settings in settings_list:
+        for group in groups:
+            if all(value == getattr(group[0], name) for name, value in vars(settings).items()
+                   if name not in ensemble_setting_names | trial_setting_names):
+                group.append(settings)
+                break
+        else:
+            groups.append([settings])
+    return groups
+
+
+def apply_gradients(optimizer, parameters, gradients):
+    """Steps the optimizer with the given gradients for the stacked parameters."""
+    for name, parameter in parameters.items():
+        if parameter.requires_grad:
+            parameter.grad = gradients[name]
+    optimizer.step()
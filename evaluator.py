@@ -0,0 +1,151 @@
+"""
+Code to run an experiment's validation summaries in a background process.
+"""
+import queue
+
+import torch
+import torch.multiprocessing as multiprocessing
+
+
+class AsynchronousEvaluator:
+    """
+    Runs an experiment's validation summaries in a background process, so training continues while they run. At each
+    summary step, the network weights are snapshotted to the CPU and queued for the worker process, which holds its
+    own copy of the experiment (datasets, networks, and summary writers for the same trial directory). The scalars
+    the worker writes are sent back, and added to the latest scalars of the experiment's summary writers (e.g. to
+    score its checkpoints).
+    """
+    def __init__(self, experiment):
+        settings = experiment.settings
+        if settings.evaluation_queue_policy not in ('block', 'drop'):
+            raise ValueError(f'Unknown evaluation queue policy `{settings.evaluation_queue_policy}`.')
+        self.queue_policy = settings.evaluation_queue_policy
+        context = multiprocessing.get_context('spawn')
+        self.snapshot_queue = context.Queue(maxsize=settings.evaluation_queue_size)
+        self.result_queue = context.Queue()
+        self.process = context.Process(target=evaluation_worker, daemon=True,
+                                       args=(type(experiment), settings, experiment.trial_directory,
+                                             self.snapshot_queue, self.result_queue))
+        self.process.start()
+        self.dropped_steps = []
+        self.pending_steps = []  # The queued steps whose scalars have not been received yet, in order.
+
+    def submit(self, experiment, step, block=False):
+        """
+        Queues the experiment's current weights for the validation summaries of the given step, after receiving the
+        scalars of the summaries already written.
+
+        :param experiment: The experiment being trained.
+        :type experiment: srgan.Experiment
+        :param step: The step the summaries are written for.
+        :type step: int
+        :param block: Whether to wait for space in the queue, regardless of the queue policy.
+        :type block: bool
+        :return: Whether the snapshot was queued (rather than dropped).
+        :rtype: bool
+        """
+        self.receive_scalars(experiment)
+        if self.queue_policy == 'drop' and not block and self.snapshot_queue.full():
+            self.dropped_steps.append(step)
+            return False
+        snapshot = {}
+        for network_name in ['DNN', 'D', 'G']:
+            network = getattr(experiment, network_name)
+            if network is not None:
+                snapshot[network_name] = {key: value.detach().to('cpu', copy=True)
+                                          for key, value in network.state_dict().items()}
+        while True:
+            self.check_worker()
+            try:
+                self.snapshot_queue.put((step, snapshot), timeout=1)
+                self.pending_steps.append(step)
+                return True
+            except queue.Full:
+                continue
+
+    def receive_scalars(self, experiment):
+        """
+        Adds the scalars the worker has written so far to the latest scalars of the experiment's summary writers, and
+        tells the experiment of each step evaluated.
+
+        :param experiment: The experiment being trained.
+        :type experiment: srgan.Experiment
+        """
+        while True:
+            try:
+                step, scalars = self.result_queue.get_nowait()
+            except queue.Empty:
+                return
+            for writer_name, writer_scalars in scalars.items():
+                summary_writer = getattr(experiment, writer_name)
+                for tag, value in writer_scalars.items():
+                    summary_writer.latest_scalars[tag] = value
+                    summary_writer.latest_scalar_steps[tag] = step
+            self.pending_steps.remove(step)
+            experiment.evaluation_received(step)
+
+    def check_worker(self):
+        """Raises an error if the worker process has stopped."""
+        if not self.process.is_alive():
+            raise RuntimeError(f'Evaluation worker exited with code {self.process.exitcode}.')
+
+    def close(self, experiment):
+        """
+        Waits for the queued summaries to be written and their scalars received, then stops the worker process.
+
+        :param experiment: The experiment being trained.
+        :type experiment: srgan.Experiment
+        """
+        self.check_worker()
+        self.snapshot_queue.put(None)
+        while self.process.is_alive():  # The worker only exits once its results are read from the queue.
+            self.receive_scalars(experiment)
+            self.process.join(timeout=0.1)
+        self.receive_scalars(experiment)
+        if self.dropped_steps:
+            print(f'\rEvaluation skipped for {len(self.dropped_steps)} summary steps while the queue was full.')
+
+
+def evaluation_worker(experiment_class, settings, trial_directory, snapshot_queue, result_queue):
+    """
+    Runs the validation summaries for each snapshot from the queue until given `None`, sending back the scalars
+    written for each step.
+
+    :param experiment_class: The class of the experiment being trained.
+    :type experiment_class: type
+    :param settings: The settings of the experiment.
+    :type settings: settings.Settings
+    :param trial_directory: The directory the experiment is writing to.
+    :type trial_directory: str
+    :param snapshot_queue: The queue of steps and network state dicts.
+    :type snapshot_queue: multiprocessing.Queue
+    :param result_queue: The queue of steps and the scalars written for them, by summary writer attribute name.
+    :type result_queue: multiprocessing.Queue
+    """
+    experiment = experiment_class(settings)
+    experiment.trial_directory = trial_directory
+    experiment.prepare_summary_writers(filename_suffix='.evaluation')
+    experiment.dataset_setup()
+    experiment.model_setup()
+    experiment.gpu_mode()
+    experiment.eval_mode()
+    summary_writers = {writer_name: getattr(experiment, writer_name)
+                       for writer_name in ['dnn_summary_writer', 'gan_summary_writer']
+                       if getattr(experiment, writer_name) is not None}
+    while True:
+        item = snapshot_queue.get()
+        if item is None:
+            break
+        step, snapshot = item
+        for network_name, state_dict in snapshot.items():
+            getattr(experiment, network_name).load_state_dict(state_dict)
+        for summary_writer in summary_writers.values():
+            summary_writer.step = step
+        with torch.no_grad():
+            experiment.validation_summaries(step)
+        scalars = {writer_name: {tag: float(value) for tag, value in summary_writer.latest_scalars.items()
+                                 if summary_writer.latest_scalar_steps[tag] == step}
+                   for writer_name, summary_writer in summary_writers.items()}
+        result_queue.put((step, scalars))
+    for summary_writer in summary_writers.values():
+        summary_writer.close()
@@ -0,0 +1,207 @@
+"""
+Code to profile a window of training steps, layer by layer.
+"""
+import os
+from collections import defaultdict
+
+import torch
+from torch.autograd.profiler import record_function
+from torch.profiler import profile, ProfilerActivity
+
+module_range_prefix = 'Module: '
+backward_event_prefix = 'autograd::engine::evaluate_function: '
+
+
+class TrainingProfiler:
+    """
+    Runs the torch profiler over a window of training steps. Each module of the networks (down to `module_depth`
+    levels, e.g. `DNN.dense_blocks.denseblock3` or `D.map_module1`) is marked in the trace with a named range around
+    its forward pass. Backward operations are attributed to the module whose forward created them, by their autograd
+    sequence numbers. At the end of the window, a Chrome trace and a summary of the modules ranked by total time are
+    written to the trial directory.
+    """
+    def __init__(self, experiment, module_depth=2):
+        start_step, step_count = experiment.settings.profile_steps
+        self.start_step = start_step
+        self.stop_step = start_step + step_count - 1
+        self.experiment = experiment
+        self.module_depth = module_depth
+        self.use_cuda = torch.cuda.is_available()
+        self.profile = None
+        self.hook_handles = []
+        self.open_ranges = defaultdict(list)
+
+    def step_started(self, step):
+        """
+        Starts profiling if the step is the first of the window.
+
+        :param step: The current step of the program.
+        :type step: int
+        """
+        if step != self.start_step:
+            return
+        activities = [ProfilerActivity.CPU]
+        if self.use_cuda:
+            activities.append(ProfilerActivity.CUDA)
+        self.add_module_hooks()
+        self.profile = profile(activities=activities, profile_memory=True, record_shapes=True)
+        self.profile.start()
+
+    def step_completed(self, step):
+        """
+        Stops profiling and writes the results if the step is the last of the window.
+
+        :param step: The current step of the program.
+        :type step: int
+        """
+        if step == self.stop_step:
+            self.close()
+
+    def close(self):
+        """Stops profiling (if profiling) and writes the results."""
+        if self.profile is None:
+            return
+        if self.use_cuda:
+            torch.cuda.synchronize()
+        self.profile.stop()
+        self.remove_module_hooks()
+        trace_path = os.path.join(self.experiment.trial_directory, 'profile_trace.json')
+        self.profile.export_chrome_trace(trace_path)
+        summary_path = os.path.join(self.experiment.trial_directory, 'profile_summary.txt')
+        with open(summary_path, 'w') as summary_file:
+            summary_file.write(self.summary())
+        print(f'\rProfile of steps {self.start_step} to {self.stop_step} written to {summary_path}.')
+        self.profile = None
+
+    def add_module_hooks(self):
+        """Adds the hooks which mark the forward pass of each module in the trace."""
+        for network_name in ['DNN', 'D', 'G']:
+            network = getattr(self.experiment, network_name)
+            if network is None:
+                continue
+            for module_name, module in network.named_modules(prefix=network_name):
+                if module_name.count('.') > self.module_depth:
+                    continue
+                range_name = module_range_prefix + module_name
+                self.hook_handles.append(module.register_forward_pre_hook(
+                    lambda module_, input_, range_name_=range_name: self.open_range(module_, range_name_)))
+                self.hook_handles.append(module.register_forward_hook(
+                    lambda module_, input_, output: self.close_range(module_)))
+
+    def remove_module_hooks(self):
+        """Removes the module hooks."""
+        for handle in self.hook_handles:
+            handle.remove()
+        self.hook_handles = []
+        self.open_ranges.clear()
+
+    def open_range(self, module, range_name):
+        """Opens the trace range of a module's forward pass."""
+        range_ = record_function(range_name)
+        range_.__enter__()
+        self.open_ranges[module].append(range_)
+
+    def close_range(self, module):
+        """Closes the trace range of a module's forward pass."""
+        self.open_ranges[module].pop().__exit__(None, None, None)
+
+    def event_time(self, event):
+        """The total time of a profiler event in milliseconds, on the GPU if one is used."""
+        if self.use_cuda:
+            return event.device_time_total / 1000
+        return event.cpu_time_total / 1000
+
+    def summary(self):
+        """
+        Creates the text summary of the profile.
+
+        :return: The module table ranked by total time, followed by the operator table.
+        :rtype: str
+        """
+        events = self.profile.events()
+        forward_times = defaultdict(float)
+        backward_times = defaultdict(float)
+        memory_usages = defaultdict(int)
+        call_counts = defaultdict(int)
+        sequence_modules = {}
+        for event in events:
+            if event.name.startswith(module_range_prefix):
+                module_name = event.name[len(module_range_prefix):]
+                forward_times[module_name] += self.event_time(event)
+                call_counts[module_name] += 1
+                memory_usages[module_name] += event.cpu_memory_usage + event.device_memory_usage
+                for descendant in event_descendants(event):
+                    if descendant.sequence_nr >= 0:
+                        sequence_modules.setdefault((descendant.thread, descendant.sequence_nr),
+                                                    innermost_module_name(descendant))
+        for event in events:
+            if event.name.startswith(backward_event_prefix) and event.sequence_nr >= 0:
+                module_name = sequence_modules.get((event.fwd_thread, event.sequence_nr))
+                if module_name is None:
+                    continue
+                for owner_name in module_ancestor_names(module_name, forward_times):
+                    backward_times[owner_name] += self.event_time(event)
+                    memory_usages[owner_name] += event.cpu_memory_usage + event.device_memory_usage
+        module_names = sorted(forward_times, key=lambda name: forward_times[name] + backward_times[name],
+                              reverse=True)
+        device = 'CUDA' if self.use_cuda else 'CPU'
+        lines = [f'Steps {self.start_step} to {self.stop_step}, {device} time.',
+                 f'{"Module":<48} {"Calls":>7} {"Forward (ms)":>13} {"Backward (ms)":>14} {"Total (ms)":>11} '
+                 f'{"Memory (MB)":>12}']
+        for module_name in module_names:
+            lines.append(f'{module_name:<48} {call_counts[module_name]:>7} {forward_times[module_name]:>13.3f} '
+                         f'{backward_times[module_name]:>14.3f} '
+                         f'{forward_times[module_name] + backward_times[module_name]:>11.3f} '
+                         f'{memory_usages[module_name] / 2 ** 20:>12.2f}')
+        sort_by = 'self_cuda_time_total' if self.use_cuda else 'self_cpu_time_total'
+        operator_table = self.profile.key_averages().table(sort_by=sort_by, row_limit=30)
+        return '\n'.join(lines) + '\n\n' + operator_table + '\n'
+
+
+def event_descendants(event):
+    """
+    Finds an event and all the events nested within it.
+
+    :param event: The profiler event.
+    :type event: torch.autograd.profiler_util.FunctionEvent
+    :return: The event and its descendants.
+    :rtype: list[torch.autograd.profiler_util.FunctionEvent]
+    """
+    descendants = [event]
+    index = 0
+    while index < len(descendants):
+        descendants.extend(descendants[index].cpu_children)
+        index += 1
+    return descendants
+
+
+def innermost_module_name(event):
+    """
+    Finds the name of the innermost module whose forward range contains the event.
+
+    :param event: The profiler event.
+    :type event: torch.autograd.profiler_util.FunctionEvent
+    :return: The module name, or None if the event is outside all module ranges.
+    :rtype: str
+    """
+    while event is not None:
+        if event.name.startswith(module_range_prefix):
+            return event.name[len(module_range_prefix):]
+        event = event.cpu_parent
+    return None
+
+
+def module_ancestor_names(module_name, module_names):
+    """
+    Finds the names of a module and its profiled parent modules (e.g. `D.dense_blocks.denseblock1` and `D`).
+
+    :param module_name: The name of the module.
+    :type module_name: str
+    :param module_names: The names of the profiled modules.
+    :type module_names: collections.abc.Container[str]
+    :return: The names of the module and its parent modules.
+    :rtype: list[str]
+    """
+    name_parts = module_name.split('.')
+    names = ['.'.join(name_parts[:index]) for index in range(1, len(name_parts) + 1)]
+    return [name for name in names if name in module_names]
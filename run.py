@@ -14,7 +14,9 @@ from crowd.dnn import CrowdDnnExperiment
 from crowd.sgan import CrowdSganExperiment
 from crowd.srgan import CrowdExperiment
 from driving.srgan import DrivingExperiment
+from ensemble import ExperimentEnsemble, group_ensemble_settings
 from settings import Settings, convert_to_settings_list, ApplicationName, MethodName
+from sweep import SweepExecutor
 from utility import seed_all, clean_scientific_notation, abs_plus_one_sqrt_mean_neg, square_mean, abs_mean_neg, \
     abs_plus_one_log_neg, abs_plus_one_log_mean_neg, norm_mean, abs_mean
 
@@ -23,6 +25,11 @@ torch.backends.cudnn.fastest = True
 
 application_name = ApplicationName.age
 method_name = MethodName.srgan
+concurrent_trials = 1  # Trials run at once, each in its own process. 1 runs them one after another in this process.
+cores_per_trial = None  # CPU cores (and torch threads) for each concurrent trial. None splits the cores evenly.
+data_workers_per_trial = None  # Data loader workers for each concurrent trial. None keeps the setting.
+pin_trial_cores = False  # Restricts each concurrent trial's process to its own cores.
+ensemble_trials = False  # Trains trials differing only in loss multipliers or data seed together (coefficient only).
 
 settings_ = Settings()
 if application_name == ApplicationName.age:
@@ -78,35 +85,52 @@ settings_.matching_distance_function = abs_mean
 settings_.continue_existing_experiments = False
 settings_.save_step_period = 20000
 settings_.local_setup()
-settings_list = convert_to_settings_list(settings_, shuffle=True)
-seed_all(0)
-previous_trial_directory = None
-for settings_ in settings_list:
+
+
+def create_trial_name(settings):
+    """Creates the name of a trial from its settings."""
     trial_name = f'base'
-    trial_name += f' {settings_.matching_distance_function.__name__} {settings_.contrasting_distance_function.__name__}'
+    trial_name += f' {settings.matching_distance_function.__name__}'
+    trial_name += f' {settings.contrasting_distance_function.__name__}'
     trial_name += f' {method_name.value}' if method_name != MethodName.srgan else ''
     trial_name += f' {application_name.value}'
-    trial_name += f' {settings_.map_directory_name}' if application_name == ApplicationName.crowd else ''
-    trial_name += f' {settings_.crowd_dataset.value}' if application_name == ApplicationName.crowd else ''
+    trial_name += f' {settings.map_directory_name}' if application_name == ApplicationName.crowd else ''
+    trial_name += f' {settings.crowd_dataset.value}' if application_name == ApplicationName.crowd else ''
     if method_name != MethodName.dnn:
-        if application_name == ApplicationName.crowd and settings_.crowd_dataset == CrowdDataset.world_expo:
-            trial_name += f' c{settings_.number_of_cameras}i{settings_.number_of_images_per_camera}'
+        if application_name == ApplicationName.crowd and settings.crowd_dataset == CrowdDataset.world_expo:
+            trial_name += f' c{settings.number_of_cameras}i{settings.number_of_images_per_camera}'
         else:
-            trial_name += f' le{settings_.labeled_dataset_size}'
-            trial_name += f' ue{settings_.unlabeled_dataset_size}'
-    trial_name += f' ul{settings_.matching_loss_multiplier:e}'
-    trial_name += f' fl{settings_.contrasting_loss_multiplier:e}'
-    trial_name += f' gp{settings_.gradient_penalty_multiplier:e}'
-    trial_name += f' lr{settings_.learning_rate:e}'
-    trial_name += f' mm{settings_.map_multiplier:e}' if application_name == ApplicationName.crowd else ''
-    trial_name += f' ls{settings_.labeled_dataset_seed}'
-    trial_name += f' bs{settings_.batch_size}'
-    trial_name += ' l' if settings_.load_model_path and not settings_.continue_existing_experiments else ''
-    settings_.trial_name = clean_scientific_notation(trial_name)
-    if previous_trial_directory and settings_.continue_from_previous_trial:
-        settings_.load_model_path = previous_trial_directory
-    experiment = Experiment(settings_)
-    experiment.train()
-    previous_trial_directory = experiment.trial_directory
-    if experiment.signal_quit:
-        break
+            trial_name += f' le{settings.labeled_dataset_size}'
+            trial_name += f' ue{settings.unlabeled_dataset_size}'
+    trial_name += f' ul{settings.matching_loss_multiplier:e}'
+    trial_name += f' fl{settings.contrasting_loss_multiplier:e}'
+    trial_name += f' gp{settings.gradient_penalty_multiplier:e}'
+    trial_name += f' lr{settings.learning_rate:e}'
+    trial_name += f' mm{settings.map_multiplier:e}' if application_name == ApplicationName.crowd else ''
+    trial_name += f' ls{settings.labeled_dataset_seed}'
+    trial_name += f' bs{settings.batch_size}'
+    trial_name += ' l' if settings.load_model_path and not settings.continue_existing_experiments else ''
+    return clean_scientific_notation(trial_name)
+
+
+if __name__ == '__main__':
+    settings_list = convert_to_settings_list(settings_, shuffle=True)
+    seed_all(0)
+    for settings_ in settings_list:
+        settings_.trial_name = create_trial_name(settings_)
+    if ensemble_trials:
+        for settings_group in group_ensemble_settings(settings_list):
+            ExperimentEnsemble(Experiment, settings_group).train()
+    elif concurrent_trials > 1:
+        SweepExecutor(Experiment, concurrent_trials, cores_per_trial=cores_per_trial,
+                      data_workers_per_trial=data_workers_per_trial, pin_cores=pin_trial_cores).run(settings_list)
+    else:
+        previous_trial_directory = None
+        for settings_ in settings_list:
+            if previous_trial_directory and settings_.continue_from_previous_trial:
+                settings_.load_model_path = previous_trial_directory
+            experiment = Experiment(settings_)
+            experiment.train()
+            previous_trial_directory = experiment.trial_directory
+            if experiment.signal_quit:
+                break
@@ -8,6 +8,8 @@ from enum import Enum
 
 from utility import abs_plus_one_sqrt_mean_neg, abs_mean
 
+tuple_setting_names = {'profile_steps'}  # Settings whose tuple values are a single setting, rather than a list.
+
 
 class Settings:
     """Represents the settings for a given run of SRGAN."""
@@ -31,6 +33,8 @@ class Settings:
         self.dggan_loss_multiplier = 1e1
         self.gradient_penalty_on = True
         self.gradient_penalty_multiplier = 1e1
+        self.gradient_penalty_period = 1  # Steps between gradient penalties, each scaled by the period (lazy).
+        self.gradient_penalty_fraction = 1.0  # Fraction of the batch's examples interpolated for the penalty.
         self.mean_offset = 0
         self.labeled_loss_order = 2
         self.generator_training_step_period = 1
@@ -48,6 +52,31 @@ class Settings:
         self.continue_from_previous_trial = False
         self.continue_existing_experiments = False
         self.save_step_period = None
+        self.checkpoints_to_keep = None  # Latest `model_{step}.pth` files kept, plus the best. None keeps all.
+        self.best_checkpoint_scalar = '1 Validation Error/MAE'  # Summary scalar (lower is better) for the best.
+
+        # Performance options.
+        self.fused_discriminator_forward = False
+        self.reuse_generator_forward = False  # Generator update uses the fake examples from the discriminator update.
+        self.reuse_discriminator_fake_features = False  # Generator loss taken from the discriminator's fake forward.
+        self.precision = 'fp32'  # One of 'fp32', 'bf16', or 'fp16'.
+        self.micro_batch_size = None  # Examples per forward pass, accumulating gradients over the batch. None for all.
+        self.compile_mode = None  # A `torch.compile` mode for all networks, or a dict from network name to mode.
+        self.concurrent_dnn_training = False  # Runs the DNN step on its own thread alongside the GAN step.
+        self.dnn_thread_count = None  # Intra-op threads for the concurrent DNN step. None keeps the default.
+        self.asynchronous_evaluation = False  # Runs the validation summaries in a background process.
+        self.evaluation_queue_size = 1  # Weight snapshots waiting for the background evaluation.
+        self.evaluation_queue_policy = 'block'  # When the queue is full, 'block' training or 'drop' the snapshot.
+        self.phase_timers = True  # Writes the average time per step spent in each phase of training.
+        self.synchronize_phase_timers = False  # Waits for the GPU at phase boundaries, for accurate phase times.
+        self.prefetch_batches = 2  # Batches loaded ahead on a background thread. 0 loads synchronously.
+        self.profile_steps = None  # A (start step, step count) window to profile, written to the trial directory.
+        self.control_port = None  # Localhost port for the control commands and live metrics. 0 picks a free port.
+        self.distributed_processes = None  # Data-parallel (gloo) processes per host. `batch_size` is per process.
+        self.distributed_hosts = 1  # Hosts each launching `distributed_processes` processes with the same settings.
+        self.distributed_host_index = 0  # The index of this host. Host 0 runs rank 0, which writes the summaries.
+        self.distributed_address = '127.0.0.1:29500'  # The address and port of host 0, for the process group.
+        self.global_feature_means = False  # Feature distance losses use the feature means of all processes' batches.
 
         # Coefficient application only.
         self.hidden_size = 10
@@ -62,6 +91,10 @@ class Settings:
         self.label_patch_size = 224
         self.map_multiplier = 1e-6
         self.map_directory_name = 'i1nn_maps'
+        self.memory_map_cache_size = 48  # Memory-mapped files kept open per data loader worker, 3 per image.
+        self.crowd_data_storage = 'npy'  # Reads the `.npy` files, or 'packed' shards (see crowd/packed_data.py).
+        self.patches_per_image_visit = None  # Training patches drawn per image visit (None draws each from any image).
+        self.pretrained_weights = True  # Starts the DenseNets from the ImageNet weights (downloaded when first used).
 
         # SGAN models only.
         self.number_of_bins = 10
@@ -93,7 +126,8 @@ def convert_to_settings_list(settings, shuffle=True):
         for settings in settings_list:
             contains_list = False
             for attribute_name, attribute_value in vars(settings).items():
-                if isinstance(attribute_value, (list, tuple)):
+                if isinstance(attribute_value, list) or (isinstance(attribute_value, tuple) and
+                                                         attribute_name not in tuple_setting_names):
                     for value in attribute_value:
                         settings_copy = deepcopy(settings)
                         setattr(settings_copy, attribute_name, value)
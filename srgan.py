@@ -4,21 +4,31 @@ Regression semi-supervised GAN code.
 import datetime
 import os
 import re
-import select
-import sys
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 
-import numpy as np
-from scipy.stats import norm
+from torch.amp import GradScaler
 from torch.nn import Module
 from torch.optim import Adam
 from torch.optim.optimizer import Optimizer
 import torch
 from torch.utils.data import Dataset, DataLoader
 from torch import Tensor
-
+from torch.distributions import Normal
+
+from control import TrainingController
+from checkpointer import CheckpointWriter, latest_checkpoint_file_name, load_checkpoint_entries
+from distributed import launch_distributed_training, shard_data_loader, broadcast_module_state, \
+    all_reduce_gradients, global_batch_mean
+from evaluator import AsynchronousEvaluator
+from profiler import TrainingProfiler
 from settings import Settings
-from utility import SummaryWriter, gpu, make_directory_name_unique, MixtureModel, seed_all, norm_squared, square_mean
+from utility import SummaryWriter, gpu, make_directory_name_unique, TorchMixtureModel, seed_all, norm_squared,\
+    square_mean, BatchPrefetcher, PhaseTimer
+
+precision_data_types = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+optimizer_names_by_network = {'DNN': 'dnn_optimizer', 'D': 'd_optimizer', 'G': 'g_optimizer'}
 
 
 class Experiment(ABC):
@@ -41,23 +51,102 @@ class Experiment(ABC):
         self.G: Module = None
         self.g_optimizer: Optimizer = None
         self.signal_quit = False
+        self.summary_requested = False
+        self.controller: TrainingController = None
         self.starting_step = 0
+        self.checkpoint_writer: CheckpointWriter = None
+        self.evaluator: AsynchronousEvaluator = None
+        self.rank = torch.distributed.get_rank() if torch.distributed.is_initialized() else 0
+        self.world_size = torch.distributed.get_world_size() if torch.distributed.is_initialized() else 1
+        self.dnn_process_group = None
 
         self.labeled_features = None
         self.unlabeled_features = None
         self.fake_features = None
         self.interpolates_features = None
         self.gradient_norm = None
+        self.gradient_penalty = None  # The latest, as summary steps need not be penalty steps.
+        self.generator_input_distribution = TorchMixtureModel([Normal(-float(settings.mean_offset), 1.),
+                                                               Normal(float(settings.mean_offset), 1.)])
+        if settings.precision not in precision_data_types:
+            raise ValueError(f'Unknown precision `{settings.precision}`. Use one of {list(precision_data_types)}.')
+        if settings.micro_batch_size is not None and (settings.fused_discriminator_forward or
+                                                      settings.reuse_discriminator_fake_features):
+            raise ValueError('Micro-batching cannot be combined with the fused discriminator forward options.')
+        if settings.micro_batch_size is not None and settings.concurrent_dnn_training:
+            # The micro-batched backward replays the global random state, which the GAN step draws from concurrently.
+            raise ValueError('Micro-batching cannot be combined with concurrent DNN training.')
+        if settings.gradient_penalty_period < 1 or not 0 < settings.gradient_penalty_fraction <= 1:
+            raise ValueError('The gradient penalty period must be at least 1, and its fraction in (0, 1].')
+        # Loss scaling is only needed for fp16, as bf16 has the exponent range of fp32.
+        self.dnn_gradient_scaler = GradScaler(gpu.type, enabled=settings.precision == 'fp16')
+        self.gan_gradient_scaler = GradScaler(gpu.type, enabled=settings.precision == 'fp16')
+        self.timer = PhaseTimer(enabled=settings.phase_timers, synchronize=settings.synchronize_phase_timers)
 
     def train(self):
         """
         Run the SRGAN training for the experiment.
         """
+        if self.settings.distributed_processes is not None and not torch.distributed.is_initialized():
+            self.trial_directory = launch_distributed_training(type(self), self.settings)
+            return
+        if not self.training_setup():
+            return
+        self.training_loop()
+
+        if self.rank == 0:
+            print('Completed {}'.format(self.trial_directory))
+        if self.settings.should_save_models:
+            self.save_models(step=self.settings.steps_to_run)
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.close()
+
+    def training_setup(self):
+        """
+        Prepares the trial directory, summary writers, datasets, networks, and optimizers for training.
+
+        :return: Whether the trial should be trained (rather than skipped as already completed).
+        :rtype: bool
+        """
+        if self.world_size == 1:
+            if not self.prepare_trial_directory():
+                return False
+        else:  # Rank 0 alone decides the trial directory, as the other ranks would see it being created.
+            trial_state = [None, None, None]
+            if self.rank == 0 and self.prepare_trial_directory():
+                trial_state = [self.trial_directory, self.settings.load_model_path,
+                               self.settings.continue_existing_experiments]
+            torch.distributed.broadcast_object_list(trial_state)
+            self.trial_directory, self.settings.load_model_path, self.settings.continue_existing_experiments = \
+                trial_state
+            if self.trial_directory is None:
+                return False
+            self.dnn_process_group = torch.distributed.new_group()  # The DNN step may run on its own thread.
+        self.prepare_summary_writers()
+        seed_all(0)
+
+        self.dataset_setup()
+        self.model_setup()
+        self.prepare_optimizers()
+        self.gpu_mode()  # Before loading, so the memory-mapped checkpoint tensors are copied once, onto the device.
+        self.load_models()
+        self.train_mode()
+        if self.world_size > 1:
+            self.distributed_setup()
+        self.compile_networks()
+        return True
+
+    def prepare_trial_directory(self):
+        """
+        Chooses and creates the trial directory, or finds the existing one when continuing an experiment.
+
+        :return: Whether the trial should be trained (rather than skipped as already completed).
+        :rtype: bool
+        """
         self.trial_directory = os.path.join(self.settings.logs_directory, self.settings.trial_name)
-        if (self.settings.skip_completed_experiment and os.path.exists(self.trial_directory) and
-                '/check' not in self.trial_directory and not self.settings.continue_existing_experiments):
+        if self.completed_trial_exists(self.settings):
             print('`{}` experiment already exists. Skipping...'.format(self.trial_directory))
-            return
+            return False
         if not self.settings.continue_existing_experiments:
             self.trial_directory = make_directory_name_unique(self.trial_directory)
         else:
@@ -69,21 +158,51 @@ class Experiment(ABC):
                 self.settings.continue_existing_experiments = False
         print(self.trial_directory)
         os.makedirs(os.path.join(self.trial_directory, self.settings.temporary_directory), exist_ok=True)
-        self.prepare_summary_writers()
-        seed_all(0)
+        return True
 
-        self.dataset_setup()
-        self.model_setup()
-        self.prepare_optimizers()
-        self.load_models()
-        self.gpu_mode()
-        self.train_mode()
+    def distributed_setup(self):
+        """
+        Prepares a data-parallel rank for training. The ranks start from rank 0's networks, each trains on its own
+        shard of the labeled and unlabeled data, and each draws its own generator inputs and data orders. The datasets
+        and networks are created before this with the same seed on every rank, so the shards are consistent.
+        """
+        self.train_dataset_loader = shard_data_loader(self.train_dataset_loader, self.rank, self.world_size)
+        if self.unlabeled_dataset_loader is not None:
+            self.unlabeled_dataset_loader = shard_data_loader(self.unlabeled_dataset_loader, self.rank,
+                                                              self.world_size)
+        for network_name in ['DNN', 'D', 'G']:
+            network = getattr(self, network_name)
+            if network is not None:
+                broadcast_module_state(network)
+        seed_all(self.rank)
+
+    def all_reduce_gradients(self, network_name, group=None):
+        """
+        Averages the named network's gradients over the data-parallel ranks (if training with more than one).
 
-        self.training_loop()
+        :param network_name: The attribute name of the network (e.g. 'D').
+        :type network_name: str
+        :param group: The process group to average over. None for the default group.
+        :type group: torch.distributed.ProcessGroup
+        """
+        if self.world_size == 1:
+            return
+        with self.timer.phase(f'{network_name} Gradient All-Reduce'):
+            all_reduce_gradients(getattr(self, network_name), group=group)
 
-        print('Completed {}'.format(self.trial_directory))
-        if self.settings.should_save_models:
-            self.save_models(step=self.settings.steps_to_run)
+    @staticmethod
+    def completed_trial_exists(settings):
+        """
+        Checks whether the trial of the settings has already been run, and should be skipped.
+
+        :param settings: The settings of the trial.
+        :type settings: Settings
+        :return: Whether the trial should be skipped.
+        :rtype: bool
+        """
+        trial_directory = os.path.join(settings.logs_directory, settings.trial_name)
+        return (settings.skip_completed_experiment and os.path.exists(trial_directory) and
+                '/check' not in trial_directory and not settings.continue_existing_experiments)
 
     def save_models(self, step):
         """Saves the network models."""
@@ -94,39 +213,133 @@ class Experiment(ABC):
                  'G': self.G.state_dict(),
                  'g_optimizer': self.g_optimizer.state_dict(),
                  'step': step}
-        torch.save(model, os.path.join(self.trial_directory, f'model_{step}.pth'))
+        self.write_checkpoint(model, step)
+
+    def write_checkpoint(self, model, step):
+        """
+        Saves a checkpoint in the background, scored by the latest value of the best checkpoint summary scalar (whose
+        step is recorded with the score). With asynchronous evaluation, the checkpoint awaits the scalars of the latest
+        queued summaries instead, if they have not been received yet. Only rank 0 saves checkpoints when training
+        data-parallel.
+
+        :param model: The dictionary of state dicts (and other values) to save.
+        :type model: dict
+        :param step: The step of the checkpoint.
+        :type step: int
+        """
+        if self.rank != 0:
+            return
+        if self.checkpoint_writer is None:
+            self.checkpoint_writer = CheckpointWriter(
+                self.trial_directory, os.path.join(self.trial_directory, self.settings.temporary_directory),
+                checkpoints_to_keep=self.settings.checkpoints_to_keep)
+        if self.evaluator is not None and self.evaluator.pending_steps:
+            self.checkpoint_writer.save(model, step, score_step=self.evaluator.pending_steps[-1], score_pending=True)
+        else:
+            self.checkpoint_writer.save(model, step, *self.latest_checkpoint_score())
+
+    def latest_checkpoint_score(self):
+        """
+        Gives the latest value of the best checkpoint summary scalar, and the step it was written at.
+
+        :return: The score and its step, or None for both if the scalar has not been written.
+        :rtype: (float, int)
+        """
+        summary_writer = self.gan_summary_writer if self.gan_summary_writer is not None else self.dnn_summary_writer
+        return (summary_writer.latest_scalars.get(self.settings.best_checkpoint_scalar),
+                summary_writer.latest_scalar_steps.get(self.settings.best_checkpoint_scalar))
+
+    def evaluation_received(self, step):
+        """
+        Scores the checkpoints awaiting the asynchronous evaluation of a step, once its scalars are received.
+
+        :param step: The step evaluated.
+        :type step: int
+        """
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.add_score(step, *self.latest_checkpoint_score())
 
     def training_loop(self):
         """Runs the main training loop."""
-        train_dataset_generator = self.infinite_iter(self.train_dataset_loader)
-        unlabeled_dataset_generator = self.infinite_iter(self.unlabeled_dataset_loader)
+        train_dataset_generator = BatchPrefetcher(self.train_dataset_loader, depth=self.settings.prefetch_batches)
+        unlabeled_dataset_generator = BatchPrefetcher(self.unlabeled_dataset_loader,
+                                                      depth=self.settings.prefetch_batches)
+        dnn_executor = self.dnn_step_executor()
+        if self.settings.asynchronous_evaluation and self.rank == 0:
+            self.evaluator = AsynchronousEvaluator(self)
+        profiler = TrainingProfiler(self) if self.settings.profile_steps is not None and self.rank == 0 else None
+        if self.rank == 0:
+            self.controller = TrainingController(self, [train_dataset_generator, unlabeled_dataset_generator])
         step_time_start = datetime.datetime.now()
         for step in range(self.starting_step, self.settings.steps_to_run):
+            if profiler is not None:
+                profiler.step_started(step)
             self.adjust_learning_rate(step)
             # DNN.
             samples = next(train_dataset_generator)
             if len(samples) == 2:
                 labeled_examples, labels = samples
-                labeled_examples, labels = labeled_examples.to(gpu), labels.to(gpu)
             else:
                 labeled_examples, primary_labels, secondary_labels = samples
-                labeled_examples, labels = labeled_examples.to(gpu), (primary_labels.to(gpu), secondary_labels.to(gpu))
-            self.dnn_training_step(labeled_examples, labels, step)
+                labels = (primary_labels, secondary_labels)
+            if dnn_executor is None:
+                self.dnn_training_step(labeled_examples, labels, step)
+            else:
+                dnn_step = dnn_executor.submit(self.dnn_training_step, labeled_examples, labels, step)
             # GAN.
             unlabeled_examples = next(unlabeled_dataset_generator)[0]
-            unlabeled_examples = unlabeled_examples.to(gpu)
             self.gan_training_step(labeled_examples, labels, unlabeled_examples, step)
+            if dnn_executor is not None:
+                dnn_step.result()
+            self.timer.step_completed()
 
-            if self.gan_summary_writer.is_summary_step() or step == self.settings.steps_to_run - 1:
+            summary_step = self.gan_summary_writer.is_summary_step() or step == self.settings.steps_to_run - 1
+            if self.rank == 0 and (summary_step or self.summary_requested):
+                self.summary_requested = False
                 print('\rStep {}, {}...'.format(step, datetime.datetime.now() - step_time_start), end='')
+                self.timer.add('Data Wait/Labeled', train_dataset_generator.pop_wait_time())
+                self.timer.add('Data Wait/Unlabeled', unlabeled_dataset_generator.pop_wait_time())
+                self.timer.add('Host To Device Copy', train_dataset_generator.pop_copy_time() +
+                               unlabeled_dataset_generator.pop_copy_time())
+                self.timer.write_summaries(self.gan_summary_writer)
                 step_time_start = datetime.datetime.now()
-                self.eval_mode()
-                with torch.no_grad():
-                    self.validation_summaries(step)
-                self.train_mode()
+                with self.timer.phase('Summaries'):
+                    if self.evaluator is not None:
+                        self.evaluator.submit(self, step, block=step == self.settings.steps_to_run - 1)
+                    else:
+                        self.eval_mode()
+                        with torch.no_grad():
+                            self.validation_summaries(step)
+                        self.train_mode()
             self.handle_user_input(step)
             if self.settings.save_step_period and step % self.settings.save_step_period == 0 and step != 0:
-                self.save_models(step=step)
+                with self.timer.phase('Checkpointing'):
+                    self.save_models(step=step)
+            if profiler is not None:
+                profiler.step_completed(step)
+        if profiler is not None:
+            profiler.close()
+        if self.controller is not None:
+            self.controller.close()
+        train_dataset_generator.close()
+        unlabeled_dataset_generator.close()
+        if dnn_executor is not None:
+            dnn_executor.shutdown()
+        if self.evaluator is not None:
+            self.evaluator.close(self)
+
+    def dnn_step_executor(self):
+        """
+        Creates the executor which runs the DNN training step alongside the GAN training step, or `None` if the
+        steps should run one after the other. The two steps share no models, optimizers, or summary writers.
+        """
+        if not self.settings.concurrent_dnn_training:
+            return None
+        if self.settings.dnn_thread_count is None:
+            return ThreadPoolExecutor(max_workers=1)
+        # With OpenMP, the intra-op thread count applies to the thread which sets it.
+        return ThreadPoolExecutor(max_workers=1, initializer=torch.set_num_threads,
+                                  initargs=(self.settings.dnn_thread_count,))
 
     def prepare_optimizers(self):
         """Prepares the optimizers of the network."""
@@ -137,10 +350,12 @@ class Experiment(ABC):
         self.g_optimizer = Adam(self.G.parameters(), lr=g_lr)
         self.dnn_optimizer = Adam(self.DNN.parameters(), lr=d_lr, weight_decay=weight_decay)
 
-    def prepare_summary_writers(self):
-        """Prepares the summary writers for TensorBoard."""
-        self.dnn_summary_writer = SummaryWriter(os.path.join(self.trial_directory, 'DNN'))
-        self.gan_summary_writer = SummaryWriter(os.path.join(self.trial_directory, 'GAN'))
+    def prepare_summary_writers(self, filename_suffix=''):
+        """Prepares the summary writers for TensorBoard. Only rank 0 writes summaries when training data-parallel."""
+        self.dnn_summary_writer = SummaryWriter(os.path.join(self.trial_directory, 'DNN'),
+                                                filename_suffix=filename_suffix, write_to_disk=self.rank == 0)
+        self.gan_summary_writer = SummaryWriter(os.path.join(self.trial_directory, 'GAN'),
+                                                filename_suffix=filename_suffix, write_to_disk=self.rank == 0)
         self.dnn_summary_writer.summary_period = self.settings.summary_step_period
         self.gan_summary_writer.summary_period = self.settings.summary_step_period
         self.dnn_summary_writer.steps_to_run = self.settings.steps_to_run
@@ -148,19 +363,34 @@ class Experiment(ABC):
 
     def handle_user_input(self, step):
         """
-        Handle input from the user.
+        Handle the commands from the user, sent through the training controller. While paused, this waits for the
+        command to resume (or quit).
 
         :param step: The current step of the program.
         :type step: int
         """
-        while sys.stdin in select.select([sys.stdin], [], [], 0)[0]:
-            line = sys.stdin.readline()
-            if 'save' in line:
+        if self.controller is None:
+            return
+        self.controller.step_completed(step)
+        while True:
+            command = self.controller.next_command()
+            if command is None:
+                break
+            if command == 'save':
                 self.save_models(step)
                 print('\rSaved model for step {}...'.format(step))
-            if 'quit' in line:
+            elif command == 'quit':
                 self.signal_quit = True
+                self.controller.paused = False
                 print('\rQuit requested after current experiment...')
+            elif command == 'pause':
+                self.controller.paused = True
+                print('\rPaused after step {}...'.format(step))
+            elif command == 'resume':
+                self.controller.paused = False
+                print('\rResumed...')
+            elif command == 'summary':
+                self.summary_requested = True
 
     def train_mode(self):
         """
@@ -218,33 +448,38 @@ class Experiment(ABC):
         else:
             return model_path2
 
-    def load_models(self, with_optimizers=True):
-        """Loads existing models if they exist at `self.settings.load_model_path`."""
+    def load_models(self, with_optimizers=True, network_names=('DNN', 'D', 'G')):
+        """
+        Loads existing models if they exist at `self.settings.load_model_path`. Only the entries for the given
+        networks (and their optimizers) are read from the checkpoint.
+
+        :param with_optimizers: Whether to load the optimizer states.
+        :type with_optimizers: bool
+        :param network_names: The names of the networks to load. Networks which are not set up are skipped.
+        :type network_names: list[str]
+        """
         if self.settings.load_model_path:
-            latest_model = None
-            model_path_file_names = os.listdir(self.settings.load_model_path)
-            for file_name in model_path_file_names:
-                match = re.search(r'model_?(\d+)?\.pth', file_name)
-                if match:
-                    latest_model = self.compare_model_path_for_latest(latest_model, match)
-            latest_model = None if latest_model is None else latest_model.group(0)
-            if not torch.cuda.is_available():
-                map_location = 'cpu'
-            else:
-                map_location = None
+            latest_model = latest_checkpoint_file_name(self.settings.load_model_path)
+            if latest_model is None:  # Trials saved before the checkpoint manifest.
+                model_path_file_names = os.listdir(self.settings.load_model_path)
+                for file_name in model_path_file_names:
+                    match = re.search(r'model_?(\d+)?\.pth', file_name)
+                    if match:
+                        latest_model = self.compare_model_path_for_latest(latest_model, match)
+                latest_model = None if latest_model is None else latest_model.group(0)
             if latest_model:
                 model_path = os.path.join(self.settings.load_model_path, latest_model)
-                loaded_model = torch.load(model_path, map_location)
-                self.DNN.load_state_dict(loaded_model['DNN'])
-                self.D.load_state_dict(loaded_model['D'])
-                self.G.load_state_dict(loaded_model['G'])
+                network_names = [name for name in network_names if getattr(self, name) is not None]
+                optimizer_names = [optimizer_names_by_network[name] for name in network_names]
+                entry_names = network_names + (optimizer_names if with_optimizers else []) + ['step']
+                loaded_model = load_checkpoint_entries(model_path, entry_names)
+                for network_name in network_names:
+                    getattr(self, network_name).load_state_dict(loaded_model[network_name])
                 if with_optimizers:
-                    self.dnn_optimizer.load_state_dict(loaded_model['dnn_optimizer'])
-                    self.optimizer_to_gpu(self.dnn_optimizer)
-                    self.d_optimizer.load_state_dict(loaded_model['d_optimizer'])
-                    self.optimizer_to_gpu(self.d_optimizer)
-                    self.g_optimizer.load_state_dict(loaded_model['g_optimizer'])
-                    self.optimizer_to_gpu(self.g_optimizer)
+                    for optimizer_name in optimizer_names:
+                        optimizer = getattr(self, optimizer_name)
+                        optimizer.load_state_dict(loaded_model[optimizer_name])
+                        self.optimizer_to_gpu(optimizer)
                 print('Model loaded from `{}`.'.format(model_path))
                 if self.settings.continue_existing_experiments:
                     self.starting_step = loaded_model['step'] + 1
@@ -254,21 +489,69 @@ class Experiment(ABC):
         for state in optimizer.state.values():
             for k, v in state.items():
                 if torch.is_tensor(v):
-                    state[k] = v.cuda()
+                    state[k] = v.to(gpu)
+
+    def compile_networks(self):
+        """Compiles the networks selected by the compile mode setting."""
+        for network_name in ['DNN', 'D', 'G']:
+            network = getattr(self, network_name)
+            mode = self.compile_mode_for(network_name)
+            if network is not None and mode is not None:
+                setattr(self, network_name, CompiledModuleForward(network, mode))
+
+    def compile_mode_for(self, network_name):
+        """
+        The `torch.compile` mode for the named network, or `None` if it should not be compiled.
+
+        :param network_name: The attribute name of the network (e.g. 'D').
+        :type network_name: str
+        :return: The compile mode.
+        :rtype: str | None
+        """
+        if isinstance(self.settings.compile_mode, dict):
+            return self.settings.compile_mode.get(network_name)
+        return self.settings.compile_mode
+
+    @contextmanager
+    def uncompiled(self, network_name):
+        """
+        Replaces the named network with its uncompiled module for the duration of the context. Needed for double
+        backward passes (e.g. the gradient penalty), which compiled graphs do not support.
+
+        :param network_name: The attribute name of the network (e.g. 'D').
+        :type network_name: str
+        """
+        network = getattr(self, network_name)
+        if not isinstance(network, CompiledModuleForward):
+            yield
+            return
+        setattr(self, network_name, network.module)
+        try:
+            yield
+        finally:
+            setattr(self, network_name, network)
 
     def dnn_training_step(self, examples, labels, step):
         """Runs an individual round of DNN training."""
         self.DNN.apply(disable_batch_norm_updates)  # No batch norm
         self.dnn_summary_writer.step = step
         self.dnn_optimizer.zero_grad()
-        dnn_loss = self.dnn_loss_calculation(examples, labels)
-        dnn_loss.backward()
-        self.dnn_optimizer.step()
+        with self.micro_batched('DNN'):
+            with self.timer.phase('DNN Forward'), self.autocast():
+                dnn_loss = self.dnn_loss_calculation(examples, labels)
+            # Taken within the context, as a micro-batched network only keeps the last micro-batch's features.
+            features = getattr(self.DNN, 'features', None)
+            with self.timer.phase('DNN Backward'):
+                self.dnn_gradient_scaler.scale(dnn_loss).backward()
+        self.all_reduce_gradients('DNN', group=self.dnn_process_group)
+        with self.timer.phase('DNN Optimizer'):
+            self.dnn_gradient_scaler.step(self.dnn_optimizer)
+            self.dnn_gradient_scaler.update()
         # Summaries.
         if self.dnn_summary_writer.is_summary_step():
             self.dnn_summary_writer.add_scalar('Discriminator/Labeled Loss', dnn_loss.item())
-            if hasattr(self.DNN, 'features') and self.DNN.features is not None:
-                self.dnn_summary_writer.add_scalar('Feature Norm/Labeled', self.DNN.features.norm(dim=1).mean().item())
+            if features is not None:
+                self.dnn_summary_writer.add_scalar('Feature Norm/Labeled', features.norm(dim=1).mean().item())
 
     def gan_training_step(self, labeled_examples, labels, unlabeled_examples, step):
         """Runs an individual round of GAN training."""
@@ -276,42 +559,116 @@ class Experiment(ABC):
         self.D.apply(disable_batch_norm_updates)  # No batch norm
         self.gan_summary_writer.step = step
         self.d_optimizer.zero_grad()
-        labeled_loss = self.labeled_loss_calculation(labeled_examples, labels)
-        labeled_loss.backward()
-        # Unlabeled.
-        # self.D.apply(disable_batch_norm_updates)  # Make sure only labeled data is used for batch norm statistics
-        unlabeled_loss = self.unlabeled_loss_calculation(labeled_examples, unlabeled_examples)
-        unlabeled_loss.backward()
-        # Fake.
-        z = torch.tensor(MixtureModel([norm(-self.settings.mean_offset, 1),
-                                       norm(self.settings.mean_offset, 1)]
-                                      ).rvs(size=[unlabeled_examples.size(0),
-                                                  self.G.input_size]).astype(np.float32)).to(gpu)
-        fake_examples = self.G(z)
-        fake_loss = self.fake_loss_calculation(unlabeled_examples, fake_examples)
-        fake_loss.backward()
-        # Gradient penalty.
-        gradient_penalty = self.gradient_penalty_calculation(fake_examples, unlabeled_examples)
-        gradient_penalty.backward()
+        generator_step = step % self.settings.generator_training_step_period == 0
+        reuse_fake_features = generator_step and self.settings.reuse_discriminator_fake_features
+        reuse_fake_examples = generator_step and (self.settings.reuse_generator_forward or reuse_fake_features)
+        gradient_scaler = self.gan_gradient_scaler
+        with self.timer.phase('Generator Forward'):
+            z = self.generator_input_distribution.rvs([unlabeled_examples.size(0), self.G.input_size])
+            with self.autocast():
+                fake_examples = self.G(z)
+        if reuse_fake_examples:
+            # The discriminator sees a leaf copy, so its losses do not backpropagate through (or free) the generator.
+            discriminator_fake_examples = fake_examples.detach().requires_grad_(reuse_fake_features)
+        else:
+            discriminator_fake_examples = fake_examples
+        generator_loss = None
+        if self.settings.fused_discriminator_forward:
+            with self.timer.phase('Fused Discriminator Losses'):
+                labeled_loss, unlabeled_loss, fake_loss, generator_loss = self.fused_discriminator_losses(
+                    labeled_examples, labels, unlabeled_examples, discriminator_fake_examples,
+                    with_generator_loss=reuse_fake_features)
+        else:
+            with self.micro_batched('D'):
+                with self.timer.phase('Labeled Loss'):
+                    with self.autocast():
+                        labeled_loss = self.labeled_loss_calculation(labeled_examples, labels)
+                    gradient_scaler.scale(labeled_loss).backward()
+                # Unlabeled.
+                # self.D.apply(disable_batch_norm_updates)  # Make sure only labeled data is used for batch norm
+                with self.timer.phase('Unlabeled Loss'):
+                    with self.autocast():
+                        unlabeled_loss = self.unlabeled_loss_calculation(labeled_examples, unlabeled_examples)
+                    gradient_scaler.scale(unlabeled_loss).backward()
+                # Fake.
+                with self.timer.phase('Fake Loss'):
+                    if reuse_fake_features:
+                        with self.autocast(), self.fused_discriminator([discriminator_fake_examples]):
+                            fake_loss = self.fake_loss_calculation(unlabeled_examples, discriminator_fake_examples)
+                            generator_loss = self.generator_loss_calculation(discriminator_fake_examples,
+                                                                             unlabeled_examples)
+                        gradient_scaler.scale(fake_loss).backward(retain_graph=True)
+                    else:
+                        with self.autocast():
+                            fake_loss = self.fake_loss_calculation(unlabeled_examples, discriminator_fake_examples)
+                        gradient_scaler.scale(fake_loss).backward()
+        if reuse_fake_features:
+            # Taken before the discriminator update, as the update modifies the weights the features depend on.
+            with self.timer.phase('Generator Loss'):
+                fake_example_gradients = torch.autograd.grad(gradient_scaler.scale(generator_loss),
+                                                             discriminator_fake_examples)[0]
+        # Gradient penalty. The penalty is a mean over examples, so it is accumulated over micro-batches directly.
+        # With lazy regularization, the penalty is only applied every `gradient_penalty_period` steps, scaled by the
+        # period, on the first `gradient_penalty_fraction` of the (shuffled) examples.
+        gradient_penalty_period = self.settings.gradient_penalty_period
+        gradient_penalty_step = step % gradient_penalty_period == 0
+        if gradient_penalty_step:
+            with self.timer.phase('Gradient Penalty') as gradient_penalty_phase:
+                interpolate_count = max(1, round(unlabeled_examples.size(0) * self.settings.gradient_penalty_fraction))
+                penalty_fake_examples = fake_examples[:interpolate_count]
+                penalty_unlabeled_examples = unlabeled_examples[:interpolate_count]
+                micro_batch_size = self.settings.micro_batch_size or interpolate_count
+                gradient_penalty = 0
+                gradient_norms = []
+                for fake_micro_batch, unlabeled_micro_batch in zip(penalty_fake_examples.split(micro_batch_size),
+                                                                   penalty_unlabeled_examples.split(micro_batch_size)):
+                    micro_batch_fraction = unlabeled_micro_batch.size(0) / interpolate_count
+                    micro_batch_penalty = self.gradient_penalty_calculation(fake_micro_batch, unlabeled_micro_batch)
+                    gradient_scaler.scale(micro_batch_penalty * micro_batch_fraction *
+                                          gradient_penalty_period).backward()
+                    gradient_penalty += micro_batch_penalty.detach() * micro_batch_fraction
+                    gradient_norms.append(self.gradient_norm)
+                self.gradient_norm = torch.cat(gradient_norms)
+                self.gradient_penalty = gradient_penalty
+            if gradient_penalty_phase is not None:
+                # The time of the skipped penalties, as the time of this one. The savings of the fraction are not
+                # included, but show in the penalty time compared against a run without the fraction.
+                self.timer.add('Gradient Penalty Saved',
+                               gradient_penalty_phase.duration * (gradient_penalty_period - 1))
         # Discriminator update.
-        self.d_optimizer.step()
+        self.all_reduce_gradients('D')
+        with self.timer.phase('Discriminator Optimizer'):
+            gradient_scaler.step(self.d_optimizer)
         # Generator.
-        if step % self.settings.generator_training_step_period == 0:
+        if generator_step:
             self.g_optimizer.zero_grad()
-            z = torch.randn(unlabeled_examples.size(0), self.G.input_size).to(gpu)
-            fake_examples = self.G(z)
-            generator_loss = self.generator_loss_calculation(fake_examples, unlabeled_examples)
-            generator_loss.backward()
-            self.g_optimizer.step()
-            if self.gan_summary_writer.is_summary_step():
-                self.gan_summary_writer.add_scalar('Generator/Loss', generator_loss.item())
+            with self.timer.phase('Generator Loss'):
+                if reuse_fake_features:
+                    fake_examples.backward(fake_example_gradients)
+                else:
+                    with self.micro_batched('D'):
+                        with self.autocast():
+                            if not reuse_fake_examples:
+                                z = torch.randn(unlabeled_examples.size(0), self.G.input_size).to(gpu)
+                                fake_examples = self.G(z)
+                            generator_loss = self.generator_loss_calculation(fake_examples, unlabeled_examples)
+                        gradient_scaler.scale(generator_loss).backward()
+            self.all_reduce_gradients('G')
+            with self.timer.phase('Generator Optimizer'):
+                gradient_scaler.step(self.g_optimizer)
+        gradient_scaler.update()
+        if generator_step and self.gan_summary_writer.is_summary_step():
+            self.gan_summary_writer.add_scalar('Generator/Loss', generator_loss.item())
         # Summaries.
         if self.gan_summary_writer.is_summary_step():
             self.gan_summary_writer.add_scalar('Discriminator/Labeled Loss', labeled_loss.item())
             self.gan_summary_writer.add_scalar('Discriminator/Unlabeled Loss', unlabeled_loss.item())
             self.gan_summary_writer.add_scalar('Discriminator/Fake Loss', fake_loss.item())
-            self.gan_summary_writer.add_scalar('Discriminator/Gradient Penalty', gradient_penalty.item())
-            self.gan_summary_writer.add_scalar('Discriminator/Gradient Norm', self.gradient_norm.mean().item())
+            if self.gradient_penalty is not None:
+                self.gan_summary_writer.add_scalar('Discriminator/Gradient Penalty', self.gradient_penalty.item())
+                self.gan_summary_writer.add_scalar('Discriminator/Effective Gradient Penalty',
+                                                   self.gradient_penalty.item() * gradient_penalty_period)
+                self.gan_summary_writer.add_scalar('Discriminator/Gradient Norm', self.gradient_norm.mean().item())
             if self.labeled_features is not None and self.unlabeled_features is not None:
                 self.gan_summary_writer.add_scalar('Feature Norm/Labeled',
                                                    self.labeled_features.mean(0).norm().item())
@@ -319,6 +676,72 @@ class Experiment(ABC):
                                                    self.unlabeled_features.mean(0).norm().item())
         # self.D.apply(enable_batch_norm_updates)  # Only labeled data used for batch norm running statistics
 
+    def fused_discriminator_losses(self, labeled_examples, labels, unlabeled_examples, fake_examples,
+                                   with_generator_loss=False):
+        """
+        Calculates the labeled, unlabeled, and fake losses from a single discriminator forward pass over the
+        labeled, unlabeled, and fake examples together, then backpropagates their sum. Batch norm statistics are
+        frozen during the GAN step, so each example's prediction does not depend on the rest of the batch.
+        If requested, the generator loss is also calculated from the same forward pass (but not backpropagated).
+        """
+        if with_generator_loss:
+            batches = [labeled_examples, unlabeled_examples, fake_examples]
+        else:
+            batches = [labeled_examples, unlabeled_examples, fake_examples.detach()]
+        generator_loss = None
+        with self.autocast(), self.fused_discriminator(batches):
+            labeled_loss = self.labeled_loss_calculation(labeled_examples, labels)
+            unlabeled_loss = self.unlabeled_loss_calculation(labeled_examples, unlabeled_examples)
+            fake_loss = self.fake_loss_calculation(unlabeled_examples, fake_examples)
+            if with_generator_loss:
+                generator_loss = self.generator_loss_calculation(fake_examples, unlabeled_examples)
+        discriminator_loss = labeled_loss + unlabeled_loss + fake_loss
+        self.gan_gradient_scaler.scale(discriminator_loss).backward(retain_graph=with_generator_loss)
+        return labeled_loss, unlabeled_loss, fake_loss, generator_loss
+
+    @contextmanager
+    def fused_discriminator(self, batches):
+        """
+        Replaces `self.D` with a single forward pass over all the given batches for the duration of the context.
+
+        :param batches: The batches of examples the discriminator will be called on within the context.
+        :type batches: list[torch.Tensor]
+        """
+        discriminator = self.D
+        self.D = FusedModuleForward(discriminator, batches)
+        try:
+            yield self.D
+        finally:
+            self.D = discriminator
+
+    @contextmanager
+    def micro_batched(self, network_name):
+        """
+        Replaces the named network with a micro-batched forward (see `MicroBatchedModuleForward`) for the duration
+        of the context, if a micro-batch size is set. Losses must be backpropagated within the context, after which
+        their gradients are accumulated through the network one micro-batch at a time.
+
+        :param network_name: The attribute name of the network (e.g. 'D').
+        :type network_name: str
+        """
+        if self.settings.micro_batch_size is None:
+            yield
+            return
+        network = getattr(self, network_name)
+        micro_batched_network = MicroBatchedModuleForward(network, self.settings.micro_batch_size, self.autocast)
+        setattr(self, network_name, micro_batched_network)
+        try:
+            yield
+        finally:
+            setattr(self, network_name, network)
+        with self.timer.phase(f'{network_name} Micro-Batch Backward'):
+            micro_batched_network.backward()
+
+    def autocast(self):
+        """A context in which forward passes run at the precision given in the settings."""
+        return torch.autocast(device_type=gpu.type, dtype=precision_data_types[self.settings.precision],
+                              enabled=self.settings.precision != 'fp32')
+
     def dnn_loss_calculation(self, labeled_examples, labels):
         """Calculates the DNN loss."""
         predicted_labels = self.DNN(labeled_examples)
@@ -360,20 +783,29 @@ class Experiment(ABC):
     def gradient_penalty_calculation(self, fake_examples: Tensor, unlabeled_examples: Tensor) -> Tensor:
         """Calculates the gradient penalty from the given fake and real examples."""
         alpha_shape = [1] * len(unlabeled_examples.size())
-        alpha_shape[0] = self.settings.batch_size
+        alpha_shape[0] = unlabeled_examples.size(0)
         alpha = torch.rand(alpha_shape, device=gpu)
-        interpolates = (alpha * unlabeled_examples.detach().requires_grad_() +
-                        (1 - alpha) * fake_examples.detach().requires_grad_())
-        interpolates_loss = self.interpolate_loss_calculation(interpolates)
-        gradients = torch.autograd.grad(outputs=interpolates_loss, inputs=interpolates,
-                                        grad_outputs=torch.ones_like(interpolates_loss, device=gpu),
-                                        create_graph=True)[0]
+        interpolates = alpha * unlabeled_examples.detach() + (1 - alpha) * fake_examples.detach()
+        gradients = self.interpolate_gradients(interpolates)
         gradient_norm = gradients.view(unlabeled_examples.size(0), -1).norm(dim=1)
         self.gradient_norm = gradient_norm
         norm_excesses = torch.max(gradient_norm - 1, torch.zeros_like(gradient_norm))
         gradient_penalty = (norm_excesses ** 2).mean() * self.settings.gradient_penalty_multiplier
         return gradient_penalty
 
+    def interpolate_gradients(self, interpolates):
+        """Calculates the gradients of the interpolate loss with respect to the interpolates (keeping the graph)."""
+        interpolates.requires_grad_()
+        with self.autocast(), self.uncompiled('D'):
+            interpolates_loss = self.interpolate_loss_calculation(interpolates)
+        scaled_interpolates_loss = self.gan_gradient_scaler.scale(interpolates_loss)
+        gradients = torch.autograd.grad(outputs=scaled_interpolates_loss, inputs=interpolates,
+                                        grad_outputs=torch.ones_like(scaled_interpolates_loss, device=gpu),
+                                        create_graph=True)[0]
+        if self.gan_gradient_scaler.is_enabled():
+            gradients = gradients / self.gan_gradient_scaler.get_scale()
+        return gradients
+
     def interpolate_loss_calculation(self, interpolates):
         """Calculates the interpolate loss for use in the gradient penalty."""
         _ = self.D(interpolates)
@@ -419,16 +851,9 @@ class Experiment(ABC):
     def evaluate(self):
         """Evaluates the model on the test dataset (needs to be overridden by subclass)."""
         self.model_setup()
-        self.load_models()
+        self.load_models(with_optimizers=False, network_names=['DNN', 'D'])
         self.eval_mode()
 
-    @staticmethod
-    def infinite_iter(dataset):
-        """Create an infinite generator from a dataset"""
-        while True:
-            for examples in dataset:
-                yield examples
-
     def adjust_learning_rate(self, step):
         """Sets the learning rate to the initial LR decayed by 10 every 30 epochs"""
         lr = self.settings.learning_rate * (0.1 ** (step // 100000))
@@ -436,11 +861,18 @@ class Experiment(ABC):
             param_group['lr'] = lr
 
     def feature_distance_loss(self, base_features, other_features, distance_function=None):
-        """Calculate the loss based on the distance between feature vectors."""
+        """
+        Calculate the loss based on the distance between feature vectors. When training data-parallel with
+        `global_feature_means` set, the feature means are over the batches of all the ranks.
+        """
         if distance_function is None:
             distance_function = self.settings.matching_distance_function
-        base_mean_features = base_features.mean(0)
-        other_mean_features = other_features.mean(0)
+        if self.settings.global_feature_means and self.world_size > 1:
+            base_mean_features = global_batch_mean(base_features)
+            other_mean_features = global_batch_mean(other_features)
+        else:
+            base_mean_features = base_features.mean(0)
+            other_mean_features = other_features.mean(0)
         if self.settings.normalize_feature_norm:
             epsilon = 1e-5
             base_mean_features = base_mean_features / (base_mean_features.norm() + epsilon)
@@ -458,8 +890,9 @@ class Experiment(ABC):
         Sets up the network for inference.
         """
         self.model_setup()
-        self.load_models(with_optimizers=False)
         self.gpu_mode()
+        self.load_models(with_optimizers=False, network_names=[name for name in ['DNN', 'D', 'G']
+                                                               if getattr(self, name) is self.inference_network])
         self.eval_mode()
 
     def inference(self, input_):
@@ -469,6 +902,208 @@ class Experiment(ABC):
         raise NotImplementedError
 
 
+class FusedModuleForward:
+    """
+    Runs a module once on the concatenation of several batches. Calling the wrapper with one of those batches (or a
+    detached version of it) returns that batch's slice of the outputs, rather than running the module again. Batch
+    tensors the module stores on itself during the forward pass (e.g. `features`) are sliced the same way. Any other
+    input is passed through to the module.
+    """
+    def __init__(self, module, batches):
+        self.module = module
+        sizes = [batch.size(0) for batch in batches]
+        outputs = module(torch.cat(batches))
+        split_outputs = split_batch_dimension(outputs, sizes)
+        attribute_names = [name for name, value in vars(module).items()
+                           if torch.is_tensor(value) and value.dim() > 0 and value.size(0) == sum(sizes)]
+        split_attributes = {name: split_batch_dimension(getattr(module, name), sizes) for name in attribute_names}
+        self.cache = {}
+        for index, batch in enumerate(batches):
+            attributes = {name: split_attribute[index] for name, split_attribute in split_attributes.items()}
+            self.cache[self.batch_key(batch)] = (split_outputs[index], attributes)
+        self.attribute_names = attribute_names
+
+    def __call__(self, input_, *args, **kwargs):
+        cached = self.cache.get(self.batch_key(input_))
+        if cached is None:
+            for name in self.attribute_names:
+                self.__dict__.pop(name, None)
+            return self.module(input_, *args, **kwargs)
+        outputs, attributes = cached
+        self.__dict__.update(attributes)
+        return outputs
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+    @staticmethod
+    def batch_key(batch):
+        """A key identifying the batch which is shared by any detached version of it."""
+        return batch.data_ptr(), tuple(batch.size())
+
+
+class CompiledModuleForward:
+    """
+    Runs a module's forward pass through `torch.compile`. Batch tensors the module stores on itself during the
+    forward pass (e.g. `features`) are returned from the compiled graph as outputs and set on the wrapper after each
+    call, so reading them never touches the graph. Anything else is passed through to the module.
+    """
+    def __init__(self, module, mode='default'):
+        self.module = module
+        self.compiled_forward = torch.compile(AttributeReturningForward(module), mode=mode)
+
+    def __call__(self, *args, **kwargs):
+        outputs, attributes = self.compiled_forward(*args, **kwargs)
+        self.__dict__.update(attributes)
+        return outputs
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+
+class AttributeReturningForward(Module):
+    """Wraps a module to return the tensors it stores on itself during the forward pass along with its outputs."""
+    def __init__(self, module):
+        super().__init__()
+        self.module = module
+
+    def forward(self, *args, **kwargs):
+        """The forward pass of the module."""
+        outputs = self.module(*args, **kwargs)
+        attributes = {name: value for name, value in vars(self.module).items() if torch.is_tensor(value)}
+        return outputs, attributes
+
+
+class MicroBatchedModuleForward:
+    """
+    Runs a module over a batch in micro-batches, trading an extra forward pass for memory. Calling the wrapper runs
+    the module on each micro-batch without building a graph, and returns the concatenated outputs as leaf tensors.
+    Batch tensors the module stores on itself (e.g. `features`) are handled the same way. Any loss can then be
+    calculated on the full logical batch, so losses over batch means (e.g. the feature matching losses) are
+    unchanged. Once the losses have been backpropagated to those leaves, `backward` reruns the module on each
+    micro-batch with the same random state and backpropagates the leaves' gradients through it. This matches a
+    full batch backward pass as long as each example's outputs do not depend on the rest of the batch, which holds
+    with batch norm updates disabled.
+    """
+    def __init__(self, module, micro_batch_size, autocast=nullcontext):
+        self.module = module
+        self.micro_batch_size = micro_batch_size
+        self.autocast = autocast
+        self.calls = []
+        self.attribute_names = []
+
+    def __call__(self, input_, *args, **kwargs):
+        random_states = []
+        micro_batch_outputs = []
+        micro_batch_attributes = []
+        with torch.no_grad():
+            for micro_batch in input_.detach().split(self.micro_batch_size):
+                random_states.append(self.random_state())
+                micro_batch_outputs.append(self.module(micro_batch, *args, **kwargs))
+                micro_batch_attributes.append({name: value for name, value in vars(self.module).items()
+                                               if torch.is_tensor(value) and value.dim() > 0 and
+                                               value.size(0) == micro_batch.size(0)})
+        outputs = concatenate_batch_dimension(micro_batch_outputs)
+        for output in flatten_outputs(outputs):
+            if output.is_floating_point():
+                output.requires_grad_()
+        attributes = {name: torch.cat([attributes[name] for attributes in micro_batch_attributes]).requires_grad_()
+                      for name in micro_batch_attributes[0] if micro_batch_attributes[0][name].is_floating_point()}
+        for name in self.attribute_names:
+            self.__dict__.pop(name, None)
+        self.__dict__.update(attributes)
+        self.attribute_names = list(attributes)
+        self.calls.append((input_, args, kwargs, random_states, outputs, attributes))
+        return outputs
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+    def backward(self):
+        """Backpropagates the gradients of the returned outputs through the module, one micro-batch at a time."""
+        for input_, args, kwargs, random_states, outputs, attributes in self.calls:
+            leaves = flatten_outputs(outputs) + list(attributes.values())
+            if all(leaf.grad is None for leaf in leaves):
+                continue
+            input_gradients = []
+            start = 0
+            for micro_batch, random_state in zip(input_.detach().split(self.micro_batch_size), random_states):
+                micro_batch.requires_grad_(input_.requires_grad)
+                end = start + micro_batch.size(0)
+                with torch.random.fork_rng(devices=range(torch.cuda.device_count())):
+                    self.set_random_state(random_state)
+                    with self.autocast():
+                        micro_batch_outputs = flatten_outputs(self.module(micro_batch, *args, **kwargs))
+                micro_batch_outputs += [getattr(self.module, name) for name in attributes]
+                tensors, gradients = [], []
+                for micro_batch_output, leaf in zip(micro_batch_outputs, leaves):
+                    if leaf.grad is not None and micro_batch_output.requires_grad:
+                        tensors.append(micro_batch_output)
+                        gradients.append(leaf.grad[start:end])
+                if tensors:
+                    torch.autograd.backward(tensors, gradients)
+                if input_.requires_grad:
+                    input_gradients.append(torch.zeros_like(micro_batch) if micro_batch.grad is None
+                                           else micro_batch.grad)
+                start = end
+            if input_.requires_grad:
+                input_.backward(torch.cat(input_gradients))
+        self.calls = []
+
+    @staticmethod
+    def random_state():
+        """The current CPU and GPU random number generator states."""
+        cuda_state = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+        return torch.get_rng_state(), cuda_state
+
+    @staticmethod
+    def set_random_state(random_state):
+        """Restores random number generator states from `random_state`."""
+        cpu_state, cuda_state = random_state
+        torch.set_rng_state(cpu_state)
+        if cuda_state is not None:
+            torch.cuda.set_rng_state_all(cuda_state)
+
+
+def flatten_outputs(outputs):
+    """The list of tensors in a module's outputs."""
+    if isinstance(outputs, (tuple, list)):
+        return list(outputs)
+    return [outputs]
+
+
+def concatenate_batch_dimension(outputs_list):
+    """
+    Concatenates several calls' worth of module outputs along the batch dimension. The inverse of
+    `split_batch_dimension`.
+
+    :param outputs_list: The tensor, or tuple of tensors, output by each call of the module.
+    :type outputs_list: list[torch.Tensor] | list[tuple[torch.Tensor]]
+    :return: The concatenated outputs.
+    :rtype: torch.Tensor | tuple[torch.Tensor]
+    """
+    if isinstance(outputs_list[0], (tuple, list)):
+        return tuple(torch.cat(outputs) for outputs in zip(*outputs_list))
+    return torch.cat(outputs_list)
+
+
+def split_batch_dimension(outputs, sizes):
+    """
+    Splits a module's outputs along the batch dimension.
+
+    :param outputs: The tensor, or tuple of tensors, output by the module.
+    :type outputs: torch.Tensor | tuple[torch.Tensor]
+    :param sizes: The batch sizes to split into.
+    :type sizes: list[int]
+    :return: The outputs for each batch.
+    :rtype: list[torch.Tensor] | list[tuple[torch.Tensor]]
+    """
+    if isinstance(outputs, (tuple, list)):
+        return [tuple(batch_outputs) for batch_outputs in zip(*[split_batch_dimension(output, sizes)
+                                                                  for output in outputs])]
+    return list(outputs.split(sizes))
+
+
 def unit_vector(vector):
     """Gets the unit vector version of a vector."""
     return vector.div(vector.norm() + 1e-10)
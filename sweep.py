@@ -0,0 +1,155 @@
+"""
+Code to run the trials of a hyperparameter sweep in parallel processes.
+"""
+import datetime
+import os
+import traceback
+from multiprocessing.connection import wait
+
+import torch
+import torch.multiprocessing as multiprocessing
+
+
+class SweepExecutor:
+    """
+    Runs each trial of a sweep in its own process, with up to `concurrent_trials` processes at once. Each running
+    trial has a slot with its own set of CPU cores, whose count is used as the trial's torch thread budget (and
+    optionally the process's CPU affinity). A trial which raises an error or crashes is reported as such, without
+    stopping the other trials.
+    """
+    def __init__(self, experiment_class, concurrent_trials, cores_per_trial=None, data_workers_per_trial=None,
+                 pin_cores=False):
+        self.experiment_class = experiment_class
+        self.concurrent_trials = concurrent_trials
+        self.data_workers_per_trial = data_workers_per_trial
+        self.pin_cores = pin_cores
+        available_cores = sorted(os.sched_getaffinity(0))
+        if cores_per_trial is None:
+            cores_per_trial = max(1, len(available_cores) // concurrent_trials)
+        self.slot_cores = [[available_cores[(slot * cores_per_trial + offset) % len(available_cores)]
+                            for offset in range(cores_per_trial)]
+                           for slot in range(concurrent_trials)]
+
+    def run(self, settings_list):
+        """
+        Runs the trials and prints a summary table of their results.
+
+        :param settings_list: The settings of each trial, with their trial names set.
+        :type settings_list: list[settings.Settings]
+        :return: The results of the trials, in the order of the settings.
+        :rtype: list[TrialResult]
+        """
+        if any(settings.continue_from_previous_trial for settings in settings_list):
+            raise ValueError('Trials continuing from the previous trial cannot be run concurrently.')
+        context = multiprocessing.get_context('spawn')
+        results = [TrialResult(settings.trial_name) for settings in settings_list]
+        pending_indexes = list(range(len(settings_list)))
+        free_slots = list(range(self.concurrent_trials))
+        running = {}  # Process sentinel to (process, connection, trial index, slot).
+        try:
+            while pending_indexes or running:
+                while pending_indexes and free_slots:
+                    index = pending_indexes.pop(0)
+                    settings = settings_list[index]
+                    if self.experiment_class.completed_trial_exists(settings):
+                        results[index].status = 'Skipped'
+                        continue
+                    if self.data_workers_per_trial is not None:
+                        settings.number_of_data_workers = self.data_workers_per_trial
+                    slot = free_slots.pop(0)
+                    cores = self.slot_cores[slot]
+                    receiver, sender = context.Pipe(duplex=False)
+                    process = context.Process(target=trial_worker,
+                                              args=(self.experiment_class, settings, cores, self.pin_cores, sender))
+                    process.start()
+                    sender.close()
+                    results[index].status = 'Running'
+                    results[index].start_time = datetime.datetime.now()
+                    running[process.sentinel] = (process, receiver, index, slot)
+                if not running:
+                    continue
+                for sentinel in wait(list(running)):
+                    process, receiver, index, slot = running.pop(sentinel)
+                    process.join()
+                    result = results[index]
+                    result.duration = datetime.datetime.now() - result.start_time
+                    try:
+                        result.status, result.metric, result.message = receiver.recv()
+                    except EOFError:  # The process exited without sending a result.
+                        result.status = f'Crashed ({process.exitcode})'
+                    receiver.close()
+                    free_slots.append(slot)
+                    print(f'\r{result.status}: {result.trial_name}')
+                    if result.status == 'Failed':
+                        print(result.message)
+        finally:
+            for process, _, _, _ in running.values():
+                process.terminate()
+        print(summary_table(results, settings_list[0].best_checkpoint_scalar if settings_list else ''))
+        return results
+
+
+class TrialResult:
+    """The result of a trial of a sweep."""
+    def __init__(self, trial_name):
+        self.trial_name = trial_name
+        self.status = 'Pending'
+        self.start_time: datetime.datetime = None
+        self.duration: datetime.timedelta = None
+        self.metric: float = None
+        self.message: str = None
+
+
+def trial_worker(experiment_class, settings, cores, pin_cores, connection):
+    """
+    Runs a single trial, sending its status, final metric, and message back through the connection.
+
+    :param experiment_class: The class of the experiment to run.
+    :type experiment_class: type
+    :param settings: The settings of the trial.
+    :type settings: settings.Settings
+    :param cores: The CPU cores of the trial.
+    :type cores: list[int]
+    :param pin_cores: Whether to restrict the process to the cores.
+    :type pin_cores: bool
+    :param connection: The connection to send the result through.
+    :type connection: multiprocessing.connection.Connection
+    """
+    if pin_cores:
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    try:
+        experiment = experiment_class(settings)
+        experiment.train()
+        summary_writer = (experiment.gan_summary_writer if experiment.gan_summary_writer is not None
+                          else experiment.dnn_summary_writer)
+        metric = None
+        if summary_writer is not None and settings.best_checkpoint_scalar in summary_writer.latest_scalars:
+            metric = float(summary_writer.latest_scalars[settings.best_checkpoint_scalar])
+        for summary_writer in [experiment.dnn_summary_writer, experiment.gan_summary_writer]:
+            if summary_writer is not None:
+                summary_writer.close()
+        connection.send(('Completed', metric, experiment.trial_directory))
+    except Exception:
+        connection.send(('Failed', None, traceback.format_exc()))
+    connection.close()
+
+
+def summary_table(results, metric_name):
+    """
+    Creates a text table of the results of a sweep.
+
+    :param results: The results of the trials.
+    :type results: list[TrialResult]
+    :param metric_name: The name of the final metric reported by the trials.
+    :type metric_name: str
+    :return: The table.
+    :rtype: str
+    """
+    name_width = max([len('Trial')] + [len(result.trial_name) for result in results])
+    lines = [f'{"Trial":<{name_width}}  {"Status":<14}  {"Duration":>15}  {metric_name}']
+    for result in results:
+        duration = '' if result.duration is None else str(result.duration).split('.')[0]
+        metric = '' if result.metric is None else f'{result.metric:.6g}'
+        lines.append(f'{result.trial_name:<{name_width}}  {result.status:<14}  {duration:>15}  {metric}')
+    return '\n'.join(lines)
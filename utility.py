@@ -2,10 +2,14 @@
 Utility code to be used in miscellaneous cases.
 """
 import os
+import queue
 import random
 import re
+import threading
 import time
 import zipfile
+from collections import defaultdict
+from contextlib import nullcontext
 from urllib.request import urlretrieve
 
 import imageio
@@ -14,6 +18,7 @@ import numpy as np
 import torch
 from scipy.stats import rv_continuous
 from tensorboardX import SummaryWriter as SummaryWriter_
+from torch.distributions import Normal, Uniform
 
 gpu = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 
@@ -25,11 +30,15 @@ class SummaryWriter(SummaryWriter_):
         self.step = 0
         self.summary_period = summary_period
         self.steps_to_run = steps_to_run
+        self.latest_scalars = {}
+        self.latest_scalar_steps = {}  # The step each of the latest scalars was written at.
 
     def add_scalar(self, tag, scalar_value, global_step=None, **kwargs):
         """Add a scalar to the Tensorboard summary."""
         if global_step is None:
             global_step = self.step
+        self.latest_scalars[tag] = scalar_value
+        self.latest_scalar_steps[tag] = global_step
         super().add_scalar(tag, scalar_value, global_step, **kwargs)
 
     def add_histogram(self, tag, values, global_step=None, bins='auto', **kwargs):
@@ -107,6 +116,273 @@ class MixtureModel(rv_continuous):
         return rvs
 
 
+class BatchPrefetcher:
+    """
+    Iterates endlessly over a data loader, keeping several batches in flight on a background thread. Each batch is
+    a sequence of tensors, which are copied to the device (from pinned memory when the device is a GPU) before the
+    training loop asks for them. `wait_time` accumulates the seconds the training loop spent blocked on data.
+    """
+    def __init__(self, data_loader, device=gpu, depth=2):
+        self.data_loader = data_loader
+        self.seed_data_loader()
+        self.device = torch.device(device)
+        self.depth = depth
+        self.wait_time = 0
+        self.total_wait_time = 0  # Never reset, for the live metrics.
+        self.copy_time = 0
+        self.copy_time_lock = threading.Lock()
+        self.use_cuda_stream = self.device.type == 'cuda'
+        self.batch_queue = None
+        self.stop_event = threading.Event()
+        self.thread = None
+        if depth > 0:
+            self.batch_queue = queue.Queue(maxsize=depth)
+            self.thread = threading.Thread(target=self.fill_queue, daemon=True)
+            self.thread.start()
+        else:
+            self.batch_iterator = self.infinite_batches()
+
+    def seed_data_loader(self):
+        """
+        Gives the data loader (and its sampler) their own generators, seeded from the global torch generator here on
+        the calling thread. The background thread creates a new iterator each epoch, which would otherwise draw its
+        seeds from the global generator while the training loop draws from it too, making the order thread timed.
+        """
+        if self.data_loader.generator is None:
+            self.data_loader.generator = torch.Generator()
+            self.data_loader.generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+        sampler = self.data_loader.sampler
+        if getattr(sampler, 'generator', False) is None:
+            sampler.generator = torch.Generator()
+            sampler.generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+
+    def infinite_batches(self):
+        """Create an infinite generator from the data loader."""
+        while True:
+            for batch in self.data_loader:
+                yield batch
+
+    def to_device(self, batch, stream=None):
+        """Copies a batch of tensors to the device."""
+        copy_start = time.perf_counter()
+        device_batch = []
+        for tensor in batch:
+            if stream is not None:
+                if not tensor.is_pinned():
+                    tensor = tensor.pin_memory()
+                with torch.cuda.stream(stream):
+                    tensor = tensor.to(self.device, non_blocking=True)
+            else:
+                tensor = tensor.to(self.device)
+            device_batch.append(tensor)
+        if stream is not None:
+            stream.synchronize()
+        with self.copy_time_lock:
+            self.copy_time += time.perf_counter() - copy_start
+        return device_batch
+
+    def fill_queue(self):
+        """Loads and copies batches on the background thread until stopped."""
+        stream = torch.cuda.Stream(device=self.device) if self.use_cuda_stream else None
+        try:
+            for batch in self.infinite_batches():
+                if not self.put(self.to_device(batch, stream)):
+                    return
+        except Exception as error:
+            self.put(error)
+
+    def put(self, item):
+        """
+        Queues an item for the training loop, unless stopped while waiting for room.
+
+        :param item: The batch (or the error raised loading it).
+        :type item: list[torch.Tensor] | Exception
+        :return: Whether the item was queued.
+        :rtype: bool
+        """
+        while not self.stop_event.is_set():
+            try:
+                self.batch_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        wait_start = time.perf_counter()
+        if self.batch_queue is None:
+            batch = self.to_device(next(self.batch_iterator))
+        else:
+            batch = self.batch_queue.get()
+            if isinstance(batch, Exception):
+                raise batch
+        wait_time = time.perf_counter() - wait_start
+        self.wait_time += wait_time
+        self.total_wait_time += wait_time
+        if self.use_cuda_stream:
+            for tensor in batch:
+                # The copy stream allocated the memory, so the allocator must know the compute stream uses it.
+                tensor.record_stream(torch.cuda.current_stream(self.device))
+        return batch
+
+    def pop_wait_time(self):
+        """Returns the seconds spent waiting for batches since the last call, and resets the count."""
+        wait_time = self.wait_time
+        self.wait_time = 0
+        return wait_time
+
+    def pop_copy_time(self):
+        """Returns the seconds spent copying batches to the device since the last call, and resets the count."""
+        with self.copy_time_lock:
+            copy_time = self.copy_time
+            self.copy_time = 0
+        return copy_time
+
+    def close(self):
+        """Stops the background thread."""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class PhaseTimer:
+    """
+    Accumulates the wall time spent in each named phase of the training steps, and writes the average seconds per
+    step of each phase as summaries. When disabled, `phase` returns a shared no-op context.
+    """
+    def __init__(self, enabled=True, synchronize=False):
+        self.enabled = enabled
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.totals = defaultdict(float)
+        self.steps = 0
+        self.disabled_phase = nullcontext()
+
+    def phase(self, name):
+        """
+        A context which times the named phase. Entering the context gives the `TimedPhase`, whose `duration` is set
+        on exit, or `None` when disabled.
+
+        :param name: The name of the phase.
+        :type name: str
+        """
+        if not self.enabled:
+            return self.disabled_phase
+        return TimedPhase(self, name)
+
+    def add(self, name, seconds):
+        """Adds time measured elsewhere to the named phase."""
+        if self.enabled:
+            self.totals[name] += seconds
+
+    def step_completed(self):
+        """Counts a completed training step."""
+        self.steps += 1
+
+    def write_summaries(self, summary_writer):
+        """Writes the average seconds per step of each phase since the last summaries, then resets the totals."""
+        if not self.enabled or self.steps == 0:
+            return
+        for name, total in self.totals.items():
+            summary_writer.add_scalar(f'Time/{name}', total / self.steps)
+        self.totals.clear()
+        self.steps = 0
+
+
+class TimedPhase:
+    """A context which adds its duration to a phase of a `PhaseTimer`."""
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+        self.start = None
+        self.duration = None
+
+    def __enter__(self):
+        if self.timer.synchronize:
+            torch.cuda.synchronize()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        if self.timer.synchronize:
+            torch.cuda.synchronize()
+        self.duration = time.perf_counter() - self.start
+        self.timer.totals[self.name] += self.duration
+
+
+class TorchMixtureModel:
+    """
+    An equally weighted combination of several torch distributions, sampled directly on the target device.
+    Normal and uniform submodels are sampled by reparameterizing a single draw of standard noise; any other
+    submodel type is sampled through its inverse CDF.
+    """
+    def __init__(self, submodels, device=gpu, generator=None):
+        self.submodels = [distribution_to_device(submodel, device) for submodel in submodels]
+        submodels = self.submodels
+        self.device = device
+        self.generator = generator
+        if all(isinstance(submodel, Normal) for submodel in submodels):
+            self.locations = torch.stack([submodel.loc for submodel in submodels]).float().to(device)
+            self.scales = torch.stack([submodel.scale for submodel in submodels]).float().to(device)
+            self.noise_function = torch.randn
+        elif all(isinstance(submodel, Uniform) for submodel in submodels):
+            self.locations = torch.stack([submodel.low for submodel in submodels]).float().to(device)
+            self.scales = torch.stack([submodel.high - submodel.low for submodel in submodels]).float().to(device)
+            self.noise_function = torch.rand
+        else:
+            self.locations = None
+            self.scales = None
+            self.noise_function = None
+
+    def rvs(self, size):
+        """Random variates of the mixture model."""
+        submodel_choices = torch.randint(len(self.submodels), size=size, device=self.device, generator=self.generator)
+        if self.noise_function is not None:
+            noise = self.noise_function(size, device=self.device, generator=self.generator)
+            return self.locations[submodel_choices] + (self.scales[submodel_choices] * noise)
+        quantiles = torch.rand(size, device=self.device, generator=self.generator)
+        quantiles = quantiles.clamp(min=torch.finfo(quantiles.dtype).tiny)
+        submodel_samples = torch.stack([submodel.icdf(quantiles) for submodel in self.submodels])
+        return submodel_samples.gather(0, submodel_choices.unsqueeze(0)).squeeze(0)
+
+    def log_prob(self, x):
+        """The log of the probability density function of the mixture model."""
+        x = torch.as_tensor(x, dtype=torch.float32, device=self.device)
+        submodel_log_probs = []
+        for submodel in self.submodels:
+            if isinstance(submodel, Uniform):
+                # The uniform distribution raises outside its support rather than returning -inf.
+                inside = (x >= submodel.low) & (x <= submodel.high)
+                log_prob = torch.where(inside, -(submodel.high - submodel.low).log(),
+                                       torch.full_like(x, -float('inf')))
+            else:
+                log_prob = submodel.log_prob(x)
+            submodel_log_probs.append(log_prob)
+        return torch.logsumexp(torch.stack(submodel_log_probs), dim=0) - np.log(len(self.submodels))
+
+    def pdf(self, x):
+        """The probability density function of the mixture model."""
+        return self.log_prob(x).exp()
+
+
+def distribution_to_device(distribution, device):
+    """
+    Creates a copy of a torch distribution with its parameters on a device.
+
+    :param distribution: The distribution.
+    :type distribution: torch.distributions.Distribution
+    :param device: The device.
+    :type device: torch.device | str
+    :return: The distribution on the device.
+    :rtype: torch.distributions.Distribution
+    """
+    parameters = {name: getattr(distribution, name) for name in distribution.arg_constraints
+                  if name in vars(distribution)}
+    return type(distribution)(**{name: parameter.to(device) for name, parameter in parameters.items()})
+
+
 def seed_all(seed=None):
     """Seed every type of random used by the SRGAN."""
     random.seed(seed)